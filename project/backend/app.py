@@ -1,95 +1,251 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g, make_response, abort
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import QueuePool
 from flask_cors import CORS
 from flask_socketio import SocketIO, emit, join_room, leave_room
-from datetime import datetime
+from datetime import datetime, timedelta
 import threading
+import functools
+import logging
 import json
 import math
 import eventlet
-import traceback
 import random
-import sys
 import hashlib
 import hmac
 import os
-from urllib.parse import parse_qs
+import time
+from urllib.parse import parse_qsl
+from scheduler import scheduler, Countdown
+from writebehind import WriteBehindQueue
+from migrations import run_migrations, SCHEMA_VERSION
+from session_tokens import SessionTokens
+from cache import TTLCache
+from logs import setup_logging, log_fields
+from metrics import Registry
+from sqlprofile import SQLProfiler
+import fastjson
 from config import (
     TELEGRAM_BOT_TOKEN, ADMIN_CHAT_IDS, TELEGRAM_WEBAPP_SECRET,
-    DATABASE_URL, DOMAIN, FRONTEND_URL, BACKEND_URL
+    DATABASE_URL, DOMAIN, FRONTEND_URL, BACKEND_URL, TIMER_RESYNC_INTERVAL,
+    MIGRATE_ON_STARTUP, SESSION_SECRET, SESSION_TOKEN_TTL, CHAT_ID_AUTH_UNTIL, USER_CACHE_SIZE, USER_CACHE_TTL,
+    SOCKETIO_MESSAGE_QUEUE, MULTI_WORKER, WORKER_ID, GAME_LEASE_TTL, LOG_LEVEL, LOG_FORMAT,
+    SQL_PROFILE, SQL_SLOW_MS, SQL_REPEAT_THRESHOLD
 )
 
+# Логи пишет поток ОС из очереди: гринлеты не ждут stderr
+setup_logging(LOG_LEVEL, LOG_FORMAT)
+log = logging.getLogger('mvp')
+
+# Метрики процесса для /metrics; запись в них — словарь и пара сложений под блокировкой
+metrics = Registry()
+http_request_duration = metrics.histogram(
+    'http_request_duration_seconds', 'HTTP request latency by route', ('method', 'route', 'status'))
+socket_events_received = metrics.counter(
+    'socketio_events_received_total', 'Socket.IO events received by event name', ('event',))
+socket_events_emitted = metrics.counter(
+    'socketio_events_emitted_total', 'Socket.IO events emitted by event name', ('event',))
+socket_connections = metrics.gauge('socketio_connected_sockets', 'Sockets connected to this worker')
+game_timer_lateness = metrics.histogram(
+    'game_timer_lateness_seconds', 'Delay between scheduled and actual end of game timers', ('phase',),
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5))
+db_pool_wait = metrics.histogram(
+    'db_pool_checkout_wait_seconds', 'Time spent waiting for a pooled DB connection')
+
+# Запросы и время БД на HTTP-запрос, событие сокета и таймер; повторы форм — кандидаты в N+1
+sql_profiler = SQLProfiler(SQL_SLOW_MS / 1000, SQL_REPEAT_THRESHOLD, registry=metrics, enabled=SQL_PROFILE)
+
+class MeteredSocketIO(SocketIO):
+    """SocketIO со счётчиками входящих и исходящих событий по имени"""
+
+    def on(self, message, namespace=None):
+        register = super().on(message, namespace)
+
+        def decorator(handler):
+            @functools.wraps(handler)
+            def counted(*args, **kwargs):
+                socket_events_received.inc(message)
+                with sql_profiler.profile('socket', message):
+                    return handler(*args, **kwargs)
+            return register(counted)
+        return decorator
+
+    def emit(self, event, *args, **kwargs):
+        socket_events_emitted.inc(event)
+        return super().emit(event, *args, **kwargs)
+
+class TimedQueuePool(QueuePool):
+    """QueuePool, замеряющий ожидание свободного соединения"""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            db_pool_wait.observe(time.perf_counter() - started)
+
 app = Flask(__name__)
-CORS(app, origins=[FRONTEND_URL])
-socketio = SocketIO(app, cors_allowed_origins=[FRONTEND_URL], async_mode='eventlet')
+# orjson, если установлен: ответы и пакеты сокетов, даты в ISO 8601 без isoformat() в to_dict
+app.json = fastjson.FastJSONProvider(app)
+CORS(app, origins=[FRONTEND_URL], expose_headers=['X-DB-Queries', 'X-DB-Commits', 'X-DB-Time-Ms'])
+# С очередью сообщений emit из любого воркера доходит до сокетов всех воркеров
+socketio = MeteredSocketIO(app, cors_allowed_origins=[FRONTEND_URL], async_mode='eventlet',
+                           message_queue=SOCKETIO_MESSAGE_QUEUE or None, json=fastjson)
 
 app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'poolclass': TimedQueuePool}
 
 db = SQLAlchemy(app)
 
+with app.app_context():
+    sql_profiler.attach(db.engine)
+
 # Telegram Web App settings
 # TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN', 'your_bot_token_here')
 # ADMIN_CHAT_IDS = [int(x.strip()) for x in os.getenv('ADMIN_CHAT_IDS', '508246426').split(',')]
 
-lobby_timer = 10
-lobby_timer_running = False
+LOBBY_TIME = 10  # секунд на лобби-таймер
+
+# Обратные отсчёты лобби по lobby_id
 lobby_timer_lock = threading.Lock()
+lobby_countdowns = {}
+
+ROUND_TIME = 15  # секунд на раунд
+CHOICE_TIME = 10  # секунд на выбор
+PLAYER_CHOICES = ('stay', 'leave')
+
+# Раннеры игровых сессий по GameSession.id
+game_runners = {}
+game_runners_lock = threading.Lock()
+
+# Сокеты пользователей: sid -> chat_id и chat_id -> {sid}
+socket_users = {}
+user_sockets = {}
 
-game_timer = 15
-game_timer_running = False
-game_timer_lock = threading.Lock()
-game_session_id = None
+# Версии состава лобби для lobby_delta
+lobby_versions = {}
+lobby_versions_lock = threading.Lock()
 
-choice_timer = 10
-choice_timer_running = False
-choice_timer_lock = threading.Lock()
-choice_session_id = None
+# Версии данных для ETag условных GET: растут на каждой мутации и не сбрасываются;
+# эпоха процесса отличает ETag'и после рестарта
+DATA_VERSION_EPOCH = os.urandom(4).hex()
+data_versions = {}
+data_versions_lock = threading.Lock()
+
+# Комната сокетов администраторов и отложенная сводка для неё
+ADMIN_ROOM = 'admins'
+ADMIN_UPDATE_DELAY = 1
+admin_lobby_update_timer = None
 
 @app.route('/api/data')
 def get_data():
     return jsonify({'message': "hello world"})
 
+# Секретный ключ WebAppData считается один раз, проверка копирует готовый HMAC
+TELEGRAM_WEBAPP_MAC = hmac.new(
+    hmac.new(b"WebAppData", TELEGRAM_BOT_TOKEN.encode(), hashlib.sha256).digest(),
+    digestmod=hashlib.sha256
+)
+
+# Токен бота в плейсхолдере известен всем: подпись сессий на нём позволила бы подделать токен
+if not SESSION_SECRET or SESSION_SECRET == TELEGRAM_BOT_TOKEN:
+    raise RuntimeError('SESSION_SECRET must be set and differ from TELEGRAM_BOT_TOKEN')
+session_tokens = SessionTokens(SESSION_SECRET, SESSION_TOKEN_TTL)
+# Граница окна, в котором ещё принимаются запросы без токена (только chat_id); None — окна нет
+chat_id_auth_until = datetime.fromisoformat(CHAT_ID_AUTH_UNTIL) if CHAT_ID_AUTH_UNTIL else None
+if chat_id_auth_until:
+    log.warning("Requests without a session token are accepted until %s UTC (CHAT_ID_AUTH_UNTIL)", chat_id_auth_until)
+
+# Клеймы токенов сокетов, проверенные при подключении: sid -> claims
+socket_claims = {}
+
 def verify_telegram_webapp_data(init_data):
-    """Проверяет подлинность Telegram Web App InitData"""
+    """Проверяет подлинность Telegram Web App InitData; возвращает поля без hash или None"""
     try:
-        # Разбираем InitData
-        data_dict = dict(parse_qs(init_data))
+        # Разбираем InitData один раз
+        data_dict = dict(parse_qsl(init_data, keep_blank_values=True))
         
         # Извлекаем hash
-        received_hash = data_dict.get('hash', [None])[0]
+        received_hash = data_dict.pop('hash', None)
         if not received_hash:
-            return False
+            return None
             
-        # Удаляем hash из данных для проверки
-        data_check_string = '\n'.join([
-            f"{k}={v[0]}" for k, v in sorted(data_dict.items()) 
-            if k != 'hash'
-        ])
-        
-        # Создаем секретный ключ
-        secret_key = hmac.new(
-            b"WebAppData",
-            TELEGRAM_BOT_TOKEN.encode(),
-            hashlib.sha256
-        ).digest()
+        data_check_string = '\n'.join(f"{k}={v}" for k, v in sorted(data_dict.items()))
         
         # Проверяем подпись
-        calculated_hash = hmac.new(
-            secret_key,
-            data_check_string.encode(),
-            hashlib.sha256
-        ).hexdigest()
+        mac = TELEGRAM_WEBAPP_MAC.copy()
+        mac.update(data_check_string.encode())
         
-        return calculated_hash == received_hash
+        if not hmac.compare_digest(mac.hexdigest(), received_hash):
+            return None
+        return data_dict
     except Exception as e:
-        print(f"Error verifying Telegram data: {e}")
-        return False
+        log.error("Error verifying Telegram data: %s", e)
+        return None
 
 def is_admin(chat_id):
     """Проверяет, является ли пользователь администратором"""
     return chat_id in ADMIN_CHAT_IDS
 
+class SessionUser:
+    """Пользователь из токена сессии: поля User, нужные эндпоинтам для проверок"""
+
+    __slots__ = ('chat_id', 'user_id', 'nickname', 'is_admin')
+
+    def __init__(self, claims):
+        self.chat_id = claims['chat_id']
+        self.user_id = claims['user_id']
+        self.nickname = claims['nickname']
+        self.is_admin = claims['is_admin']
+
+def issue_session_token(user):
+    return session_tokens.issue({
+        'chat_id': user.chat_id,
+        'user_id': user.user_id,
+        'nickname': user.nickname,
+        'is_admin': bool(user.is_admin)
+    })
+
+def request_claims():
+    """Клеймы токена текущего запроса: Authorization: Bearer или токен сокета"""
+    sid = getattr(request, 'sid', None)
+    if sid is not None:
+        claims = socket_claims.get(sid)
+        return claims if claims and claims['exp'] >= time.time() else None
+    if 'session_claims' not in g:
+        header = request.headers.get('Authorization', '')
+        g.session_claims = session_tokens.verify(header[7:]) if header.startswith('Bearer ') else None
+    return g.session_claims
+
+def chat_id_auth_allowed():
+    return chat_id_auth_until is not None and datetime.utcnow() < chat_id_auth_until
+
+def request_chat_id(chat_id=None):
+    """chat_id запроса из действующего токена.
+
+    Переданный клиентом chat_id принимается только в окне CHAT_ID_AUTH_UNTIL.
+    HTTP-запрос без токена получает 401, обработчик сокета — None.
+    """
+    claims = request_claims()
+    if claims:
+        return claims['chat_id']
+    if chat_id_auth_allowed():
+        return chat_id
+    if getattr(request, 'sid', None) is None:
+        abort(make_response(jsonify({'error': 'Invalid or expired session token'}), 401))
+    return None
+
+def request_user(chat_id):
+    """Пользователь запроса: по действующему токену без БД, в окне совместимости — по chat_id"""
+    claims = request_claims()
+    if claims and claims['chat_id'] == str(chat_id):
+        return SessionUser(claims)
+    if chat_id_auth_allowed():
+        return find_user(chat_id)
+    return None
+
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     chat_id = db.Column(db.String(80), unique=True, nullable=False)
@@ -116,7 +272,53 @@ class User(db.Model):
             'is_admin': self.is_admin
         }
 
+class UserRecord:
+    """Снимок строки User для кэша: не привязан к сессии SQLAlchemy"""
+
+    __slots__ = ('chat_id', 'user_id', 'nickname', 'first_name', 'last_name', 'username', 'balance', 'is_admin')
+
+    def __init__(self, user):
+        for field, value in user.to_dict().items():
+            setattr(self, field, value)
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.__slots__}
+
+# Пользователи по ('chat_id', ...) и ('user_id', ...); межпроцессную устарелость ограничивает TTL
+user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+def cache_user(user):
+    record = UserRecord(user)
+    user_cache.set(('chat_id', record.chat_id), record)
+    user_cache.set(('user_id', record.user_id), record)
+    return record
+
+def find_user(chat_id=None, user_id=None):
+    """Пользователь по chat_id или user_id: из кэша, при промахе одним запросом"""
+    field, value = ('chat_id', chat_id) if chat_id is not None else ('user_id', user_id)
+    record = user_cache.get((field, str(value)))
+    if record is None:
+        user = User.query.filter_by(**{field: str(value)}).first()
+        if not user:
+            return None
+        record = cache_user(user)
+    return record
+
+def invalidate_users(chat_ids=(), user_ids=()):
+    """Сбрасывает записи кэша после изменения баланса или профиля (вызывать после коммита)"""
+    keys = [('chat_id', str(c)) for c in chat_ids] + [('user_id', str(u)) for u in user_ids]
+    for key in keys:
+        record = user_cache.pop(key)
+        if record:
+            user_cache.pop(('chat_id', record.chat_id))
+            user_cache.pop(('user_id', record.user_id))
+
 class Lobby(db.Model):
+    __table_args__ = (
+        db.Index('ix_lobby_chat_id_is_active', 'chat_id', 'is_active'),
+        db.Index('ix_lobby_lobby_id_is_active', 'lobby_id', 'is_active'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     lobby_id = db.Column(db.String(80), nullable=False)
     chat_id = db.Column(db.String(80), nullable=False)
@@ -134,7 +336,7 @@ class Lobby(db.Model):
             'chat_id': self.chat_id,
             'user_id': self.user_id,
             'nickname': self.nickname,
-            'joined_at': self.joined_at.isoformat(),
+            'joined_at': self.joined_at,
             'is_active': self.is_active,
             'is_admin': self.is_admin,
             'is_observer': self.is_observer,
@@ -142,8 +344,16 @@ class Lobby(db.Model):
         }
 
 class GameSession(db.Model):
+    __table_args__ = (
+        db.Index('ix_game_session_status', 'status'),
+        # Текущая сессия у лобби одна; архивные (прошлые игры) остаются для replay
+        db.Index('uq_game_session_lobby_current', 'lobby_id', unique=True,
+                 postgresql_where=db.text('NOT archived'), sqlite_where=db.text('NOT archived')),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
-    lobby_id = db.Column(db.String(80), nullable=False, unique=True)
+    lobby_id = db.Column(db.String(80), nullable=False)
+    archived = db.Column(db.Boolean, nullable=False, default=False, server_default=db.false())
     status = db.Column(db.String(20), default='waiting')
     current_round = db.Column(db.Integer, default=1)
     total_rounds = db.Column(db.Integer, default=1)
@@ -151,6 +361,7 @@ class GameSession(db.Model):
     finished_at = db.Column(db.DateTime)
     winner_id = db.Column(db.String(80))
     initial_bank = db.Column(db.Integer, default=0)
+    rng_seed = db.Column(db.BigInteger)
 
     def to_dict(self):
         return {
@@ -159,13 +370,19 @@ class GameSession(db.Model):
             'status': self.status,
             'current_round': self.current_round,
             'total_rounds': self.total_rounds,
-            'started_at': self.started_at.isoformat() if self.started_at else None,
-            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
             'winner_id': self.winner_id,
-            'initial_bank': self.initial_bank
+            'initial_bank': self.initial_bank,
+            'archived': self.archived
         }
 
 class GameRound(db.Model):
+    __table_args__ = (
+        # Раунд записывается один раз: повторная жеребьёвка не пройдёт коммит
+        db.UniqueConstraint('game_session_id', 'round_number', name='uq_game_round_session_round'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     game_session_id = db.Column(db.Integer, db.ForeignKey('game_session.id'), nullable=False)
     round_number = db.Column(db.Integer, nullable=False)
@@ -174,20 +391,27 @@ class GameRound(db.Model):
     eliminated_players = db.Column(db.Text)
     bank = db.Column(db.Integer, default=0)
     players_choice = db.Column(db.Text)
+    # Отсортированные кандидаты жеребьёвки раунда (JSON) для воспроизведения
+    candidates = db.Column(db.Text)
 
     def to_dict(self):
         return {
             'id': self.id,
             'game_session_id': self.game_session_id,
             'round_number': self.round_number,
-            'started_at': self.started_at.isoformat(),
-            'ended_at': self.ended_at.isoformat() if self.ended_at else None,
+            'started_at': self.started_at,
+            'ended_at': self.ended_at,
             'eliminated_players': self.eliminated_players,
             'bank': self.bank,
-            'players_choice': self.players_choice
+            'players_choice': self.players_choice,
+            'candidates': self.candidates
         }
 
 class PlayerChoice(db.Model):
+    __table_args__ = (
+        db.UniqueConstraint('game_session_id', 'round_number', 'user_id', name='uq_player_choice_session_round_user'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     game_session_id = db.Column(db.Integer, db.ForeignKey('game_session.id'), nullable=False)
     round_number = db.Column(db.Integer, nullable=False)
@@ -204,10 +428,15 @@ class PlayerChoice(db.Model):
             'user_id': self.user_id,
             'choice': self.choice,
             'coins_earned': self.coins_earned,
-            'made_at': self.made_at.isoformat()
+            'made_at': self.made_at
         }
 
 class PlayerGameStatus(db.Model):
+    __table_args__ = (
+        db.UniqueConstraint('game_session_id', 'user_id', name='uq_player_game_status_session_user'),
+        db.Index('ix_player_game_status_session_status', 'game_session_id', 'status'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     game_session_id = db.Column(db.Integer, db.ForeignKey('game_session.id'), nullable=False)
     user_id = db.Column(db.String(80), nullable=False)
@@ -226,33 +455,305 @@ class PlayerGameStatus(db.Model):
             'eliminated_in_round': self.eliminated_in_round,
             'quit_in_round': self.quit_in_round,
             'total_coins_earned': self.total_coins_earned,
-            'created_at': self.created_at.isoformat()
+            'created_at': self.created_at
         }
 
-@app.before_request
-def create_tables():
+# Причины движения монет в журнале
+COIN_REASONS = ('opening', 'signup', 'entry_fee', 'deposit', 'win', 'split_payout', 'admin_reset')
+
+class CoinLedger(db.Model):
+    """Журнал изменений баланса: только вставки, сумма delta равна User.balance"""
+    __table_args__ = (
+        db.Index('ix_coin_ledger_user_id', 'user_id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.String(80), nullable=False)
+    delta = db.Column(db.Integer, nullable=False)
+    reason = db.Column(db.String(20), nullable=False)
+    game_session_id = db.Column(db.Integer, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'user_id': self.user_id,
+            'delta': self.delta,
+            'reason': self.reason,
+            'game_session_id': self.game_session_id,
+            'created_at': self.created_at
+        }
+
+class LobbyCountdown(db.Model):
+    """Обратный отсчёт лобби с несколькими воркерами: срок последнего запущенного.
+    Отсчёт воркера, чей срок здесь уже другой, остановлен новым стартом"""
+    lobby_id = db.Column(db.String(80), primary_key=True)
+    deadline = db.Column(db.DateTime, nullable=False)
+
+class GameLease(db.Model):
+    """Аренда игры воркером: таймеры ведёт только владелец, пока продлевает срок"""
+    game_session_id = db.Column(db.Integer, primary_key=True)
+    owner = db.Column(db.String(120), nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+class PlayerState:
+    """Статус игрока идущей игры в памяти (зеркало PlayerGameStatus)"""
+
+    __slots__ = ('id', 'game_session_id', 'user_id', 'status', 'eliminated_in_round',
+                 'quit_in_round', 'total_coins_earned', 'created_at')
+
+    def __init__(self, status):
+        self.id = status.id
+        self.game_session_id = status.game_session_id
+        self.user_id = status.user_id
+        self.status = status.status
+        self.eliminated_in_round = status.eliminated_in_round
+        self.quit_in_round = status.quit_in_round
+        self.total_coins_earned = status.total_coins_earned or 0
+        self.created_at = status.created_at
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'game_session_id': self.game_session_id,
+            'user_id': self.user_id,
+            'status': self.status,
+            'eliminated_in_round': self.eliminated_in_round,
+            'quit_in_round': self.quit_in_round,
+            'total_coins_earned': self.total_coins_earned,
+            'created_at': self.created_at
+        }
+
+    def row(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'eliminated_in_round': self.eliminated_in_round,
+            'quit_in_round': self.quit_in_round,
+            'total_coins_earned': self.total_coins_earned
+        }
+
+class GameState:
+    """Состояние идущей игры в памяти; таблицы догоняют его через game_persister"""
+
+    def __init__(self, game_session, statuses):
+        self.id = game_session.id
+        self.lobby_id = game_session.lobby_id
+        self.status = game_session.status
+        self.current_round = game_session.current_round
+        self.total_rounds = game_session.total_rounds
+        self.started_at = game_session.started_at
+        self.finished_at = game_session.finished_at
+        self.winner_id = game_session.winner_id
+        self.initial_bank = game_session.initial_bank or 0
+        self.engine = EliminationEngine(game_session.rng_seed)
+        self.players = {status.user_id: PlayerState(status) for status in statuses}
+        # round_number -> {user_id: choice} и {user_id: made_at}
+        self.choices = {}
+        self.choices_made_at = {}
+        # round_number -> {user_id}: выборы, уже записанные в БД другим воркером
+        self.stored_choices = {}
+        self.round_started_at = {}
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'lobby_id': self.lobby_id,
+            'status': self.status,
+            'current_round': self.current_round,
+            'total_rounds': self.total_rounds,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'winner_id': self.winner_id,
+            'initial_bank': self.initial_bank
+        }
+
+    def active_players(self):
+        return [p for p in self.players.values() if p.status == 'active']
+
+    def statuses(self):
+        return [p.to_dict() for p in self.players.values()]
+
+    def log_fields(self, round_number=None):
+        return log_fields(lobby_id=self.lobby_id, game_session_id=self.id, round_number=round_number)
+
+    def session_op(self):
+        return ('session', self.id, {
+            'status': self.status,
+            'current_round': self.current_round,
+            'finished_at': self.finished_at,
+            'winner_id': self.winner_id
+        })
+
+    def players_op(self, players=None):
+        players = self.players.values() if players is None else players
+        return ('player_statuses', [p.row() for p in players])
+
+    def persist(self, ops, callback=None):
+        """Отдаёт записи в game_persister; версия игры для ETag сдвигается сейчас и после записи"""
+        bump_data_version('game', self.lobby_id)
+
+        def written():
+            bump_data_version('game', self.lobby_id)
+            if callback:
+                callback()
+
+        game_persister.submit(ops, callback=written, key=self.id)
+
+    def add_choice(self, round_number, user_id, choice):
+        """Принимает выбор игрока; False, если он уже выбирал в этом раунде.
+
+        Между проверкой и записью нет переключения гринлетов, блокировка не нужна.
+        """
+        round_choices = self.choices.setdefault(round_number, {})
+        if user_id in round_choices:
+            return False
+        round_choices[user_id] = choice
+        self.choices_made_at.setdefault(round_number, {})[user_id] = datetime.utcnow()
+        return True
+
+    def choices_op(self, round_number):
+        made_at = self.choices_made_at.get(round_number, {})
+        stored = self.stored_choices.get(round_number, ())
+        return ('choices', [
+            {
+                'game_session_id': self.id,
+                'round_number': round_number,
+                'user_id': user_id,
+                'choice': choice,
+                'coins_earned': 0,
+                'made_at': made_at.get(user_id, datetime.utcnow())
+            }
+            for user_id, choice in self.choices.get(round_number, {}).items()
+            if user_id not in stored
+        ])
+
+class EliminationEngine:
+    """Выбывание по зерну сессии: то же зерно и те же составы дают тех же жертв.
+
+    Кандидаты сортируются, жертвы тянутся из random.Random, заведённого от
+    (seed, номер раунда): раунд не зависит от предыдущих, поэтому воркер,
+    подхвативший игру, тянет то же, что тянул бы прежний владелец. Порядок
+    вытягивания сохраняется в GameRound.eliminated_players для воспроизведения.
+    """
+
+    def __init__(self, seed):
+        self.seed = seed
+
+    def rng(self, round_number):
+        return random.Random(f'{self.seed}:{round_number}')
+
+    def eliminate(self, user_ids, round_number):
+        """Половина кандидатов (с округлением вниз) в порядке вытягивания"""
+        candidates = sorted(user_ids)
+        if len(candidates) <= 1:
+            return []
+        return self.rng(round_number).sample(candidates, len(candidates) // 2)
+
+    def shuffle(self, user_ids, round_number):
+        order = sorted(user_ids)
+        self.rng(round_number).shuffle(order)
+        return order
+
+def new_game_seed():
+    return random.SystemRandom().getrandbits(63)
+
+def replay_eliminations(seed, rounds):
+    """Повторяет жеребьёвку: rounds = [(round_number, активные user_id)] по порядку"""
+    engine = EliminationEngine(seed)
+    return [(round_number, engine.eliminate(user_ids, round_number)) for round_number, user_ids in rounds]
+
+def apply_game_writes(ops):
+    """Применяет накопленные записи игр одним коммитом"""
+    with app.app_context(), sql_profiler.profile('writer', 'game_writes'):
+        changed_users = []
+        try:
+            for op in ops:
+                kind = op[0]
+                if kind == 'session':
+                    _, game_session_id, fields = op
+                    GameSession.query.filter_by(id=game_session_id).update(fields)
+                elif kind == 'player_statuses':
+                    if op[1]:
+                        db.session.execute(db.update(PlayerGameStatus), op[1])
+                elif kind == 'balances':
+                    _, balances, reason, game_session_id = op
+                    rows = [{'b_user_id': user_id, 'b_delta': delta} for user_id, delta in balances.items() if delta]
+                    if rows:
+                        users = User.__table__
+                        db.session.execute(
+                            users.update()
+                            .where(users.c.user_id == db.bindparam('b_user_id'))
+                            .values(balance=users.c.balance + db.bindparam('b_delta')),
+                            rows
+                        )
+                        record_coin_changes(
+                            [(row['b_user_id'], row['b_delta']) for row in rows], reason, game_session_id
+                        )
+                        changed_users.extend((row['b_user_id'], row['b_delta'], reason) for row in rows)
+                elif kind == 'eliminate':
+                    _, game_session_id, round_number, user_ids = op
+                    if user_ids:
+                        statuses = PlayerGameStatus.__table__
+                        db.session.execute(
+                            statuses.update()
+                            .where(statuses.c.game_session_id == game_session_id)
+                            .where(statuses.c.user_id.in_(user_ids))
+                            .where(statuses.c.status == 'active')
+                            .values(status='eliminated', eliminated_in_round=round_number)
+                        )
+                elif kind == 'choices':
+                    if op[1]:
+                        db.session.execute(db.insert(PlayerChoice), op[1])
+                elif kind == 'round':
+                    _, fields = op
+                    db.session.add(GameRound(**fields))
+                elif kind == 'round_update':
+                    _, game_session_id, round_number, fields = op
+                    GameRound.query.filter_by(game_session_id=game_session_id, round_number=round_number).update(fields)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        if changed_users:
+            invalidate_users(user_ids=[user_id for user_id, _, _ in changed_users])
+            # Новые балансы одним чтением после коммита — и сразу владельцам
+            balances = dict(db.session.query(User.user_id, User.balance).filter(
+                User.user_id.in_([user_id for user_id, _, _ in changed_users])
+            ).all())
+            for user_id, delta, reason in changed_users:
+                push_balance_update(user_id, balances.get(user_id), delta, reason)
+
+game_persister = WriteBehindQueue(apply_game_writes)
+
+def migrate_database_on_startup():
+    # Схема обновляется один раз при старте, а не на каждом запросе
     try:
-        db.create_all()
-        print("Database tables created/verified successfully")
+        with app.app_context():
+            applied = run_migrations(db.engine, db.metadata)
+        log.info("Database schema at version %s, applied migrations: %s", SCHEMA_VERSION, applied or 'none')
     except Exception as e:
-        print(f"Error creating database tables: {str(e)}")
-        print(f"Full traceback: {traceback.format_exc()}")
+        log.exception("Error migrating database")
+
+if MIGRATE_ON_STARTUP:
+    migrate_database_on_startup()
 
 def clear_lobby_on_startup():
     try:
         with app.app_context():
             Lobby.query.update({'is_active': False})
             db.session.commit()
-            print("Lobby cleared on startup")
+            log.info("Lobby cleared on startup")
     except Exception as e:
-        print(f"Error clearing lobby on startup: {e}")
+        log.error("Error clearing lobby on startup: %s", e)
 
-try:
-    clear_lobby_on_startup()
-    print("Lobby cleared on startup successfully")
-except Exception as e:
-    print(f"Error clearing lobby on startup: {str(e)}")
-    print(f"Full traceback: {traceback.format_exc()}")
+# С несколькими воркерами рестарт одного не должен выкидывать игроков остальных
+if not MULTI_WORKER:
+    try:
+        clear_lobby_on_startup()
+        log.info("Lobby cleared on startup successfully")
+    except Exception as e:
+        log.exception("Error clearing lobby on startup")
 
 @app.route('/api/telegram/auth', methods=['POST'])
 def telegram_auth():
@@ -264,15 +765,13 @@ def telegram_auth():
         return jsonify({'error': 'Missing initData'}), 400
     
     # Проверяем подлинность данных от Telegram
-    if not verify_telegram_webapp_data(init_data):
+    data_dict = verify_telegram_webapp_data(init_data)
+    if data_dict is None:
         return jsonify({'error': 'Invalid Telegram data'}), 401
     
     try:
-        # Разбираем InitData
-        data_dict = dict(parse_qs(init_data))
-        
         # Извлекаем данные пользователя
-        chat_id = data_dict.get('user', [None])[0]
+        chat_id = data_dict.get('user')
         if not chat_id:
             return jsonify({'error': 'Missing user data'}), 400
         
@@ -307,6 +806,7 @@ def telegram_auth():
                 is_admin=is_admin_user
             )
             db.session.add(user)
+            record_coin_changes([(user.user_id, user.balance)], 'signup')
         else:
             # Обновляем данные пользователя
             user.nickname = nickname
@@ -316,38 +816,134 @@ def telegram_auth():
             user.is_admin = is_admin_user
         
         db.session.commit()
+        cache_user(user)
         
         return jsonify({
             'message': 'Authentication successful',
-            'user': user.to_dict()
+            'user': user.to_dict(),
+            'token': issue_session_token(user),
+            'expires_in': SESSION_TOKEN_TTL
         }), 200
         
     except Exception as e:
-        print(f"Error in telegram_auth: {e}")
+        log.error("Error in telegram_auth: %s", e)
         return jsonify({'error': 'Authentication failed'}), 500
 
+@app.route('/api/auth/refresh', methods=['POST'])
+def refresh_session_token():
+    """Новый токен по ещё действующему: клиент обновляет его до истечения срока"""
+    claims = request_claims()
+    if not claims:
+        return jsonify({'error': 'Invalid or expired session token'}), 401
+
+    user = find_user(chat_id=claims['chat_id'])
+    if not user:
+        return jsonify({'error': 'User not found'}), 404
+
+    return jsonify({
+        'token': issue_session_token(user),
+        'expires_in': SESSION_TOKEN_TTL
+    }), 200
+
 @app.route('/api/user', methods=['GET'])
 def get_user():
-    chat_id = request.args.get('chat_id')
+    chat_id = request_chat_id(request.args.get('chat_id'))
     if not chat_id:
         return jsonify({'error': 'Missing chat_id'}), 400
 
-    user = User.query.filter_by(chat_id=chat_id).first()
+    user = find_user(chat_id)
     if not user:
         return jsonify({'error': 'User not found'}), 404
 
     return jsonify(user.to_dict()), 200
 
+def record_coin_changes(changes, reason, game_session_id=None):
+    """Добавляет записи журнала [(user_id, delta)] одной вставкой в текущую транзакцию"""
+    rows = [
+        {
+            'user_id': user_id,
+            'delta': delta,
+            'reason': reason,
+            'game_session_id': game_session_id,
+            'created_at': datetime.utcnow()
+        }
+        for user_id, delta in changes if delta
+    ]
+    if rows:
+        db.session.execute(db.insert(CoinLedger), rows)
+
+def change_balance(chat_id, delta, reason, game_session_id=None, skip_admins=False):
+    """Атомарно меняет баланс одним условным UPDATE ... RETURNING и пишет журнал.
+
+    Баланс не уходит в минус. Возвращает (user_id, новый баланс) или None,
+    если пользователь не найден или условие не выполнилось.
+    """
+    users = User.__table__
+    query = (
+        users.update()
+        .where(users.c.chat_id == chat_id)
+        .where(users.c.balance + delta >= 0)
+        .values(balance=users.c.balance + delta)
+        .returning(users.c.user_id, users.c.balance)
+    )
+    if skip_admins:
+        query = query.where(users.c.is_admin.isnot(True))
+    row = db.session.execute(query).first()
+    if row is None:
+        db.session.rollback()
+        return None
+    record_coin_changes([(row.user_id, delta)], reason, game_session_id)
+    db.session.commit()
+    invalidate_users(user_ids=[row.user_id])
+    push_balance_update(row.user_id, row.balance, delta, reason)
+    return row.user_id, row.balance
+
+def reconcile_coin_ledger(batch_size=500):
+    """Сверяет User.balance с суммой журнала пачками по batch_size пользователей"""
+    mismatches = []
+    checked = 0
+    last_id = 0
+    while True:
+        ledger = db.session.query(
+            CoinLedger.user_id.label('user_id'),
+            db.func.sum(CoinLedger.delta).label('total')
+        ).group_by(CoinLedger.user_id).subquery()
+        rows = db.session.query(
+            User.id, User.user_id, User.balance, db.func.coalesce(ledger.c.total, 0)
+        ).outerjoin(
+            ledger, ledger.c.user_id == User.user_id
+        ).filter(User.id > last_id).order_by(User.id).limit(batch_size).all()
+        if not rows:
+            break
+        for id_, user_id, balance, total in rows:
+            if (balance or 0) != total:
+                mismatches.append({'user_id': user_id, 'balance': balance, 'ledger_total': int(total)})
+        checked += len(rows)
+        last_id = rows[-1][0]
+    return {'checked': checked, 'mismatches': mismatches}
+
 @app.route('/api/coins/deduct', methods=['POST'])
 def deduct_coins():
     data = request.json
-    chat_id = data.get('chat_id')
+    chat_id = request_chat_id(data.get('chat_id'))
     amount = data.get('amount', 1)
 
     if not chat_id:
         return jsonify({'error': 'Missing chat_id'}), 400
 
-    user = User.query.filter_by(chat_id=chat_id).first()
+    if amount < 0:
+        return jsonify({'error': 'Amount must be positive'}), 400
+
+    changed = change_balance(chat_id, -amount, 'entry_fee', skip_admins=True)
+    if changed:
+        return jsonify({
+            'message': 'Coins deducted successfully',
+            'balance': changed[1],
+            'deducted': amount
+        }), 200
+
+    # Условие не прошло: разбираем причину отдельным чтением
+    user = find_user(chat_id)
     if not user:
         return jsonify({'error': 'User not found'}), 404
 
@@ -358,47 +954,37 @@ def deduct_coins():
             'deducted': 0
         }), 200
 
-    if user.balance < amount:
-        return jsonify({'error': 'Insufficient balance', 'balance': user.balance}), 400
-
-    user.balance -= amount
-    db.session.commit()
-
-    return jsonify({
-        'message': 'Coins deducted successfully',
-        'balance': user.balance,
-        'deducted': amount
-    }), 200
+    return jsonify({'error': 'Insufficient balance', 'balance': user.balance}), 400
 
 @app.route('/api/coins/add', methods=['POST'])
 def add_coins():
     data = request.json
-    chat_id = data.get('chat_id')
+    chat_id = request_chat_id(data.get('chat_id'))
     amount = data.get('amount', 1)
 
     if not chat_id:
         return jsonify({'error': 'Missing chat_id'}), 400
 
-    user = User.query.filter_by(chat_id=chat_id).first()
-    if not user:
-        return jsonify({'error': 'User not found'}), 404
+    if amount < 0:
+        return jsonify({'error': 'Amount must be positive'}), 400
 
-    user.balance += amount
-    db.session.commit()
+    changed = change_balance(chat_id, amount, 'deposit')
+    if not changed:
+        return jsonify({'error': 'User not found'}), 404
 
     return jsonify({
         'message': 'Coins added successfully',
-        'balance': user.balance,
+        'balance': changed[1],
         'added': amount
     }), 200
 
 @app.route('/api/coins/balance', methods=['GET'])
 def get_balance():
-    chat_id = request.args.get('chat_id')
+    chat_id = request_chat_id(request.args.get('chat_id'))
     if not chat_id:
         return jsonify({'error': 'Missing chat_id'}), 400
 
-    user = User.query.filter_by(chat_id=chat_id).first()
+    user = find_user(chat_id)
     if not user:
         return jsonify({'error': 'User not found'}), 404
 
@@ -409,13 +995,13 @@ def get_balance():
 @app.route('/api/lobby/join', methods=['POST'])
 def join_lobby():
     data = request.json
-    chat_id = data.get('chat_id')
+    chat_id = request_chat_id(data.get('chat_id'))
     lobby_id = data.get('lobby_id')
 
     if not chat_id or not lobby_id:
         return jsonify({'error': 'Missing chat_id or lobby_id'}), 400
 
-    user = User.query.filter_by(chat_id=chat_id).first()
+    user = request_user(chat_id)
     if not user:
         return jsonify({'error': 'User not found'}), 404
 
@@ -434,6 +1020,14 @@ def join_lobby():
     db.session.add(lobby_entry)
     db.session.commit()
 
+    move_user_sockets_to_lobby(chat_id, lobby_id, user.user_id)
+    if existing_lobby_entry and existing_lobby_entry.lobby_id == lobby_id:
+        emit_lobby_delta(lobby_id, changed=[lobby_entry])
+    else:
+        if existing_lobby_entry:
+            emit_lobby_delta(existing_lobby_entry.lobby_id, removed=[existing_lobby_entry.chat_id])
+        emit_lobby_delta(lobby_id, added=[lobby_entry])
+
     return jsonify({
         'message': 'Successfully joined lobby',
         'chat_id': chat_id,
@@ -447,7 +1041,7 @@ def join_lobby():
 @app.route('/api/lobby/leave', methods=['POST'])
 def leave_lobby():
     data = request.json
-    chat_id = data.get('chat_id')
+    chat_id = request_chat_id(data.get('chat_id'))
 
     if not chat_id:
         return jsonify({'error': 'Missing chat_id'}), 400
@@ -456,18 +1050,29 @@ def leave_lobby():
     if not lobby_entry:
         return jsonify({'error': 'User not in lobby'}), 404
 
-    current_game = GameSession.query.filter_by(status='playing').first()
+    user = request_user(chat_id)
+    if not user:
+        return jsonify({'error': 'User not found'}), 404
+
+    current_game = GameSession.query.filter_by(lobby_id=lobby_entry.lobby_id, status='playing').first()
 
-    if current_game and not user.is_admin:
-        player_status = PlayerGameStatus.query.filter_by(game_session_id=current_game.id, user_id=user.user_id, status='active').first()
-        if player_status:
+    state = get_game_state(current_game.id) if current_game else None
+    if state and not user.is_admin:
+        player_status = state.players.get(user.user_id)
+        if player_status and player_status.status == 'active':
             player_status.status = 'quit'
-            player_status.quit_in_round = current_game.current_round
-            db.session.commit()
-            statuses = PlayerGameStatus.query.filter_by(game_session_id=current_game.id).all()
-            socketio.emit('player_status_update', {
-                'statuses': [s.to_dict() for s in statuses]
-            })
+            player_status.quit_in_round = state.current_round
+            state.persist([state.players_op([player_status])])
+            emit_to_lobby('player_status_update', {
+                'statuses': state.statuses()
+            }, lobby_entry.lobby_id)
+            push_my_status(state, [player_status])
+    elif current_game and MULTI_WORKER and not user.is_admin:
+        # Игру ведёт другой воркер: выход пишется в БД, владелец подхватит его в конце фазы
+        PlayerGameStatus.query.filter_by(
+            game_session_id=current_game.id, user_id=user.user_id, status='active'
+        ).update({'status': 'quit', 'quit_in_round': current_game.current_round})
+        db.session.commit()
 
     if not user.is_admin and lobby_entry.is_ready:
         return jsonify({'error': 'Cannot leave lobby when ready for game'}), 400
@@ -475,6 +1080,9 @@ def leave_lobby():
     lobby_entry.is_active = False
     db.session.commit()
 
+    move_user_sockets_to_lobby(chat_id, None, user.user_id)
+    emit_lobby_delta(lobby_entry.lobby_id, removed=[lobby_entry.chat_id])
+
     return jsonify({
         'message': 'Successfully left lobby',
         'chat_id': chat_id
@@ -483,12 +1091,12 @@ def leave_lobby():
 @app.route('/api/lobby/ready', methods=['POST'])
 def set_player_ready():
     data = request.json
-    chat_id = data.get('chat_id')
+    chat_id = request_chat_id(data.get('chat_id'))
 
     if not chat_id:
         return jsonify({'error': 'Missing chat_id'}), 400
 
-    user = User.query.filter_by(chat_id=chat_id).first()
+    user = request_user(chat_id)
     if not user:
         return jsonify({'error': 'User not in lobby'}), 404
 
@@ -498,6 +1106,7 @@ def set_player_ready():
     lobby_entry = Lobby.query.filter_by(chat_id=chat_id, is_active=True).first()
     lobby_entry.is_ready = True
     db.session.commit()
+    emit_lobby_delta(lobby_entry.lobby_id, changed=[lobby_entry])
 
     return jsonify({
         'message': 'Player is ready for game',
@@ -507,12 +1116,12 @@ def set_player_ready():
 @app.route('/api/lobby/unready', methods=['POST'])
 def set_player_unready():
     data = request.json
-    chat_id = data.get('chat_id')
+    chat_id = request_chat_id(data.get('chat_id'))
 
     if not chat_id:
         return jsonify({'error': 'Missing chat_id'}), 400
 
-    user = User.query.filter_by(chat_id=chat_id).first()
+    user = request_user(chat_id)
     if not user:
         return jsonify({'error': 'User not in lobby'}), 404
 
@@ -522,6 +1131,7 @@ def set_player_unready():
     lobby_entry = Lobby.query.filter_by(chat_id=chat_id, is_active=True).first()
     lobby_entry.is_ready = False
     db.session.commit()
+    emit_lobby_delta(lobby_entry.lobby_id, changed=[lobby_entry])
 
     return jsonify({
         'message': 'Player is no longer ready for game',
@@ -531,7 +1141,7 @@ def set_player_unready():
 @app.route('/api/lobby/reset-ready', methods=['POST'])
 def reset_player_ready():
     data = request.json
-    chat_id = data.get('chat_id')
+    chat_id = request_chat_id(data.get('chat_id'))
 
     if not chat_id:
         return jsonify({'error': 'Missing chat_id'}), 400
@@ -541,6 +1151,7 @@ def reset_player_ready():
         if player:
             player.is_ready = False
             db.session.commit()
+            emit_lobby_delta(player.lobby_id, changed=[player])
             return jsonify({'message': 'Player ready status reset'}), 200
         else:
             return jsonify({'error': 'Player not found in lobby'}), 404
@@ -549,7 +1160,7 @@ def reset_player_ready():
 
 @app.route('/api/lobby/ready', methods=['GET'])
 def check_player_ready():
-    chat_id = request.args.get('chat_id')
+    chat_id = request_chat_id(request.args.get('chat_id'))
 
     if not chat_id:
         return jsonify({'error': 'Missing chat_id'}), 400
@@ -563,89 +1174,90 @@ def check_player_ready():
     except Exception as e:
         return jsonify({'error': f'Error checking player ready status: {str(e)}'}), 500
 
-@app.route('/api/lobby/players', methods=['GET'])
-def get_lobby_players():
-    active_players = Lobby.query.filter_by(is_active=True).order_by(Lobby.joined_at.asc()).all()
-
-    current_game = GameSession.query.filter_by(status='playing').first()
-    game_session_id = current_game.id if current_game else None
+def lobby_game_statuses(lobby_ids):
+    """Статусы игроков идущих игр: {lobby_id: {user_id: status}}"""
+    statuses = {}
+    for runner in list(game_runners.values()):
+        if runner.state and runner.state.status == 'playing' and runner.lobby_id in lobby_ids:
+            statuses[runner.lobby_id] = {p.user_id: p.status for p in runner.state.players.values()}
+    missing = [lobby_id for lobby_id in lobby_ids if lobby_id not in statuses]
+    # С одним воркером идущая игра всегда в раннере; в БД «playing» без раннера — игра, оборванная рестартом
+    if missing and MULTI_WORKER:
+        rows = db.session.query(GameSession.lobby_id, PlayerGameStatus.user_id, PlayerGameStatus.status).join(
+            PlayerGameStatus, PlayerGameStatus.game_session_id == GameSession.id
+        ).filter(GameSession.status == 'playing', GameSession.lobby_id.in_(missing)).all()
+        for lobby_id, user_id, status in rows:
+            statuses.setdefault(lobby_id, {})[user_id] = status
+    return statuses
+
+def list_lobby_players(lobby_id=None, include_admins=False):
+    """Активные игроки лобби одним запросом с флагом is_admin из User"""
+    query = db.session.query(Lobby, User.is_admin).outerjoin(
+        User, Lobby.chat_id == User.chat_id
+    ).filter(Lobby.is_active == True)
+    if lobby_id:
+        query = query.filter(Lobby.lobby_id == lobby_id)
+    rows = query.order_by(Lobby.joined_at.asc()).all()
 
-    player_statuses = {}
-    if game_session_id:
-        for status in PlayerGameStatus.query.filter_by(game_session_id=game_session_id).all():
-            player_statuses[status.user_id] = status
+    game_statuses = lobby_game_statuses({player.lobby_id for player, _ in rows})
 
     players = []
-    for player in active_players:
+    for player, user_is_admin in rows:
         # Пропускаем администраторов
-        user = User.query.filter_by(chat_id=player.chat_id).first()
-        if user and user.is_admin:
+        if user_is_admin and not include_admins:
             continue
-            
-        player_data = player.to_dict()
-        player_data['is_admin'] = False
-        player_data['is_joined'] = True
-        player_data['is_ready'] = player.is_ready
-        player_data['is_observer'] = player.is_observer
-        player_data['is_eliminated'] = False
-        player_data['is_in_game'] = False
-        player_data['is_winner'] = False
-
-        if current_game:
-            status = player_statuses.get(player.user_id)
-            if status:
-                if status.status == 'eliminated':
-                    player_data['is_eliminated'] = True
-                elif status.status == 'winner':
-                    player_data['is_winner'] = True
-                elif status.status == 'active':
-                    player_data['is_in_game'] = True
-                elif status.status == 'quit':
-                    player_data['is_eliminated'] = True
-            else:
-                pass
-        players.append(player_data)
-    return jsonify({
-        'players': players,
-        'count': len(players)
-    }), 200
+        players.append(lobby_player_dict(
+            player, user_is_admin, game_statuses.get(player.lobby_id, {}).get(player.user_id)
+        ))
+    return players
+
+def lobby_player_dict(player, user_is_admin, status):
+    """Строка игрока лобби для клиента: is_admin из User и флаги статуса в идущей игре"""
+    player_data = player.to_dict()
+    player_data['is_admin'] = bool(user_is_admin)
+    player_data['is_joined'] = True
+    player_data['is_ready'] = player.is_ready
+    player_data['is_observer'] = player.is_observer
+    player_data['is_eliminated'] = False
+    player_data['is_in_game'] = False
+    player_data['is_winner'] = False
+
+    if status == 'eliminated':
+        player_data['is_eliminated'] = True
+    elif status == 'winner':
+        player_data['is_winner'] = True
+    elif status == 'active':
+        player_data['is_in_game'] = True
+    elif status == 'quit':
+        player_data['is_eliminated'] = True
+    return player_data
+
+def lobby_delta_players(lobby_id, entries):
+    """Строки дельты в том же виде, что и в снимке; is_admin — из кэша пользователей"""
+    if not entries:
+        return []
+    statuses = lobby_game_statuses({lobby_id}).get(lobby_id, {})
+    players = []
+    for entry in entries:
+        user = find_user(chat_id=entry.chat_id)
+        players.append(lobby_player_dict(entry, user.is_admin if user else False, statuses.get(entry.user_id)))
+    return players
+
+@app.route('/api/lobby/players', methods=['GET'])
+def get_lobby_players():
+    def build():
+        players = list_lobby_players()
+        return jsonify({
+            'players': players,
+            'count': len(players)
+        }), 200
+
+    return conditional_response(data_etag(('lobby', None), ('game', None)), build)
 
 @app.route('/api/admin/lobby/players', methods=['GET'])
 def get_admin_lobby_players():
     lobby_id = request.args.get('lobby_id')
-    if lobby_id:
-        active_players = Lobby.query.filter_by(is_active=True, lobby_id=lobby_id).order_by(Lobby.joined_at.asc()).all()
-    else:
-        active_players = Lobby.query.filter_by(is_active=True).order_by(Lobby.joined_at.asc()).all()
-    current_game = GameSession.query.filter_by(status='playing').first()
-    game_session_id = current_game.id if current_game else None
-    player_statuses = {}
-    if game_session_id:
-        for status in PlayerGameStatus.query.filter_by(game_session_id=game_session_id).all():
-            player_statuses[status.user_id] = status
-    players = []
-    for player in active_players:
-        user = User.query.filter_by(chat_id=player.chat_id).first()
-        player_data = player.to_dict()
-        player_data['is_admin'] = user.is_admin if user else False
-        player_data['is_joined'] = True
-        player_data['is_ready'] = player.is_ready
-        player_data['is_observer'] = player.is_observer
-        player_data['is_eliminated'] = False
-        player_data['is_in_game'] = False
-        player_data['is_winner'] = False
-        if current_game:
-            status = player_statuses.get(player.user_id)
-            if status:
-                if status.status == 'eliminated':
-                    player_data['is_eliminated'] = True
-                elif status.status == 'winner':
-                    player_data['is_winner'] = True
-                elif status.status == 'active':
-                    player_data['is_in_game'] = True
-                elif status.status == 'quit':
-                    player_data['is_eliminated'] = True
-        players.append(player_data)
+    players = list_lobby_players(lobby_id, include_admins=True)
     return jsonify({
         'players': players,
         'count': len(players),
@@ -655,18 +1267,19 @@ def get_admin_lobby_players():
 @app.route('/api/admin/lobby/<lobby_id>/join', methods=['POST'])
 def admin_join_specific_lobby(lobby_id):
     data = request.json
-    chat_id = data.get('chat_id')
+    chat_id = request_chat_id(data.get('chat_id'))
 
     if not chat_id:
         return jsonify({'error': 'Missing chat_id'}), 400
 
-    user = User.query.filter_by(chat_id=chat_id).first()
+    user = request_user(chat_id)
     if not user or not user.is_admin:
         return jsonify({'error': 'Only admin can use this endpoint'}), 403
 
     existing_entries = Lobby.query.filter_by(chat_id=chat_id, is_active=True).all()
     for entry in existing_entries:
         entry.is_active = False
+    left_lobbies = {entry.lobby_id for entry in existing_entries}
 
     lobby_entry = Lobby(
         chat_id=chat_id,
@@ -679,6 +1292,14 @@ def admin_join_specific_lobby(lobby_id):
     db.session.add(lobby_entry)
     db.session.commit()
 
+    move_user_sockets_to_lobby(chat_id, lobby_id, user.user_id)
+    for left_lobby_id in left_lobbies - {lobby_id}:
+        emit_lobby_delta(left_lobby_id, removed=[lobby_entry.chat_id])
+    if lobby_id in left_lobbies:
+        emit_lobby_delta(lobby_id, changed=[lobby_entry])
+    else:
+        emit_lobby_delta(lobby_id, added=[lobby_entry])
+
     return jsonify({
         'message': 'Admin successfully joined specific lobby',
         'chat_id': chat_id,
@@ -690,22 +1311,37 @@ def admin_join_specific_lobby(lobby_id):
 
 @app.route('/api/lobby/clear', methods=['POST'])
 def clear_lobby():
+    for game_session_id in list(game_runners):
+        stop_game_runner(game_session_id)
+    game_persister.flush()
+    game_persister.discard()
+    lobby_versions.clear()
     Lobby.query.delete()
-    GameSession.query.delete()
+    archive_game_sessions()
     db.session.commit()
+    bump_data_version('lobby')
+    bump_data_version('game')
     return jsonify({'message': 'Lobby and game sessions cleared'}), 200
 
 @app.route('/api/admin/give-coins-to-all', methods=['POST'])
 def give_coins_to_all():
     try:
-        all_users = User.query.all()
-        updated_count = 0
-
-        for user in all_users:
-            user.balance = 10
-            updated_count += 1
+        users = User.__table__
+        # Сначала журнал (разница до 10), затем сам сброс — в одной транзакции
+        db.session.execute(db.insert(CoinLedger).from_select(
+            ['user_id', 'delta', 'reason', 'created_at'],
+            db.select(
+                users.c.user_id,
+                10 - db.func.coalesce(users.c.balance, 0),
+                db.literal('admin_reset'),
+                db.literal(datetime.utcnow())
+            ).where(db.func.coalesce(users.c.balance, 0) != 10)
+        ))
+        updated_count = db.session.execute(users.update().values(balance=10)).rowcount
 
         db.session.commit()
+        user_cache.clear()
+        socketio.emit('balance_update', {'balance': 10, 'delta': None, 'reason': 'admin_reset'})
 
         return jsonify({
             'message': f'Successfully updated balance for {updated_count} users',
@@ -742,40 +1378,201 @@ def get_all_users():
             'error': f'Error getting users: {str(e)}'
         }), 500
 
+def lobby_room(lobby_id):
+    return f'lobby:{lobby_id}'
+
+def emit_to_lobby(event, data, lobby_id):
+    """Отправляет событие только сокетам комнаты лобби"""
+    socketio.emit(event, data, to=lobby_room(lobby_id))
+
+def game_lobby_id(game_session_id):
+    runner = game_runners.get(game_session_id)
+    if runner and runner.lobby_id:
+        return runner.lobby_id
+    game_session = GameSession.query.get(game_session_id)
+    return game_session.lobby_id if game_session else None
+
+def user_room(user_id):
+    return f'user:{user_id}'
+
+def emit_to_user(event, data, user_id):
+    """Отправляет событие всем сокетам одного пользователя"""
+    socketio.emit(event, data, to=user_room(user_id))
+
+def register_user_socket(sid, chat_id, user_id=None):
+    previous = socket_users.get(sid)
+    if previous and previous != chat_id:
+        user_sockets.get(previous, set()).discard(sid)
+        for room in socketio.server.rooms(sid, namespace='/'):
+            if room.startswith('user:'):
+                leave_room(room, sid=sid, namespace='/')
+    socket_users[sid] = chat_id
+    user_sockets.setdefault(chat_id, set()).add(sid)
+    if user_id:
+        join_room(user_room(user_id), sid=sid, namespace='/')
+
+def push_balance_update(user_id, balance, delta, reason):
+    emit_to_user('balance_update', {'balance': balance, 'delta': delta, 'reason': reason}, user_id)
+
+def push_my_status(state, players):
+    """Личное событие о статусе в игре каждому из players"""
+    for player in players:
+        emit_to_user('my_status_update', dict(player.to_dict(), lobby_id=state.lobby_id), player.user_id)
+
+def current_game_status(lobby_id, user_id):
+    """Статус пользователя в идущей игре лобби: из раннера, иначе из БД (игра на другом воркере)"""
+    runner = find_game_runner(lobby_id)
+    if runner:
+        return runner.state.players.get(user_id)
+    if not MULTI_WORKER:
+        # С одним воркером идущая игра всегда в раннере
+        return None
+    game_session = GameSession.query.filter_by(lobby_id=lobby_id, status='playing').first()
+    if not game_session:
+        return None
+    return PlayerGameStatus.query.filter_by(game_session_id=game_session.id, user_id=user_id).first()
+
+def move_socket_to_lobby(sid, lobby_id):
+    for room in socketio.server.rooms(sid, namespace='/'):
+        if room.startswith('lobby:') and room != lobby_room(lobby_id):
+            leave_room(room, sid=sid, namespace='/')
+    if lobby_id:
+        join_room(lobby_room(lobby_id), sid=sid, namespace='/')
+
+def move_user_sockets_to_lobby(chat_id, lobby_id, user_id):
+    """Переводит все сокеты пользователя в комнату лобби (None — вывести из комнат лобби).
+
+    Сокеты известны только своему воркеру: с несколькими воркерами остальным
+    сокетам пользователя уходит lobby_room_changed, и клиент сверяет комнату
+    событием sync_lobby_room на своём воркере.
+    """
+    for sid in list(user_sockets.get(str(chat_id), ())):
+        move_socket_to_lobby(sid, lobby_id)
+    if MULTI_WORKER:
+        emit_to_user('lobby_room_changed', {'lobby_id': lobby_id}, user_id)
+
+@socketio.on('connect')
+def ws_connect(auth=None):
+    # Токен проверяется один раз на подключение, дальше обработчики берут клеймы по sid
+    claims = session_tokens.verify((auth or {}).get('token'))
+    if claims:
+        socket_claims[request.sid] = claims
+        register_user_socket(request.sid, claims['chat_id'], claims['user_id'])
+    socket_connections.inc()
+
+@socketio.on('session_token')
+def ws_session_token(data=None):
+    """Токен после входа или обновления: сокет, подключённый раньше, получает новые клеймы"""
+    claims = session_tokens.verify((data or {}).get('token'))
+    if not claims:
+        return
+    socket_claims[request.sid] = claims
+    register_user_socket(request.sid, claims['chat_id'], claims['user_id'])
+
+@socketio.on('disconnect')
+def ws_disconnect():
+    socket_connections.dec()
+    socket_claims.pop(request.sid, None)
+    chat_id = socket_users.pop(request.sid, None)
+    if chat_id:
+        sids = user_sockets.get(chat_id)
+        if sids:
+            sids.discard(request.sid)
+            if not sids:
+                user_sockets.pop(chat_id, None)
+
 @socketio.on('join_lobby')
 def ws_join_lobby(data):
-    chat_id = data.get('chat_id')
+    chat_id = request_chat_id(data.get('chat_id'))
     lobby_id = data.get('lobby_id')
     if not chat_id or not lobby_id:
         return
-    user = User.query.filter_by(chat_id=chat_id).first()
+    user = request_user(chat_id)
     if not user:
         return
     existing = Lobby.query.filter_by(chat_id=chat_id, is_active=True).first()
+    register_user_socket(request.sid, str(chat_id), user.user_id)
     if not existing:
         lobby_entry = Lobby(chat_id=chat_id, user_id=user.user_id, nickname=user.nickname, lobby_id=lobby_id, is_ready=True)
         db.session.add(lobby_entry)
         db.session.commit()
-    emit_lobby_update()
+        move_user_sockets_to_lobby(chat_id, lobby_id, user.user_id)
+        emit_lobby_delta(lobby_id, added=[lobby_entry])
+    else:
+        lobby_id = existing.lobby_id
+        move_user_sockets_to_lobby(chat_id, lobby_id, user.user_id)
+    # Новому сокету — полный снимок, остальным хватает дельты
+    emit('lobby_update', lobby_update_payload(lobby_id))
+    if existing:
+        # Переподключение посреди игры: свой статус вместо запроса player-status
+        player_status = current_game_status(lobby_id, user.user_id)
+        if player_status:
+            emit('my_status_update', dict(player_status.to_dict(), lobby_id=lobby_id))
 
 @socketio.on('leave_lobby')
 def ws_leave_lobby(data):
-    chat_id = data.get('chat_id')
+    chat_id = request_chat_id(data.get('chat_id'))
     if not chat_id:
         return
     lobby_entry = Lobby.query.filter_by(chat_id=chat_id, is_active=True).first()
     if lobby_entry:
         lobby_entry.is_active = False
         db.session.commit()
-    emit_lobby_update()
+        move_user_sockets_to_lobby(chat_id, None, lobby_entry.user_id)
+        emit_lobby_delta(lobby_entry.lobby_id, removed=[lobby_entry.chat_id])
+
+@socketio.on('sync_lobby_room')
+def ws_sync_lobby_room(data=None):
+    """Ставит этот сокет в комнату его активного лобби по БД и шлёт снимок состава"""
+    chat_id = socket_users.get(request.sid)
+    if not chat_id:
+        return
+    entry = Lobby.query.filter_by(chat_id=chat_id, is_active=True).first()
+    lobby_id = entry.lobby_id if entry else None
+    move_socket_to_lobby(request.sid, lobby_id)
+    if lobby_id:
+        emit('lobby_update', lobby_update_payload(lobby_id))
 
 @socketio.on('request_lobby')
-def ws_request_lobby():
-    emit_lobby_update()
+def ws_request_lobby(data=None):
+    lobby_id = (data or {}).get('lobby_id')
+    if not lobby_id:
+        chat_id = socket_users.get(request.sid)
+        entry = Lobby.query.filter_by(chat_id=chat_id, is_active=True).first() if chat_id else None
+        lobby_id = entry.lobby_id if entry else None
+    if lobby_id:
+        emit('lobby_update', lobby_update_payload(lobby_id))
+
+@socketio.on('join_admin')
+def ws_join_admin(data):
+    chat_id = request_chat_id((data or {}).get('chat_id'))
+    user = request_user(chat_id) if chat_id else None
+    if not user or not user.is_admin:
+        return
+    register_user_socket(request.sid, str(chat_id), user.user_id)
+    join_room(ADMIN_ROOM)
+    lobby_list = admin_lobby_summaries()
+    emit('admin_lobby_update', {
+        'lobbies': lobby_list,
+        'total_count': len(lobby_list)
+    })
 
 @socketio.on('request_timer')
-def ws_request_timer():
-    emit('timer_update', {'time': lobby_timer})
+def ws_request_timer(data=None):
+    game_session_id = (data or {}).get('game_session_id')
+    runner = game_runners.get(game_session_id) if game_session_id else None
+    if runner and runner.phase in runner.TIMER_EVENTS:
+        with runner.lock:
+            event = runner.TIMER_EVENTS[runner.phase]
+            payload = runner.timer_payload()
+        emit(f'{event}_update', payload)
+        return
+    lobby_id = (data or {}).get('lobby_id')
+    if not lobby_id:
+        chat_id = socket_users.get(request.sid)
+        entry = Lobby.query.filter_by(chat_id=chat_id, is_active=True).first() if chat_id else None
+        lobby_id = entry.lobby_id if entry else None
+    emit('timer_update', lobby_timer_payload(lobby_id))
 
 @socketio.on('start_game')
 def ws_start_game(data):
@@ -805,388 +1602,672 @@ def ws_start_game(data):
         'game_session': game_session_data
     }), 200
 
-def emit_lobby_update():
+def lobby_update_payload(lobby_id):
+    # Версию берём до запроса: дельты после неё применяются к снимку повторно без вреда
+    version = lobby_versions.get(lobby_id, 0)
+    # Администраторы тоже в составе: клиент отфильтровывает их по is_admin
+    players = list_lobby_players(lobby_id, include_admins=True)
+    return {'lobby_id': lobby_id, 'version': version, 'players': players, 'count': len(players)}
+
+def emit_lobby_delta(lobby_id, added=(), removed=(), changed=()):
+    """Рассылает изменения состава лобби (строки Lobby и chat_id ушедших) с новой версией.
+
+    Версии живут в процессе: с несколькими воркерами они бы совпадали у разных
+    воркеров, поэтому вместо дельты рассылается полный снимок.
+    """
+    if MULTI_WORKER:
+        emit_lobby_update(lobby_id)
+        schedule_admin_lobby_update()
+        return
+    with lobby_versions_lock:
+        version = lobby_versions.get(lobby_id, 0) + 1
+        lobby_versions[lobby_id] = version
+    bump_data_version('lobby', lobby_id)
+    emit_to_lobby('lobby_delta', {
+        'lobby_id': lobby_id,
+        'version': version,
+        'added': lobby_delta_players(lobby_id, added),
+        'removed': list(removed),
+        'changed': lobby_delta_players(lobby_id, changed)
+    }, lobby_id)
+    schedule_admin_lobby_update()
+
+def emit_lobby_update(lobby_id):
+    bump_data_version('lobby', lobby_id)
     try:
-        active_players = Lobby.query.filter_by(is_active=True).order_by(Lobby.joined_at.asc()).all()
-        players = [player.to_dict() for player in active_players]
-        socketio.emit('lobby_update', {'players': players, 'count': len(players)})
+        emit_to_lobby('lobby_update', lobby_update_payload(lobby_id), lobby_id)
     except Exception as e:
         pass
 
+def bump_data_version(kind, lobby_id=None):
+    """Сдвигает версию состава лобби (kind='lobby') или его игры (kind='game') и общую версию вида.
+
+    Без lobby_id сдвигаются все версии вида — для массовых удалений.
+    """
+    with data_versions_lock:
+        if lobby_id is None:
+            keys = [key for key in data_versions if key[0] == kind] or [(kind, None)]
+        else:
+            keys = [(kind, lobby_id), (kind, None)]
+        for key in keys:
+            data_versions[key] = data_versions.get(key, 0) + 1
+
+def data_etag(*keys, extra=None):
+    with data_versions_lock:
+        parts = [str(data_versions.get(key, 0)) for key in keys]
+    if extra is not None:
+        parts.append(hashlib.sha1(str(extra).encode()).hexdigest()[:12])
+    return f'{DATA_VERSION_EPOCH}-{"-".join(parts)}'
+
+def conditional_response(etag, build):
+    """304 без запросов к БД и сериализации, если клиент прислал тот же ETag.
+
+    ETag считается до build(): мутация во время сборки лишь сдвинет версию.
+    Версии живут в процессе, поэтому с несколькими воркерами 304 не отдаётся.
+    """
+    if MULTI_WORKER:
+        return build()
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = make_response(build())
+        if response.status_code != 200:
+            return response
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def admin_lobby_summaries():
+    """Сводка по всем лобби одним сгруппированным запросом плюс живое состояние игр"""
+    # Считаем только не-администраторов
+    is_player = db.and_(Lobby.is_active == True, User.is_admin == False)
+    rows = db.session.query(
+        Lobby.lobby_id,
+        db.func.sum(db.case((is_player, 1), else_=0)),
+        db.func.sum(db.case((db.and_(is_player, Lobby.is_ready == True), 1), else_=0)),
+        GameSession.id,
+        GameSession.status,
+        GameSession.current_round,
+        GameSession.total_rounds,
+        GameSession.initial_bank
+    ).outerjoin(
+        User, Lobby.chat_id == User.chat_id
+    ).outerjoin(
+        GameSession, db.and_(GameSession.lobby_id == Lobby.lobby_id, GameSession.archived == False)
+    ).group_by(
+        Lobby.lobby_id, GameSession.id, GameSession.status, GameSession.current_round,
+        GameSession.total_rounds, GameSession.initial_bank
+    ).order_by(Lobby.lobby_id).all()
+
+    live_games = {runner.lobby_id: runner.state for runner in list(game_runners.values()) if runner.state}
+
+    lobby_list = []
+    for lobby_id, player_count, ready_count, game_session_id, status, current_round, total_rounds, initial_bank in rows:
+        state = live_games.get(lobby_id)
+        if state:
+            game_session_id = state.id
+            status = state.status
+            current_round = state.current_round
+            total_rounds = state.total_rounds
+            initial_bank = state.initial_bank
+        status = status or 'waiting'
+        lobby_list.append({
+            'lobby_id': lobby_id,
+            'player_count': int(player_count or 0),
+            'ready_count': int(ready_count or 0),
+            'status': status,
+            'game_session_id': game_session_id,
+            'current_round': current_round,
+            'total_rounds': total_rounds,
+            # До старта банк — взносы готовых игроков
+            'bank': initial_bank if status != 'waiting' else int(ready_count or 0)
+        })
+    return lobby_list
+
 def emit_admin_lobby_update():
+    global admin_lobby_update_timer
+    admin_lobby_update_timer = None
     try:
-        lobbies = db.session.query(Lobby.lobby_id).distinct().all()
-        lobby_list = []
+        with app.app_context(), sql_profiler.profile('timer', 'admin_lobby_update'):
+            lobby_list = admin_lobby_summaries()
+        socketio.emit('admin_lobby_update', {
+            'lobbies': lobby_list,
+            'total_count': len(lobby_list)
+        }, to=ADMIN_ROOM)
+    except Exception as e:
+        log.error("Error in emit_admin_lobby_update: %s", e)
+
+def schedule_admin_lobby_update():
+    """Сводка админам не чаще раза в ADMIN_UPDATE_DELAY секунд"""
+    global admin_lobby_update_timer
+    if admin_lobby_update_timer is None:
+        admin_lobby_update_timer = scheduler.schedule(ADMIN_UPDATE_DELAY, emit_admin_lobby_update, name='admin lobby update')
+
+class GameSessionRunner:
+    """Таймеры и фаза одной игровой сессии"""
+
+    # Фаза -> префикс событий таймера
+    TIMER_EVENTS = {'round': 'game_timer', 'choice': 'choice_timer'}
+
+    def __init__(self, game_session_id, lobby_id=None):
+        self.game_session_id = game_session_id
+        self.lobby_id = lobby_id
+        self.lock = threading.Lock()
+        self.phase = 'idle'
+        self.round_number = None
+        self.countdown = None
+        self.active_players = []
+        self.state = None
+
+    def log_fields(self):
+        return log_fields(lobby_id=self.lobby_id, game_session_id=self.game_session_id,
+                          round_number=self.round_number)
+
+    def timer_payload(self):
+        payload = self.countdown.payload() if self.countdown else {'time': 0}
+        payload['game_session_id'] = self.game_session_id
+        payload['round_number'] = self.round_number
+        return payload
+
+    def start_round(self, round_number):
+        self._start_countdown('round', round_number, ROUND_TIME)
+
+    def start_choice(self, round_number, active_players):
+        self._start_countdown('choice', round_number, CHOICE_TIME, active_players)
+
+    def _start_countdown(self, phase, round_number, duration, active_players=None):
+        with self.lock:
+            if self.countdown:
+                self.countdown.cancel()
+            self.phase = phase
+            self.round_number = round_number
+            if active_players is not None:
+                self.active_players = active_players
+            self.countdown = Countdown(
+                duration, self._countdown_finished, self._countdown_resync, TIMER_RESYNC_INTERVAL,
+                name=f'session {self.game_session_id} {phase} {round_number}'
+            )
+            payload = self.timer_payload()
+            log.info("%s timer set to %s seconds", phase.capitalize(), duration, extra=self.log_fields())
 
-        for (lobby_id,) in lobbies:
-            # Считаем только не-администраторов
-            active_players = Lobby.query.filter_by(
-                lobby_id=lobby_id,
-                is_active=True
-            ).join(User, Lobby.chat_id == User.chat_id).filter(User.is_admin == False).count()
+        emit_to_lobby(f'{self.TIMER_EVENTS[phase]}_start', payload, self.lobby_id)
 
-            game_session = GameSession.query.filter_by(lobby_id=lobby_id).first()
-            status = game_session.status if game_session else 'waiting'
+    def _countdown_resync(self, countdown):
+        with self.lock:
+            if countdown is not self.countdown:
+                return
+            event = self.TIMER_EVENTS[self.phase]
+            payload = self.timer_payload()
+        emit_to_lobby(f'{event}_update', payload, self.lobby_id)
 
-            lobby_list.append({
-                'lobby_id': lobby_id,
-                'player_count': active_players,
-                'status': status
-            })
+    def _countdown_finished(self, countdown):
+        with self.lock:
+            if countdown is not self.countdown:
+                return
+            phase = self.phase
+            round_number = self.round_number
+            active_players = self.active_players
+            self.phase = f'{phase}_finished'
+            payload = self.timer_payload()
+        game_timer_lateness.observe(max(0.0, countdown.scheduler.clock() - countdown.deadline), phase)
+
+        emit_to_lobby(f'{self.TIMER_EVENTS[phase]}_finished', payload, self.lobby_id)
+
+        with app.app_context(), sql_profiler.profile('timer', f'{phase}_finished'):
+            if phase == 'round':
+                log.debug("Round timer finished", extra=self.log_fields())
+                finish_round(self.game_session_id, round_number)
+            else:
+                log.debug("Choice timer finished", extra=self.log_fields())
+                finish_choice_phase(self.game_session_id, round_number, active_players)
+
+    def stop(self, notify=True):
+        with self.lock:
+            phase = self.phase
+            cancelled = self.countdown.cancel() if self.countdown else False
+            self.phase = 'finished'
+            payload = self.timer_payload()
+        if cancelled and notify:
+            emit_to_lobby(f'{self.TIMER_EVENTS[phase]}_cancel', payload, self.lobby_id)
+
+def get_game_runner(game_session_id, lobby_id=None):
+    """Возвращает раннер сессии, создавая его при необходимости"""
+    with game_runners_lock:
+        runner = game_runners.get(game_session_id)
+        if runner is None:
+            runner = GameSessionRunner(game_session_id, lobby_id)
+            game_runners[game_session_id] = runner
+        elif lobby_id and not runner.lobby_id:
+            runner.lobby_id = lobby_id
+        return runner
+
+def get_game_state(game_session_id):
+    runner = game_runners.get(game_session_id)
+    return runner.state if runner else None
+
+def find_game_runner(lobby_id):
+    for runner in list(game_runners.values()):
+        if runner.lobby_id == lobby_id and runner.state:
+            return runner
+    return None
+
+def stop_game_runner(game_session_id):
+    """Останавливает таймеры сессии и убирает раннер из реестра"""
+    with game_runners_lock:
+        runner = game_runners.pop(game_session_id, None)
+    if runner:
+        runner.stop()
+        log.info("Game runner stopped", extra=runner.log_fields())
+    # Игру могут остановить и с чужого воркера: снимаем аренду любого владельца,
+    # владелец увидит это при продлении и остановит свои таймеры
+    release_game_lease(game_session_id, force=True)
+
+def release_game_runner(runner):
+    """Убирает раннер завершённой игры после записи её итогов в БД"""
+    with game_runners_lock:
+        if game_runners.get(runner.game_session_id) is runner:
+            game_runners.pop(runner.game_session_id)
+    release_game_lease(runner.game_session_id)
+
+def finish_game_runner(game_session_id, ops):
+    """Останавливает таймеры и записывает итог игры; состояние живёт до конца записи,
+    при сбое записи раннер остаётся в реестре до успешной повторной"""
+    schedule_admin_lobby_update()
+    runner = game_runners.get(game_session_id)
+    if runner:
+        runner.stop()
+    if runner and runner.state:
+        runner.state.persist(ops, callback=lambda: release_game_runner(runner))
+    else:
+        game_persister.submit(ops, key=game_session_id)
+
+def acquire_game_lease(game_session_id):
+    """Берёт аренду игры или продлевает свою; True, если таймеры игры ведёт этот воркер.
+
+    Чужая аренда перехватывается только после истечения срока. Без MULTI_WORKER
+    аренды не ведутся: все игры принадлежат единственному процессу.
+    """
+    if not MULTI_WORKER:
+        return True
+    now = datetime.utcnow()
+    leases = GameLease.__table__
+    values = {'owner': WORKER_ID, 'expires_at': now + timedelta(seconds=GAME_LEASE_TTL)}
+    try:
+        taken = db.session.execute(
+            leases.update()
+            .where(leases.c.game_session_id == game_session_id)
+            .where(db.or_(leases.c.owner == WORKER_ID, leases.c.expires_at < now))
+            .values(**values)
+        ).rowcount
+        if not taken:
+            # Строки нет совсем или её держит живой владелец — тогда вставка упадёт
+            db.session.execute(leases.insert().values(game_session_id=game_session_id, **values))
+        db.session.commit()
+        return True
+    except IntegrityError:
+        db.session.rollback()
+        return False
 
-        socketio.emit('admin_lobby_update', {
-            'lobbies': lobby_list,
-            'total_count': len(lobby_list)
-        })
+def release_game_lease(game_session_id, force=False):
+    if not MULTI_WORKER:
+        return
+    try:
+        with app.app_context():
+            leases = GameLease.query.filter_by(game_session_id=game_session_id)
+            if not force:
+                leases = leases.filter_by(owner=WORKER_ID)
+            leases.delete()
+            db.session.commit()
+    except Exception as e:
+        log.error("Error releasing game lease: %s", e, extra=log_fields(game_session_id=game_session_id))
+
+def renew_game_leases():
+    """Продлевает аренды своих игр одним UPDATE; игры с перехваченной арендой останавливает"""
+    owned = {sid for sid, runner in list(game_runners.items())
+             if runner.state and runner.state.status == 'playing'}
+    if not owned:
+        return
+    leases = GameLease.__table__
+    renewed = set(db.session.execute(
+        leases.update()
+        .where(leases.c.owner == WORKER_ID)
+        .where(leases.c.game_session_id.in_(owned))
+        .values(expires_at=datetime.utcnow() + timedelta(seconds=GAME_LEASE_TTL))
+        .returning(leases.c.game_session_id)
+    ).scalars())
+    db.session.commit()
+    lost = owned - renewed
+    if not lost:
+        return
+    taken = set(db.session.scalars(
+        db.select(GameLease.game_session_id).where(GameLease.game_session_id.in_(lost))
+    ))
+    for game_session_id in lost:
+        with game_runners_lock:
+            runner = game_runners.pop(game_session_id, None)
+        if runner:
+            # Перехваченная игра уже идёт у нового владельца — клиентам ничего не шлём;
+            # снятая аренда значит, что игру остановили на другом воркере
+            runner.stop(notify=game_session_id not in taken)
+        log.warning("Lost game lease, runner stopped", extra=log_fields(game_session_id=game_session_id))
+
+def adopt_orphan_games():
+    """Подхватывает идущие игры, чей владелец перестал продлевать аренду"""
+    now = datetime.utcnow()
+    orphans = db.session.query(GameSession.id).outerjoin(
+        GameLease, GameLease.game_session_id == GameSession.id
+    ).filter(
+        GameSession.status == 'playing',
+        db.or_(
+            GameLease.expires_at < now,
+            # Игра без аренды: создатель мог упасть между коммитом сессии и арендой
+            db.and_(GameLease.game_session_id.is_(None),
+                    GameSession.started_at < now - timedelta(seconds=GAME_LEASE_TTL))
+        )
+    ).all()
+    for (game_session_id,) in orphans:
+        if game_session_id not in game_runners and acquire_game_lease(game_session_id):
+            resume_game(game_session_id)
+
+def resume_game(game_session_id):
+    """Поднимает брошенную игру из БД и продолжает её с прерванной фазы.
+
+    Записанный раунд уже разыгран: игра продолжается фазой выбора этого раунда
+    с сохранёнными выборами, иначе раунд запускается заново.
+    """
+    state = load_game_state(game_session_id)
+    if not state:
+        release_game_lease(game_session_id)
+        return
+    round_number = state.current_round
+    drawn = db.session.query(GameRound.id).filter_by(
+        game_session_id=game_session_id, round_number=round_number
+    ).first() is not None
+    log.warning("Worker %s resumed orphaned game, round %s", WORKER_ID,
+                'drawn' if drawn else 'restarted', extra=state.log_fields(round_number))
+    emit_to_lobby('player_status_update', {'statuses': state.statuses()}, state.lobby_id)
+    if drawn:
+        sync_remote_choices(state, round_number)
+        continue_after_draw(game_session_id, round_number, state.active_players())
+    else:
+        start_round_timer(game_session_id, round_number)
+
+def game_lease_tick():
+    try:
+        with app.app_context(), sql_profiler.profile('timer', 'game_leases'):
+            renew_game_leases()
+            adopt_orphan_games()
     except Exception as e:
-        print(f"Error in emit_admin_lobby_update: {e}")
+        log.exception("Error in game lease tick")
+    finally:
+        scheduler.schedule(GAME_LEASE_TTL / 3, game_lease_tick, name='game leases')
 
 def start_game_timer(game_session_id_param):
-    global game_timer, game_timer_running, game_session_id
-    print(f"=== STARTING GAME TIMER (NEW ROUND SYSTEM) ===", file=sys.stderr)
-    print(f"Session ID: {game_session_id_param}", file=sys.stderr)
+    log.info("Starting game timer", extra=log_fields(game_session_id=game_session_id_param))
 
     try:
-        with app.app_context():
-            game_session = GameSession.query.get(game_session_id_param)
-            if not game_session:
-                print("Game session not found", file=sys.stderr)
-                return
+        state = get_game_state(game_session_id_param)
+        if not state:
+            log.warning("Game session not found", extra=log_fields(game_session_id=game_session_id_param))
+            return
 
-            start_round_timer(game_session_id_param, game_session.current_round)
+        start_round_timer(game_session_id_param, state.current_round)
 
     except Exception as e:
-        print(f"Error in start_game_timer: {str(e)}", file=sys.stderr)
-        print(f"Full traceback: {traceback.format_exc()}", file=sys.stderr)
+        log.exception("Error in start_game_timer", extra=log_fields(game_session_id=game_session_id_param))
         raise
 
 def start_round_timer(game_session_id_param, round_number):
-    global game_timer, game_timer_running, game_session_id
-    print(f"=== STARTING ROUND {round_number} TIMER ===", file=sys.stderr)
+    log.info("Starting round timer", extra=log_fields(game_session_id=game_session_id_param, round_number=round_number))
 
     try:
-        with game_timer_lock:
-            game_timer = 15  # 15 секунд на раунд
-            game_timer_running = True
-            game_session_id = game_session_id_param
-            print(f"Round {round_number} timer set to {game_timer} seconds", file=sys.stderr)
-
-        socketio.emit('game_timer_start', {
-            'time': game_timer,
-            'game_session_id': game_session_id,
-            'round_number': round_number
-        })
-        print(f"Round {round_number} timer start command emitted to all players", file=sys.stderr)
-
-        def timer_thread():
-            global game_timer, game_timer_running
-            print(f"Round {round_number} timer thread started", file=sys.stderr)
-            while True:
-                eventlet.sleep(1)
-                with game_timer_lock:
-                    if game_timer_running and game_timer > 0:
-                        game_timer -= 1
-                        socketio.emit('game_timer_update', {
-                            'time': game_timer,
-                            'game_session_id': game_session_id,
-                            'round_number': round_number
-                        })
-                        print(f"Round {round_number} timer: {game_timer} seconds left", file=sys.stderr)
-                    if game_timer == 0:
-                        game_timer_running = False
-                        print(f"=== ROUND {round_number} TIMER FINISHED ===", file=sys.stderr)
-                        finish_round(game_session_id, round_number)
-                        break
-        eventlet.spawn(timer_thread)
-        print(f"Round {round_number} timer thread spawned successfully", file=sys.stderr)
+        runner = get_game_runner(game_session_id_param)
+        if runner.state:
+            runner.state.round_started_at[round_number] = datetime.utcnow()
+        runner.start_round(round_number)
 
     except Exception as e:
-        print(f"Error in start_round_timer: {str(e)}", file=sys.stderr)
-        print(f"Full traceback: {traceback.format_exc()}", file=sys.stderr)
+        log.exception("Error in start_round_timer", extra=log_fields(game_session_id=game_session_id_param, round_number=round_number))
         raise
 
 def finish_round(game_session_id_param, round_number):
     try:
-        with app.app_context():
-            print(f"=== FINISHING ROUND {round_number} ===", file=sys.stderr)
+        log.debug("Finishing round", extra=log_fields(game_session_id=game_session_id_param, round_number=round_number))
 
-            remaining_players = eliminate_players_in_round(game_session_id_param, round_number)
+        state = get_game_state(game_session_id_param)
+        if not state:
+            log.warning("Game session not found", extra=log_fields(game_session_id=game_session_id_param))
+            return
 
-            eliminated_players = PlayerGameStatus.query.filter_by(
-                game_session_id=game_session_id_param,
-                eliminated_in_round=round_number
-            ).all()
+        if MULTI_WORKER:
+            sync_remote_quits(state)
 
-            print(f"Eliminated players from database: {[p.user_id for p in eliminated_players]}", file=sys.stderr)
+        # Состав жеребьёвки пишется в раунд: по статусам не видно, кто вышел до неё, а кто после
+        candidates = sorted(p.user_id for p in state.active_players())
+        remaining_players, eliminated_ids = eliminate_players_in_round(game_session_id_param, round_number)
 
-            statuses = PlayerGameStatus.query.filter_by(game_session_id=game_session_id_param).all()
-            socketio.emit('player_status_update', {
-                'statuses': [s.to_dict() for s in statuses]
+        state.persist([
+            ('eliminate', state.id, round_number, eliminated_ids),
+            ('round', {
+                'game_session_id': state.id,
+                'round_number': round_number,
+                'started_at': state.round_started_at.get(round_number, datetime.utcnow()),
+                'ended_at': datetime.utcnow(),
+                'eliminated_players': json.dumps(eliminated_ids),
+                'bank': state.initial_bank,
+                'candidates': json.dumps(candidates)
             })
-            print(f"Player status update sent after round {round_number}", file=sys.stderr)
+        ])
 
-            game_session = GameSession.query.get(game_session_id_param)
-            if not game_session:
-                print("Game session not found", file=sys.stderr)
-                return
+        emit_to_lobby('player_status_update', {
+            'statuses': state.statuses()
+        }, state.lobby_id)
+        push_my_status(state, [state.players[user_id] for user_id in eliminated_ids])
+        log.debug("Player status update sent after round", extra=state.log_fields(round_number))
 
-            if not remaining_players or len(remaining_players) == 0:
-                if len(active_players) > 0:
-                    winner_statuses = PlayerGameStatus.query.filter(
-                        PlayerGameStatus.game_session_id == game_session_id_param,
-                        PlayerGameStatus.user_id.in_([p.user_id for p in active_players])
-                    ).all()
-                    finish_game_with_split_bank(game_session_id_param, winner_statuses)
-                else:
-                    finish_game_without_winner(game_session_id_param)
-            elif len(remaining_players) == 1:
-                winner = remaining_players[0]
-                finish_game_with_winner(game_session_id_param, winner.user_id)
-            else:
-                start_choice_phase(game_session_id_param, round_number, remaining_players)
+        continue_after_draw(game_session_id_param, round_number, remaining_players)
 
     except Exception as e:
-        print(f"Error in finish_round: {str(e)}", file=sys.stderr)
-        print(f"Full traceback: {traceback.format_exc()}", file=sys.stderr)
+        log.exception("Error in finish_round", extra=log_fields(game_session_id=game_session_id_param, round_number=round_number))
         raise
 
+def continue_after_draw(game_session_id_param, round_number, remaining_players):
+    """После жеребьёвки: конец игры или фаза выбора для оставшихся"""
+    if not remaining_players:
+        finish_game_without_winner(game_session_id_param)
+    elif len(remaining_players) == 1:
+        winner = remaining_players[0]
+        finish_game_with_winner(game_session_id_param, winner.user_id)
+    else:
+        start_choice_phase(game_session_id_param, round_number, remaining_players)
+
 def start_choice_phase(game_session_id_param, round_number, active_players):
     try:
-        print(f"=== STARTING CHOICE PHASE FOR ROUND {round_number} ===", file=sys.stderr)
-        print(f"Active players: {len(active_players)}", file=sys.stderr)
+        log.info("Starting choice phase, %s active players", len(active_players),
+                 extra=log_fields(game_session_id=game_session_id_param, round_number=round_number))
 
         choice_data = {
             'game_session_id': game_session_id_param,
             'round_number': round_number,
             'active_players': [p.user_id for p in active_players],
-            'choice_timeout': 10  # 10 секунд на выбор
+            'choice_timeout': CHOICE_TIME
         }
 
-        socketio.emit('choice_phase_started', choice_data)
-        print("Choice phase started event sent", file=sys.stderr)
+        emit_to_lobby('choice_phase_started', choice_data, game_lobby_id(game_session_id_param))
 
         start_choice_timer(game_session_id_param, round_number, active_players)
 
     except Exception as e:
-        print(f"Error in start_choice_phase: {str(e)}", file=sys.stderr)
-        print(f"Full traceback: {traceback.format_exc()}", file=sys.stderr)
+        log.exception("Error in start_choice_phase", extra=log_fields(game_session_id=game_session_id_param, round_number=round_number))
         raise
 
 def start_choice_timer(game_session_id_param, round_number, active_players):
-    global choice_timer, choice_timer_running, choice_session_id
-
     try:
-        with choice_timer_lock:
-            choice_timer = 10  # 10 секунд на выбор
-            choice_timer_running = True
-            choice_session_id = game_session_id_param
-            print(f"Choice timer set to {choice_timer} seconds", file=sys.stderr)
-
-        socketio.emit('choice_timer_start', {
-            'time': choice_timer,
-            'game_session_id': game_session_id_param,
-            'round_number': round_number
-        })
-
-        def choice_timer_thread():
-            global choice_timer, choice_timer_running
-            print("Choice timer thread started", file=sys.stderr)
-            while True:
-                eventlet.sleep(1)
-                with choice_timer_lock:
-                    if choice_timer_running and choice_timer > 0:
-                        choice_timer -= 1
-                        socketio.emit('choice_timer_update', {
-                            'time': choice_timer,
-                            'game_session_id': game_session_id_param,
-                            'round_number': round_number
-                        })
-                        print(f"Choice timer: {choice_timer} seconds left", file=sys.stderr)
-                    if choice_timer == 0:
-                        choice_timer_running = False
-                        print("=== CHOICE TIMER FINISHED ===", file=sys.stderr)
-                        finish_choice_phase(game_session_id_param, round_number, active_players)
-                        break
-        eventlet.spawn(choice_timer_thread)
-        print("Choice timer thread spawned successfully", file=sys.stderr)
+        get_game_runner(game_session_id_param).start_choice(round_number, active_players)
 
     except Exception as e:
-        print(f"Error in start_choice_timer: {str(e)}", file=sys.stderr)
-        print(f"Full traceback: {traceback.format_exc()}", file=sys.stderr)
+        log.exception("Error in start_choice_timer", extra=log_fields(game_session_id=game_session_id_param, round_number=round_number))
         raise
 
+def split_by_choice(active_players, choices):
+    """Делит активных игроков по выбору раунда: (остаются, выходят); не выбравшие не попадают никуда"""
+    staying_players = []
+    quitting_players = []
+    for player_status in active_players:
+        choice = choices.get(player_status.user_id)
+        if choice == 'stay':
+            staying_players.append(player_status)
+        elif choice == 'leave':
+            quitting_players.append(player_status)
+    return staying_players, quitting_players
+
 def finish_choice_phase(game_session_id_param, round_number, active_players):
     try:
-        with app.app_context():
-            print(f"=== FINISHING CHOICE PHASE FOR ROUND {round_number} ===", file=sys.stderr)
-            choices = PlayerChoice.query.filter_by(
-                game_session_id=game_session_id_param,
-                round_number=round_number
-            ).all()
-            staying_players = []
-            leave_votes = 0
-            for player_status in active_players:
-                choice = next((c for c in choices if c.user_id == player_status.user_id), None)
-                if choice and choice.choice == 'stay':
-                    staying_players.append(player_status)
-                elif choice and choice.choice == 'leave':
-                    leave_votes += 1
-                    player_status.status = 'quit'
-                    player_status.quit_in_round = round_number
-                    db.session.commit()
-                    print(f"Player {player_status.user_id} quit in round {round_number}", file=sys.stderr)
-            statuses = PlayerGameStatus.query.filter_by(game_session_id=game_session_id_param).all()
-            socketio.emit('player_status_update', {
-                'statuses': [s.to_dict() for s in statuses]
-            })
-            print(f"Player status update sent after choice phase {round_number}", file=sys.stderr)
-            if len(staying_players) == 0:
-                if len(active_players) > 0:
-                    winner_statuses = PlayerGameStatus.query.filter(
-                        PlayerGameStatus.game_session_id == game_session_id_param,
-                        PlayerGameStatus.user_id.in_([p.user_id for p in active_players])
-                    ).all()
-                    finish_game_with_split_bank(game_session_id_param, winner_statuses)
-                else:
-                    finish_game_without_winner(game_session_id_param)
-            elif len(staying_players) == 1:
-                winner = staying_players[0]
-                finish_game_with_winner(game_session_id_param, winner.user_id)
+        log.debug("Finishing choice phase", extra=log_fields(game_session_id=game_session_id_param, round_number=round_number))
+        state = get_game_state(game_session_id_param)
+        if not state:
+            log.warning("Game session not found", extra=log_fields(game_session_id=game_session_id_param))
+            return
+        if MULTI_WORKER:
+            quitters = sync_remote_quits(state)
+            sync_remote_choices(state, round_number)
+            active_players = [p for p in active_players if p not in quitters]
+        choices = state.choices.get(round_number, {})
+        staying_players, quitting_players = split_by_choice(active_players, choices)
+        for player_status in quitting_players:
+            player_status.status = 'quit'
+            player_status.quit_in_round = round_number
+            log.debug("Player %s quit", player_status.user_id, extra=state.log_fields(round_number))
+        leave_votes = len(quitting_players)
+        state.persist([
+            state.choices_op(round_number),
+            state.players_op(quitting_players),
+            ('round_update', state.id, round_number, {'players_choice': json.dumps(choices)})
+        ])
+        emit_to_lobby('player_status_update', {
+            'statuses': state.statuses()
+        }, state.lobby_id)
+        push_my_status(state, quitting_players)
+        log.info("Choice phase finished: %s stay, %s leave", len(staying_players), leave_votes,
+                 extra=state.log_fields(round_number))
+        if len(staying_players) == 0:
+            if len(active_players) > 0:
+                finish_game_with_split_bank(game_session_id_param, active_players)
             else:
-                total_votes = len(staying_players) + leave_votes
-                if leave_votes >= math.ceil(total_votes / 2):
-                    winner_statuses = PlayerGameStatus.query.filter(
-                        PlayerGameStatus.game_session_id == game_session_id_param,
-                        PlayerGameStatus.user_id.in_([p.user_id for p in staying_players])
-                    ).all()
-                    finish_game_with_split_bank(game_session_id_param, winner_statuses)
-                else:
-                    start_next_round(game_session_id_param, round_number, staying_players)
+                finish_game_without_winner(game_session_id_param)
+        elif len(staying_players) == 1:
+            winner = staying_players[0]
+            finish_game_with_winner(game_session_id_param, winner.user_id)
+        else:
+            total_votes = len(staying_players) + leave_votes
+            if leave_votes >= math.ceil(total_votes / 2):
+                finish_game_with_split_bank(game_session_id_param, staying_players)
+            else:
+                start_next_round(game_session_id_param, round_number, staying_players)
     except Exception as e:
-        print(f"Error in finish_choice_phase: {str(e)}", file=sys.stderr)
-        print(f"Full traceback: {traceback.format_exc()}", file=sys.stderr)
+        log.exception("Error in finish_choice_phase", extra=log_fields(game_session_id=game_session_id_param, round_number=round_number))
         raise
 
 def start_next_round(game_session_id_param, current_round, active_players):
     try:
-        with app.app_context():
-            next_round = current_round + 1
-            print(f"=== STARTING NEXT ROUND {next_round} ===", file=sys.stderr)
-
-            game_session = GameSession.query.get(game_session_id_param)
-            if game_session:
-                game_session.current_round = next_round
-                db.session.commit()
-
-                round_update_data = {
-                    'game_session_id': game_session_id_param,
-                    'current_round': next_round,
-                    'total_rounds': game_session.total_rounds,
-                    'active_players': [p.user_id for p in active_players]
-                }
-                socketio.emit('round_updated', round_update_data)
-                print(f"Round updated event sent: round {next_round}", file=sys.stderr)
+        next_round = current_round + 1
+        log.debug("Starting next round", extra=log_fields(game_session_id=game_session_id_param, round_number=next_round))
+
+        state = get_game_state(game_session_id_param)
+        if state:
+            state.current_round = next_round
+            state.persist([state.session_op()])
+
+            round_update_data = {
+                'game_session_id': game_session_id_param,
+                'current_round': next_round,
+                'total_rounds': state.total_rounds,
+                'active_players': [p.user_id for p in active_players]
+            }
+            emit_to_lobby('round_updated', round_update_data, state.lobby_id)
 
-            start_round_timer(game_session_id_param, next_round)
+        start_round_timer(game_session_id_param, next_round)
 
     except Exception as e:
-        print(f"Error in start_next_round: {str(e)}", file=sys.stderr)
-        print(f"Full traceback: {traceback.format_exc()}", file=sys.stderr)
+        log.exception("Error in start_next_round", extra=log_fields(game_session_id=game_session_id_param, round_number=current_round + 1))
         raise
 
 def finish_game_with_winner(game_session_id_param, winner_id):
     try:
-        with app.app_context():
-            print(f"=== GAME FINISHED WITH WINNER: {winner_id} ===", file=sys.stderr)
-
-            game_session = GameSession.query.get(game_session_id_param)
-            if not game_session:
-                print("Game session not found", file=sys.stderr)
-                return
-
-            winner_status = PlayerGameStatus.query.filter_by(
-                game_session_id=game_session_id_param,
-                user_id=winner_id
-            ).first()
 
-            if winner_status:
-                winner_status.status = 'winner'
-                user = User.query.filter_by(user_id=winner_id).first()
-                if user:
-                    coins = game_session.initial_bank
-                    user.balance += coins
-                    winner_status.total_coins_earned = coins
-                db.session.commit()
-
-            game_session.status = 'finished'
-            game_session.finished_at = datetime.utcnow()
-            game_session.winner_id = winner_id
-            db.session.commit()
-
-            all_player_statuses = PlayerGameStatus.query.filter_by(
-                game_session_id=game_session_id_param
-            ).all()
+        state = get_game_state(game_session_id_param)
+        if not state:
+            log.warning("Game session not found", extra=log_fields(game_session_id=game_session_id_param))
+            return
+
+        balances = {}
+        winner_status = state.players.get(winner_id)
+        if winner_status:
+            winner_status.status = 'winner'
+            coins = state.initial_bank
+            balances[winner_id] = coins
+            winner_status.total_coins_earned = coins
+
+        state.status = 'finished'
+        state.finished_at = datetime.utcnow()
+        state.winner_id = winner_id
+        finish_game_runner(game_session_id_param, [
+            state.players_op([winner_status] if winner_status else []),
+            ('balances', balances, 'win', state.id),
+            state.session_op()
+        ])
 
-            result_data = {
-                'winner_id': winner_id,
-                'game_session': game_session.to_dict(),
-                'player_statistics': [status.to_dict() for status in all_player_statuses],
-                'game_finished': True
-            }
+        result_data = {
+            'winner_id': winner_id,
+            'game_session': state.to_dict(),
+            'player_statistics': state.statuses(),
+            'game_finished': True
+        }
 
-            print("=== SENDING GAME RESULT TO ALL PLAYERS ===", file=sys.stderr)
-            socketio.emit('game_result', result_data)
-            socketio.emit('game_finished', {'winner_id': winner_id})
+        log.info("Game finished with winner %s", winner_id, extra=state.log_fields(state.current_round))
+        emit_to_lobby('game_result', result_data, state.lobby_id)
+        emit_to_lobby('game_finished', {'winner_id': winner_id}, state.lobby_id)
+        push_my_status(state, [winner_status] if winner_status else [])
 
-            emit_lobby_update()
-            print("Game result events sent successfully", file=sys.stderr)
+        emit_lobby_update(state.lobby_id)
 
     except Exception as e:
-        print(f"Error in finish_game_with_winner: {str(e)}", file=sys.stderr)
-        print(f"Full traceback: {traceback.format_exc()}", file=sys.stderr)
+        log.exception("Error in finish_game_with_winner", extra=log_fields(game_session_id=game_session_id_param))
         raise
 
 def finish_game_without_winner(game_session_id_param):
     try:
-        with app.app_context():
-            print(f"=== GAME FINISHED WITHOUT WINNER ===", file=sys.stderr)
-
-            game_session = GameSession.query.get(game_session_id_param)
-            if not game_session:
-                print("Game session not found", file=sys.stderr)
-                return
 
-            game_session.status = 'finished'
-            game_session.finished_at = datetime.utcnow()
-            db.session.commit()
-
-            all_player_statuses = PlayerGameStatus.query.filter_by(
-                game_session_id=game_session_id_param
-            ).all()
-            player_stats = [status.to_dict() for status in all_player_statuses] if all_player_statuses else []
-            result_data = {
-                'winner_id': None,
-                'game_session': game_session.to_dict(),
-                'player_statistics': player_stats,
-                'game_finished': True,
-                'no_winner': True
-            }
-            print("=== SENDING GAME RESULT (NO WINNER) TO ALL PLAYERS ===", file=sys.stderr)
-            socketio.emit('game_result', result_data)
-            socketio.emit('game_finished', {'winner_id': None, 'no_winner': True})
+        state = get_game_state(game_session_id_param)
+        if not state:
+            log.warning("Game session not found", extra=log_fields(game_session_id=game_session_id_param))
+            return
+
+        state.status = 'finished'
+        state.finished_at = datetime.utcnow()
+        finish_game_runner(game_session_id_param, [state.session_op()])
+
+        result_data = {
+            'winner_id': None,
+            'game_session': state.to_dict(),
+            'player_statistics': state.statuses(),
+            'game_finished': True,
+            'no_winner': True
+        }
+        log.info("Game finished without winner", extra=state.log_fields(state.current_round))
+        emit_to_lobby('game_result', result_data, state.lobby_id)
+        emit_to_lobby('game_finished', {'winner_id': None, 'no_winner': True}, state.lobby_id)
 
-            emit_lobby_update()
-            print("Game result events sent successfully", file=sys.stderr)
+        emit_lobby_update(state.lobby_id)
 
     except Exception as e:
-        print(f"Error in finish_game_without_winner: {str(e)}", file=sys.stderr)
-        print(f"Full traceback: {traceback.format_exc()}", file=sys.stderr)
+        log.exception("Error in finish_game_without_winner", extra=log_fields(game_session_id=game_session_id_param))
         raise
 
 @app.route('/api/game/choice', methods=['POST'])
 def make_player_choice():
     data = request.json
-    chat_id = data.get('chat_id')
+    chat_id = request_chat_id(data.get('chat_id'))
     game_session_id = data.get('game_session_id')
     round_number = data.get('round_number')
     choice = data.get('choice')
@@ -1194,127 +2275,235 @@ def make_player_choice():
     if not all([chat_id, game_session_id, round_number, choice]):
         return jsonify({'error': 'Missing required fields'}), 400
 
+    if choice not in PLAYER_CHOICES:
+        return jsonify({'error': 'Invalid choice'}), 400
+
     try:
-        user = User.query.filter_by(chat_id=chat_id).first()
+        user = request_user(chat_id)
         if not user:
             return jsonify({'error': 'User not found'}), 404
 
-        existing_choice = PlayerChoice.query.filter_by(
-            game_session_id=game_session_id,
-            round_number=round_number,
-            user_id=user.user_id
-        ).first()
-
-        if existing_choice:
+        # Выбор живёт в памяти раннера, в базу уходит пачкой при закрытии фазы
+        round_number = int(round_number)
+        runner = game_runners.get(int(game_session_id))
+        if not runner and MULTI_WORKER:
+            return record_remote_choice(int(game_session_id), round_number, user.user_id, choice)
+        # round_finished: choice_phase_started уже разослан, таймер выбора ещё стартует
+        if not runner or not runner.state or runner.phase not in ('round_finished', 'choice') \
+                or runner.round_number != round_number:
+            return jsonify({'error': 'Choice phase is not active'}), 400
+
+        player = runner.state.players.get(user.user_id)
+        if not player or player.status != 'active':
+            return jsonify({'error': 'Player is not active in this game'}), 400
+
+        if not runner.state.add_choice(round_number, user.user_id, choice):
             return jsonify({'error': 'Choice already made for this round'}), 400
 
-        player_choice = PlayerChoice(
-            game_session_id=game_session_id,
-            round_number=round_number,
-            user_id=user.user_id,
-            choice=choice
-        )
-        db.session.add(player_choice)
-        db.session.commit()
-
-        print(f"Player {chat_id} chose {choice} in round {round_number}", file=sys.stderr)
+        log.debug("Player %s chose %s", user.user_id, choice, extra=runner.state.log_fields(round_number))
         return jsonify({'message': 'Choice recorded successfully'}), 200
     except Exception as e:
-        print(f"Error making player choice: {e}")
+        log.error("Error making player choice: %s", e)
         return jsonify({'error': 'Internal server error'}), 500
 
+def record_remote_choice(game_session_id, round_number, user_id, choice):
+    """Выбор, пришедший на воркер без раннера игры: пишется сразу в БД,
+    владелец игры подмешивает его при закрытии фазы выбора"""
+    game_session = GameSession.query.get(game_session_id)
+    if not game_session or game_session.status != 'playing' or game_session.current_round != round_number:
+        return jsonify({'error': 'Choice phase is not active'}), 400
+    player = PlayerGameStatus.query.filter_by(
+        game_session_id=game_session_id, user_id=user_id, status='active'
+    ).first()
+    if not player:
+        return jsonify({'error': 'Player is not active in this game'}), 400
+    try:
+        db.session.add(PlayerChoice(
+            game_session_id=game_session_id, round_number=round_number,
+            user_id=user_id, choice=choice, coins_earned=0
+        ))
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({'error': 'Choice already made for this round'}), 400
+    log.debug("Player %s chose %s (stored for the owner worker)", user_id, choice,
+              extra=log_fields(game_session_id=game_session_id, round_number=round_number))
+    return jsonify({'message': 'Choice recorded successfully'}), 200
+
+def sync_remote_choices(state, round_number):
+    """Подмешивает выборы, записанные другими воркерами; они уже в БД и не пишутся повторно"""
+    rows = db.session.query(PlayerChoice.user_id, PlayerChoice.choice, PlayerChoice.made_at).filter_by(
+        game_session_id=state.id, round_number=round_number
+    ).all()
+    for user_id, choice, made_at in rows:
+        player = state.players.get(user_id)
+        if player and player.status == 'active' and state.add_choice(round_number, user_id, choice):
+            state.choices_made_at[round_number][user_id] = made_at
+        state.stored_choices.setdefault(round_number, set()).add(user_id)
+
+def sync_remote_quits(state):
+    """Выходы из игры, записанные другими воркерами, переносит в состояние владельца"""
+    rows = db.session.query(PlayerGameStatus.user_id, PlayerGameStatus.quit_in_round).filter_by(
+        game_session_id=state.id, status='quit'
+    ).all()
+    quitters = []
+    for user_id, quit_in_round in rows:
+        player = state.players.get(user_id)
+        if player and player.status == 'active':
+            player.status = 'quit'
+            player.quit_in_round = quit_in_round
+            quitters.append(player)
+    if quitters:
+        emit_to_lobby('player_status_update', {'statuses': state.statuses()}, state.lobby_id)
+    return quitters
+
 def finish_game_with_split_bank(game_session_id_param, winners):
     try:
-        with app.app_context():
-            print(f"=== GAME FINISHED WITH SPLIT BANK ===", file=sys.stderr)
-            game_session = GameSession.query.get(game_session_id_param)
-            if not game_session:
-                print("Game session not found", file=sys.stderr)
-                return
-            print(f"[LOG] initial_bank в момент дележа: {game_session.initial_bank}", file=sys.stderr)
-            bank = game_session.initial_bank or 0
-            print(f"[LOG] bank для дележа: {bank}", file=sys.stderr)
-            print(f"[LOG] winners: {[w.user_id for w in winners]}", file=sys.stderr)
-            if len(winners) == 0 or bank == 0:
-                print("No winners or bank is zero for split bank", file=sys.stderr)
-                return
-            coins_per_winner = bank // len(winners)
-            remainder = bank % len(winners)
-            winner_statuses = list(winners)
-            random.shuffle(winner_statuses)
-            all_statuses = PlayerGameStatus.query.filter_by(game_session_id=game_session_id_param).all()
-            for status in all_statuses:
-                status.total_coins_earned = 0
-            for i, player_status in enumerate(winner_statuses):
-                user = User.query.filter_by(user_id=player_status.user_id).first()
-                if user:
-                    extra = 1 if i < remainder else 0
-                    coins = coins_per_winner + extra
-                    print(f"[LOG] {player_status.user_id} получает {coins} монет (base {coins_per_winner} + extra {extra})", file=sys.stderr)
-                    user.balance += coins
-                    player_status.status = 'winner'
-                    player_status.total_coins_earned = coins
-            db.session.commit()
-            game_session.status = 'finished'
-            game_session.finished_at = datetime.utcnow()
-            db.session.commit()
-            all_player_statuses = PlayerGameStatus.query.filter_by(
-                game_session_id=game_session_id_param
-            ).all()
-            print("=== PLAYER STATISTICS FOR GAME RESULT ===", file=sys.stderr)
-            for s in all_player_statuses:
-                print(f"user_id={s.user_id} status={s.status} total_coins_earned={s.total_coins_earned}", file=sys.stderr)
-            result_data = {
-                'winner_id': None,
-                'split_winners': [p.user_id for p in winners],
-                'coins_per_winner': coins_per_winner,
-                'bank_remainder': remainder,
-                'game_session': game_session.to_dict(),
-                'player_statistics': [status.to_dict() for status in all_player_statuses],
-                'game_finished': True,
-                'split_bank': True
-            }
-            print("=== SENDING SPLIT BANK GAME RESULT TO ALL PLAYERS ===", file=sys.stderr)
-            socketio.emit('game_result', result_data)
-            socketio.emit('game_finished', {'winner_id': None, 'split_bank': True})
-            emit_lobby_update()
-            print("Game result events sent successfully", file=sys.stderr)
+        state = get_game_state(game_session_id_param)
+        if not state:
+            log.warning("Game session not found", extra=log_fields(game_session_id=game_session_id_param))
+            return
+        bank = state.initial_bank or 0
+        log.debug("Split bank %s between %s", bank, [w.user_id for w in winners], extra=state.log_fields(state.current_round))
+        if len(winners) == 0 or bank == 0:
+            log.warning("No winners or bank is zero for split bank", extra=state.log_fields(state.current_round))
+            return
+        coins_per_winner = bank // len(winners)
+        remainder = bank % len(winners)
+        winner_statuses = [state.players[user_id] for user_id in state.engine.shuffle((w.user_id for w in winners), state.current_round)]
+        for status in state.players.values():
+            status.total_coins_earned = 0
+        balances = {}
+        for i, player_status in enumerate(winner_statuses):
+            extra = 1 if i < remainder else 0
+            coins = coins_per_winner + extra
+            log.debug("%s получает %s монет (base %s + extra %s)", player_status.user_id, coins, coins_per_winner, extra,
+                      extra=state.log_fields(state.current_round))
+            balances[player_status.user_id] = coins
+            player_status.status = 'winner'
+            player_status.total_coins_earned = coins
+        state.status = 'finished'
+        state.finished_at = datetime.utcnow()
+        finish_game_runner(game_session_id_param, [
+            state.players_op(),
+            ('balances', balances, 'split_payout', state.id),
+            state.session_op()
+        ])
+        if log.isEnabledFor(logging.DEBUG):
+            for s in state.players.values():
+                log.debug("user_id=%s status=%s total_coins_earned=%s", s.user_id, s.status, s.total_coins_earned,
+                          extra=state.log_fields())
+        result_data = {
+            'winner_id': None,
+            'split_winners': [p.user_id for p in winners],
+            'coins_per_winner': coins_per_winner,
+            'bank_remainder': remainder,
+            'game_session': state.to_dict(),
+            'player_statistics': state.statuses(),
+            'game_finished': True,
+            'split_bank': True
+        }
+        log.info("Game finished with split bank, %s winners", len(winners), extra=state.log_fields(state.current_round))
+        emit_to_lobby('game_result', result_data, state.lobby_id)
+        emit_to_lobby('game_finished', {'winner_id': None, 'split_bank': True}, state.lobby_id)
+        push_my_status(state, winner_statuses)
+        emit_lobby_update(state.lobby_id)
     except Exception as e:
-        print(f"Error in finish_game_with_split_bank: {str(e)}", file=sys.stderr)
-        print(f"Full traceback: {traceback.format_exc()}", file=sys.stderr)
+        log.exception("Error in finish_game_with_split_bank", extra=log_fields(game_session_id=game_session_id_param))
         raise
 
-def lobby_timer_thread():
-    global lobby_timer, lobby_timer_running
-    print("Lobby timer thread started", file=sys.stderr)
-    while True:
+def lobby_timer_payload(lobby_id):
+    countdown = lobby_countdowns.get(lobby_id)
+    if countdown:
+        payload = countdown.payload()
+    elif MULTI_WORKER:
+        payload = shared_lobby_timer_payload(lobby_id)
+    else:
+        payload = {'time': 0}
+    payload['lobby_id'] = lobby_id
+    return payload
+
+def shared_lobby_timer_payload(lobby_id):
+    """Остаток отсчёта, запущенного на другом воркере, по сроку из LobbyCountdown"""
+    row = db.session.get(LobbyCountdown, lobby_id)
+    if not row:
+        return {'time': 0}
+    deadline = (row.deadline - datetime(1970, 1, 1)).total_seconds()
+    now = time.time()
+    return {
+        'time': max(0, math.ceil(deadline - now - 1e-3)),
+        'deadline': int(deadline * 1000),
+        'server_time': int(now * 1000),
+    }
+
+def share_lobby_countdown(lobby_id, countdown):
+    """Записывает срок отсчёта для остальных воркеров; их отсчёты этого лобби устаревают"""
+    deadline = datetime.utcfromtimestamp(countdown.wall_deadline)
+    if not LobbyCountdown.query.filter_by(lobby_id=lobby_id).update({'deadline': deadline}):
         try:
-            eventlet.sleep(1)
-            with lobby_timer_lock:
-                if lobby_timer_running and lobby_timer > 0:
-                    lobby_timer -= 1
-                    socketio.emit('timer_update', {'time': lobby_timer})
-                    print(f"Lobby timer: {lobby_timer} seconds left", file=sys.stderr)
-                if lobby_timer == 0:
-                    lobby_timer_running = False
-                    print("Lobby timer finished", file=sys.stderr)
-        except Exception as e:
-            print(f"Error in lobby_timer_thread: {e}", file=sys.stderr)
-            eventlet.sleep(1)
+            db.session.add(LobbyCountdown(lobby_id=lobby_id, deadline=deadline))
+            db.session.commit()
+            return
+        except IntegrityError:
+            # Строку только что вставил другой воркер
+            db.session.rollback()
+            LobbyCountdown.query.filter_by(lobby_id=lobby_id).update({'deadline': deadline})
+    db.session.commit()
+
+def lobby_countdown_superseded(lobby_id, countdown):
+    """True, если после этого отсчёта лобби запустили новый (на любом воркере)"""
+    if not MULTI_WORKER:
+        return False
+    with app.app_context():
+        row = db.session.get(LobbyCountdown, lobby_id)
+        deadline = datetime.utcfromtimestamp(countdown.wall_deadline)
+        return row is None or abs((row.deadline - deadline).total_seconds()) > 1e-3
 
-def start_lobby_timer():
-    global lobby_timer, lobby_timer_running
-    print("start_lobby_timer called")
+def lobby_timer_resync(lobby_id, countdown):
+    if lobby_countdowns.get(lobby_id) is not countdown:
+        return
+    if lobby_countdown_superseded(lobby_id, countdown):
+        with lobby_timer_lock:
+            if lobby_countdowns.get(lobby_id) is countdown:
+                countdown.cancel()
+                del lobby_countdowns[lobby_id]
+        return
+    emit_to_lobby('timer_update', lobby_timer_payload(lobby_id), lobby_id)
+
+def lobby_timer_finished(lobby_id, countdown):
+    superseded = lobby_countdown_superseded(lobby_id, countdown)
+    with lobby_timer_lock:
+        if lobby_countdowns.get(lobby_id) is not countdown:
+            return
+        if superseded:
+            del lobby_countdowns[lobby_id]
+            return
+        payload = lobby_timer_payload(lobby_id)
+        del lobby_countdowns[lobby_id]
+    emit_to_lobby('timer_update', payload, lobby_id)
+    log.info("Lobby timer finished", extra=log_fields(lobby_id=lobby_id))
+
+def start_lobby_timer(lobby_id):
+    log.debug("start_lobby_timer called", extra=log_fields(lobby_id=lobby_id))
     try:
         with lobby_timer_lock:
-            lobby_timer = 10
-            lobby_timer_running = True
-            print(f"Timer set to {lobby_timer} seconds")
-        socketio.emit('timer_update', {'time': lobby_timer})
-        print("Timer update emitted")
+            previous = lobby_countdowns.get(lobby_id)
+            if previous:
+                previous.cancel()
+            lobby_countdowns[lobby_id] = Countdown(
+                LOBBY_TIME, functools.partial(lobby_timer_finished, lobby_id),
+                functools.partial(lobby_timer_resync, lobby_id), TIMER_RESYNC_INTERVAL,
+                name=f'lobby {lobby_id} timer'
+            )
+            countdown = lobby_countdowns[lobby_id]
+            payload = lobby_timer_payload(lobby_id)
+            log.info("Timer set to %s seconds", LOBBY_TIME, extra=log_fields(lobby_id=lobby_id))
+        if MULTI_WORKER:
+            share_lobby_countdown(lobby_id, countdown)
+        emit_to_lobby('timer_update', payload, lobby_id)
+        return payload
     except Exception as e:
-        print(f"Error in start_lobby_timer: {str(e)}")
-        print(f"Full traceback: {traceback.format_exc()}")
+        log.exception("Error in start_lobby_timer", extra=log_fields(lobby_id=lobby_id))
         raise
 
 @app.route('/api/admin/lobby/<lobby_id>/start_timer', methods=['POST'])
@@ -1329,11 +2518,11 @@ def admin_start_lobby_timer(lobby_id):
         if not active_players:
             return jsonify({'error': 'No active players in lobby'}), 400
 
-        start_lobby_timer()
+        timer = start_lobby_timer(lobby_id)
 
         return jsonify({
             'message': 'Timer started successfully',
-            'time': lobby_timer
+            **timer
         }), 200
 
     except Exception as e:
@@ -1344,11 +2533,11 @@ def admin_start_lobby_timer(lobby_id):
 @app.route('/api/admin/lobby/test/start_timer', methods=['POST'])
 def test_start_lobby_timer():
     try:
-        start_lobby_timer()
+        timer = start_lobby_timer((request.get_json(silent=True) or {}).get('lobby_id', 'test'))
 
         return jsonify({
             'message': 'Test timer started successfully',
-            'time': lobby_timer
+            **timer
         }), 200
 
     except Exception as e:
@@ -1356,15 +2545,118 @@ def test_start_lobby_timer():
             'error': f'Error starting test timer: {str(e)}'
         }), 500
 
-def start_lobby_timer_thread():
+def request_route():
+    # Шаблон маршрута, а не путь: число серий не растёт с id лобби
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    g.sql_profile = sql_profiler.start('http', request_route())
+
+@app.after_request
+def observe_request_latency(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        http_request_duration.observe(time.perf_counter() - started, request.method, request_route(), response.status_code)
+    profile = sql_profiler.finish(g.pop('sql_profile', None))
+    if profile:
+        response.headers['X-DB-Queries'] = str(profile.queries)
+        response.headers['X-DB-Commits'] = str(profile.commits)
+        response.headers['X-DB-Time-Ms'] = f'{profile.db_time * 1000:.1f}'
+    return response
+
+@app.teardown_request
+def finish_request_profile(exc=None):
+    # after_request не вызывается при необработанном исключении
+    sql_profiler.finish(g.pop('sql_profile', None))
+
+def count_live_games():
+    return sum(1 for runner in list(game_runners.values())
+               if runner.state and runner.state.status == 'playing')
+
+def count_active_lobbies():
+    return db.session.query(db.func.count(db.distinct(Lobby.lobby_id))).filter(Lobby.is_active == True).scalar()
+
+metrics.gauge('game_live_games', 'Games with running timers on this worker', function=count_live_games)
+metrics.gauge('game_active_lobbies', 'Lobbies with active players', function=count_active_lobbies)
+metrics.gauge('scheduler_pending_timers', 'Timers waiting in the scheduler',
+              function=lambda: scheduler.stats()['pending'])
+metrics.gauge('game_writes_pending', 'Write-behind batches not yet committed',
+              function=lambda: game_persister.pending)
+metrics.gauge('game_writes_held', 'Write-behind operations kept after failed writes',
+              function=lambda: game_persister.held)
+metrics.gauge('db_pool_checked_out', 'DB connections checked out of the pool',
+              function=lambda: db.engine.pool.checkedout())
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    # Отдаётся внутри сети для Prometheus; фронтенд проксирует только /api
+    return app.response_class(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route('/api/admin/scheduler/stats', methods=['GET'])
+def get_scheduler_stats():
+    return jsonify(scheduler.stats()), 200
+
+@app.route('/api/admin/game/<int:game_session_id>/replay', methods=['GET'])
+def replay_game(game_session_id):
+    game_session = GameSession.query.get(game_session_id)
+    if not game_session:
+        return jsonify({'error': 'Game session not found'}), 404
+    if game_session.status != 'finished':
+        return jsonify({'error': 'Game is not finished yet'}), 400
+    if game_session.rng_seed is None:
+        return jsonify({'error': 'Game has no stored seed'}), 400
+
+    rounds = GameRound.query.filter_by(game_session_id=game_session_id).order_by(GameRound.round_number).all()
+    statuses = []
+    if any(r.candidates is None for r in rounds):
+        statuses = PlayerGameStatus.query.filter_by(game_session_id=game_session_id).all()
+
+    # Раунды до миграции 6 без состава: активны на жеребьёвке раунда r те, кто не выбыл
+    # и не вышел раньше r (вышедших в самом раунде до жеребьёвки так не отличить)
+    def active_in(r):
+        if r.candidates is not None:
+            return json.loads(r.candidates)
+        return [
+            s.user_id for s in statuses
+            if (s.eliminated_in_round is None or s.eliminated_in_round >= r.round_number)
+            and (s.quit_in_round is None or s.quit_in_round >= r.round_number)
+        ]
+
+    replayed = dict(replay_eliminations(
+        game_session.rng_seed, [(r.round_number, active_in(r)) for r in rounds]
+    ))
+    result = []
+    for r in rounds:
+        stored = json.loads(r.eliminated_players) if r.eliminated_players else []
+        result.append({
+            'round_number': r.round_number,
+            'eliminated_players': stored,
+            'replayed': replayed[r.round_number],
+            'match': stored == replayed[r.round_number]
+        })
+
+    return jsonify({
+        'game_session_id': game_session_id,
+        'seed': str(game_session.rng_seed),
+        'rounds': result,
+        'match': all(r['match'] for r in result)
+    }), 200
+
+@app.route('/api/admin/cache/stats', methods=['GET'])
+def get_cache_stats():
+    return jsonify({'users': user_cache.stats()}), 200
+
+@app.route('/api/admin/coins/reconcile', methods=['GET'])
+def reconcile_coins():
     try:
-        eventlet.spawn(lobby_timer_thread)
-        print("Lobby timer thread started successfully", file=sys.stderr)
+        batch_size = request.args.get('batch_size', 500, type=int)
+        return jsonify(reconcile_coin_ledger(batch_size)), 200
     except Exception as e:
-        print(f"Error starting lobby timer thread: {str(e)}", file=sys.stderr)
-        print(f"Full traceback: {traceback.format_exc()}", file=sys.stderr)
-
-start_lobby_timer_thread()
+        return jsonify({
+            'error': f'Error reconciling coin ledger: {str(e)}'
+        }), 500
 
 @app.route('/api/game/status', methods=['GET'])
 def get_game_status():
@@ -1372,33 +2664,50 @@ def get_game_status():
     if not lobby_id:
         return jsonify({'error': 'Missing lobby_id'}), 400
 
-    game_session = GameSession.query.filter_by(lobby_id=lobby_id).first()
-    if not game_session:
-        return jsonify({'status': 'waiting'}), 200
+    def build():
+        runner = find_game_runner(lobby_id)
+        if runner:
+            return jsonify(runner.state.to_dict()), 200
 
-    return jsonify(game_session.to_dict()), 200
+        game_session = GameSession.query.filter_by(lobby_id=lobby_id, archived=False).first()
+        if not game_session:
+            return jsonify({'status': 'waiting'}), 200
+
+        return jsonify(game_session.to_dict()), 200
+
+    return conditional_response(data_etag(('game', lobby_id)), build)
 
 @app.route('/api/game/player-status', methods=['GET'])
 def get_player_status():
-    chat_id = request.args.get('chat_id')
+    chat_id = request_chat_id(request.args.get('chat_id'))
     lobby_id = request.args.get('lobby_id')
 
     if not chat_id or not lobby_id:
         return jsonify({'error': 'Missing chat_id or lobby_id'}), 400
 
+    return conditional_response(
+        data_etag(('game', lobby_id), extra=chat_id),
+        lambda: player_status_response(chat_id, lobby_id)
+    )
+
+def player_status_response(chat_id, lobby_id):
     try:
-        user = User.query.filter_by(chat_id=chat_id).first()
+        user = request_user(chat_id)
         if not user:
             return jsonify({'error': 'User not found'}), 404
 
-        game_session = GameSession.query.filter_by(lobby_id=lobby_id).first()
-        if not game_session:
-            return jsonify({'error': 'Game session not found'}), 404
+        runner = find_game_runner(lobby_id)
+        if runner:
+            player_status = runner.state.players.get(user.user_id)
+        else:
+            game_session = GameSession.query.filter_by(lobby_id=lobby_id, archived=False).first()
+            if not game_session:
+                return jsonify({'error': 'Game session not found'}), 404
 
-        player_status = PlayerGameStatus.query.filter_by(
-            game_session_id=game_session.id,
-            user_id=user.user_id
-        ).first()
+            player_status = PlayerGameStatus.query.filter_by(
+                game_session_id=game_session.id,
+                user_id=user.user_id
+            ).first()
 
         if not player_status:
             return jsonify({'error': 'Player status not found'}), 404
@@ -1410,7 +2719,7 @@ def get_player_status():
             'quit_in_round': player_status.quit_in_round
         }), 200
     except Exception as e:
-        print(f"Error getting player status: {e}")
+        log.error("Error getting player status: %s", e)
         return jsonify({'error': 'Internal server error'}), 500
 
 @app.route('/api/game/round/start', methods=['POST'])
@@ -1458,6 +2767,7 @@ def end_round():
     if game_session:
         game_session.current_round = round_number + 1
         db.session.commit()
+        bump_data_version('game', game_session.lobby_id)
 
     return jsonify({
         'message': 'Round ended successfully',
@@ -1468,15 +2778,20 @@ def end_round():
 def finish_game():
     data = request.json
     winner_id = data.get('winner_id')
+    game_session_id = data.get('game_session_id')
 
-    if not winner_id:
-        return jsonify({'error': 'Missing winner_id'}), 400
+    if not winner_id or not game_session_id:
+        return jsonify({'error': 'Missing winner_id or game_session_id'}), 400
 
     try:
-        socketio.emit('game_finished', {
+        lobby_id = game_lobby_id(int(game_session_id))
+        if not lobby_id:
+            return jsonify({'error': 'Game session not found'}), 404
+
+        emit_to_lobby('game_finished', {
             'winner_id': winner_id,
             'message': 'Game finished!'
-        })
+        }, lobby_id)
 
         return jsonify({
             'message': 'Game finished successfully',
@@ -1490,122 +2805,116 @@ def finish_game():
 
 @app.route('/api/admin/lobbies', methods=['GET'])
 def get_all_lobbies():
-    try:
-        lobbies = db.session.query(Lobby.lobby_id).distinct().all()
-        lobby_list = []
-
-        for (lobby_id,) in lobbies:
-            # Считаем только не-администраторов
-            active_players = Lobby.query.filter_by(
-                lobby_id=lobby_id,
-                is_active=True
-            ).join(User, Lobby.chat_id == User.chat_id).filter(User.is_admin == False).count()
-
-            game_session = GameSession.query.filter_by(lobby_id=lobby_id).first()
-            status = game_session.status if game_session else 'waiting'
-
-            lobby_list.append({
-                'lobby_id': lobby_id,
-                'player_count': active_players,
-                'status': status
-            })
+    def build():
+        lobby_list = admin_lobby_summaries()
 
         return jsonify({
             'lobbies': lobby_list,
             'total_count': len(lobby_list)
         }), 200
+
+    try:
+        return conditional_response(data_etag(('lobby', None), ('game', None)), build)
     except Exception as e:
-        print(f"Error getting lobbies: {e}")
+        log.error("Error getting lobbies: %s", e)
         return jsonify({'error': 'Internal server error'}), 500
 
+def archive_game_sessions(lobby_id=None):
+    """Переводит текущую сессию лобби (без lobby_id — всех лобби) в архив.
+
+    Раунды, выборы и статусы архивной игры остаются: её можно воспроизвести,
+    а ссылки журнала монет не повиснут. Незавершённая игра закрывается.
+    """
+    sessions = GameSession.query.filter_by(archived=False)
+    if lobby_id is not None:
+        sessions = sessions.filter_by(lobby_id=lobby_id)
+    sessions.filter(GameSession.status != 'finished').update(
+        {'status': 'finished', 'finished_at': datetime.utcnow()}, synchronize_session='fetch'
+    )
+    sessions.update({'archived': True}, synchronize_session='fetch')
+
 @app.route('/api/admin/lobby/<lobby_id>/start', methods=['POST'])
 def admin_start_game(lobby_id):
     try:
-        print(f"=== ADMIN START GAME DEBUG ===", file=sys.stderr)
-        print(f"Starting game for lobby: {lobby_id}", file=sys.stderr)
+        log.info("Admin starts game", extra=log_fields(lobby_id=lobby_id))
         
         # Получаем всех игроков в лобби (исключая администраторов)
         all_lobby_players = Lobby.query.filter_by(lobby_id=lobby_id, is_active=True).join(
             User, Lobby.chat_id == User.chat_id
         ).filter(User.is_admin == False).all()
         
-        print("[LOG] Все игроки в лобби перед стартом:", file=sys.stderr)
-        for p in all_lobby_players:
-            print(f"[LOG] chat_id={p.chat_id} nickname={p.nickname} is_ready={p.is_ready}", file=sys.stderr)
+        # Построчный список игроков только на DEBUG: на старте большого лобби это тысячи строк
+        if log.isEnabledFor(logging.DEBUG):
+            for p in all_lobby_players:
+                log.debug("chat_id=%s nickname=%s is_ready=%s", p.chat_id, p.nickname, p.is_ready,
+                          extra=log_fields(lobby_id=lobby_id))
         
         ready_players = [p for p in all_lobby_players if p.is_ready]
-        print(f"[LOG] Игроки с is_ready=True при старте игры: {[f'{p.chat_id} ({p.nickname})' for p in ready_players]}", file=sys.stderr)
+        # Снимок до коммитов ниже: после них каждая строка Lobby перечитывалась бы отдельно
+        ready_players_payload = [player.to_dict() for player in ready_players]
         
         if not ready_players:
-            print("[LOG] Нет готовых игроков для старта игры", file=sys.stderr)
+            log.info("Нет готовых игроков для старта игры", extra=log_fields(lobby_id=lobby_id))
             return jsonify({'error': 'No ready players in lobby'}), 400
         
         initial_bank = len(ready_players)
-        print(f"[LOG] initial_bank при старте игры: {initial_bank}", file=sys.stderr)
         
         total_rounds = calculate_total_rounds(len(ready_players))
-        print(f"Calculated {total_rounds} total rounds for {len(ready_players)} players", file=sys.stderr)
+        log.info("Calculated %s total rounds for %s players", total_rounds, len(ready_players), extra=log_fields(lobby_id=lobby_id))
         
-        existing_session = GameSession.query.filter_by(lobby_id=lobby_id).first()
+        existing_session = GameSession.query.filter_by(lobby_id=lobby_id, archived=False).first()
         if existing_session:
-            print(f"Found existing session {existing_session.id} with status: {existing_session.status}", file=sys.stderr)
-            if existing_session.status != 'finished':
-                print(f"Finishing existing session {existing_session.id}", file=sys.stderr)
-                existing_session.status = 'finished'
-                existing_session.finished_at = datetime.utcnow()
-                db.session.commit()
-                print("Existing session finished", file=sys.stderr)
-            else:
-                print("Existing session is already finished", file=sys.stderr)
-        
-        GameSession.query.filter_by(lobby_id=lobby_id).delete()
-        db.session.commit()
-        print("Cleaned up existing game sessions", file=sys.stderr)
+            log.info("Found existing session with status %s", existing_session.status,
+                     extra=log_fields(lobby_id=lobby_id, game_session_id=existing_session.id))
+            stop_game_runner(existing_session.id)
+            game_persister.flush()
+            game_persister.discard(existing_session.id)
+            archive_game_sessions(lobby_id)
+            db.session.commit()
+            log.debug("Archived previous game session", extra=log_fields(lobby_id=lobby_id, game_session_id=existing_session.id))
         
-        print("Creating game session...", file=sys.stderr)
         try:
             game_session = GameSession(
                 lobby_id=lobby_id,
                 status='playing',
                 total_rounds=total_rounds,
-                initial_bank=initial_bank
+                initial_bank=initial_bank,
+                rng_seed=new_game_seed()
             )
             db.session.add(game_session)
             db.session.commit()
-            print(f"Game session created successfully with ID: {game_session.id}, total_rounds: {total_rounds}", file=sys.stderr)
+            log.info("Game session created", extra=log_fields(lobby_id=lobby_id, game_session_id=game_session.id))
         except Exception as e:
-            print(f"Error creating game session: {str(e)}", file=sys.stderr)
-            print(f"Full traceback: {traceback.format_exc()}", file=sys.stderr)
+            log.exception("Error creating game session", extra=log_fields(lobby_id=lobby_id))
             raise
         
-        print("Starting game timer...", file=sys.stderr)
         try:
             initialize_player_statuses(game_session.id, lobby_id)
+            acquire_game_lease(game_session.id)
+            state = load_game_state(game_session.id)
+            bump_data_version('game', lobby_id)
             start_game_timer(game_session.id)
-            print("Game timer started successfully", file=sys.stderr)
         except Exception as e:
-            print(f"Error starting game timer: {str(e)}", file=sys.stderr)
-            print(f"Full traceback: {traceback.format_exc()}", file=sys.stderr)
+            log.exception("Error starting game timer", extra=log_fields(lobby_id=lobby_id, game_session_id=game_session.id))
             raise
         
         try:
-            socketio.emit('game_started', {
+            emit_to_lobby('game_started', {
                 'game_session': game_session.to_dict(),
-                'players': [player.to_dict() for player in ready_players]
-            })
-            print("Game started event sent to all players", file=sys.stderr)
+                'players': ready_players_payload
+            }, lobby_id)
+            # Начальный статус каждому игроку, дальше клиент держит его по my_status_update
+            push_my_status(state, state.players.values())
+            schedule_admin_lobby_update()
         except Exception as e:
-            print(f"Error sending game started event: {str(e)}", file=sys.stderr)
+            log.error("Error sending game started event: %s", e, extra=log_fields(lobby_id=lobby_id))
         
-        print("=== ADMIN START GAME SUCCESS ===", file=sys.stderr)
         return jsonify({
             'message': 'Game started successfully by admin',
             'game_session': game_session.to_dict()
         }), 200
     except Exception as e:
-        print(f"=== ADMIN START GAME ERROR ===", file=sys.stderr)
-        print(f"Error in admin_start_game: {str(e)}", file=sys.stderr)
-        print(f"Full traceback: {traceback.format_exc()}", file=sys.stderr)
+        log.exception("Error in admin_start_game", extra=log_fields(lobby_id=lobby_id))
         return jsonify({
             'error': f'Error starting game: {str(e)}'
         }), 500
@@ -1613,31 +2922,24 @@ def admin_start_game(lobby_id):
 @app.route('/api/admin/lobby/<lobby_id>/delete', methods=['DELETE'])
 def admin_delete_lobby(lobby_id):
     try:
-        print(f"=== DELETING LOBBY {lobby_id} ===", file=sys.stderr)
+        log.info("Deleting lobby", extra=log_fields(lobby_id=lobby_id))
 
-        game_session = GameSession.query.filter_by(lobby_id=lobby_id).first()
+        game_session = GameSession.query.filter_by(lobby_id=lobby_id, archived=False).first()
 
         if game_session:
-            game_session_id = game_session.id
-            print(f"Found game session with ID: {game_session_id}", file=sys.stderr)
-
-            PlayerChoice.query.filter_by(game_session_id=game_session_id).delete()
-            print("Deleted player choices", file=sys.stderr)
-
-            PlayerGameStatus.query.filter_by(game_session_id=game_session_id).delete()
-            print("Deleted player game statuses", file=sys.stderr)
-
-            GameRound.query.filter_by(game_session_id=game_session_id).delete()
-            print("Deleted game rounds", file=sys.stderr)
-
-            GameSession.query.filter_by(lobby_id=lobby_id).delete()
-            print("Deleted game session", file=sys.stderr)
+            stop_game_runner(game_session.id)
+            game_persister.flush()
+            game_persister.discard(game_session.id)
+            archive_game_sessions(lobby_id)
 
         Lobby.query.filter_by(lobby_id=lobby_id).delete()
-        print("Deleted lobby entries", file=sys.stderr)
 
         db.session.commit()
-        print(f"=== LOBBY {lobby_id} DELETED SUCCESSFULLY ===", file=sys.stderr)
+        lobby_versions.pop(lobby_id, None)
+        bump_data_version('game', lobby_id)
+        emit_lobby_update(lobby_id)
+        schedule_admin_lobby_update()
+        log.info("Lobby deleted", extra=log_fields(lobby_id=lobby_id))
 
         return jsonify({
             'message': 'Lobby deleted successfully'
@@ -1645,9 +2947,7 @@ def admin_delete_lobby(lobby_id):
 
     except Exception as e:
         db.session.rollback()
-        print(f"=== ERROR DELETING LOBBY {lobby_id} ===", file=sys.stderr)
-        print(f"Error: {str(e)}", file=sys.stderr)
-        print(f"Full traceback: {traceback.format_exc()}", file=sys.stderr)
+        log.exception("Error deleting lobby", extra=log_fields(lobby_id=lobby_id))
         return jsonify({
             'error': f'Error deleting lobby: {str(e)}'
         }), 500
@@ -1670,7 +2970,7 @@ def admin_create_lobby():
             'lobby_id': lobby_id
         }), 201
     except Exception as e:
-        print(f"Error creating lobby: {e}")
+        log.error("Error creating lobby: %s", e)
         return jsonify({'error': 'Internal server error'}), 500
 
 def calculate_total_rounds(player_count):
@@ -1692,7 +2992,7 @@ def initialize_player_statuses(game_session_id, lobby_id=None):
         with app.app_context():
             game_session = GameSession.query.get(game_session_id)
             if not game_session:
-                print(f"Game session {game_session_id} not found", file=sys.stderr)
+                log.warning("Game session not found", extra=log_fields(game_session_id=game_session_id))
                 return
 
             lobby_id = lobby_id or game_session.lobby_id
@@ -1703,31 +3003,47 @@ def initialize_player_statuses(game_session_id, lobby_id=None):
                 is_active=True
             ).join(User, Lobby.chat_id == User.chat_id).filter(User.is_admin == False).all()
 
-            print(f"Found {len(active_players)} active players in lobby {lobby_id}", file=sys.stderr)
-
-            for player in active_players:
-                existing_status = PlayerGameStatus.query.filter_by(
-                    game_session_id=game_session_id,
-                    user_id=player.user_id
-                ).first()
-
-                if not existing_status:
-                    player_status = PlayerGameStatus(
-                        game_session_id=game_session_id,
-                        user_id=player.user_id,
-                        status='active'
-                    )
-                    db.session.add(player_status)
-                    print(f"Added player status for {player.chat_id}", file=sys.stderr)
+            # Сессия новая: статусы вставляем одной пачкой, дубли исключает uq_player_game_status_session_user
+            user_ids = list(dict.fromkeys(player.user_id for player in active_players))
+            if user_ids:
+                db.session.execute(db.insert(PlayerGameStatus), [
+                    {
+                        'game_session_id': game_session_id,
+                        'user_id': user_id,
+                        'status': 'active',
+                        'total_coins_earned': 0,
+                        'created_at': datetime.utcnow()
+                    }
+                    for user_id in user_ids
+                ])
 
             db.session.commit()
-            print(f"Initialized player statuses for {len(active_players)} players in lobby {lobby_id}", file=sys.stderr)
+            log.info("Initialized player statuses for %s players", len(active_players),
+                     extra=log_fields(lobby_id=lobby_id, game_session_id=game_session_id))
 
     except Exception as e:
-        print(f"Error initializing player statuses: {str(e)}", file=sys.stderr)
+        # Без статусов игра не стартует: ошибка уходит в admin_start_game
+        log.error("Error initializing player statuses: %s", e, extra=log_fields(game_session_id=game_session_id))
         db.session.rollback()
+        raise
+
+def load_game_state(game_session_id):
+    """Поднимает состояние игры из БД в раннер сессии"""
+    with app.app_context():
+        game_session = GameSession.query.get(game_session_id)
+        if not game_session:
+            log.warning("Game session not found", extra=log_fields(game_session_id=game_session_id))
+            return None
+        statuses = PlayerGameStatus.query.filter_by(game_session_id=game_session_id).order_by(PlayerGameStatus.id).all()
+        runner = get_game_runner(game_session_id, game_session.lobby_id)
+        runner.state = GameState(game_session, statuses)
+        return runner.state
 
 def get_active_players(game_session_id):
+    state = get_game_state(game_session_id)
+    if state:
+        return state.active_players()
+
     try:
         with app.app_context():
             active_statuses = PlayerGameStatus.query.filter_by(
@@ -1738,44 +3054,47 @@ def get_active_players(game_session_id):
             return active_statuses
 
     except Exception as e:
-        print(f"Error getting active players: {str(e)}", file=sys.stderr)
+        log.error("Error getting active players: %s", e)
         return []
 
 def eliminate_players_in_round(game_session_id, round_number):
     try:
-        with app.app_context():
-            active_players = get_active_players(game_session_id)
+        state = get_game_state(game_session_id)
+        if not state:
+            log.warning("Game session not found", extra=log_fields(game_session_id=game_session_id))
+            return [], []
 
-            if len(active_players) <= 1:
-                return active_players
+        active_players = state.active_players()
 
-            eliminate_count = len(active_players) // 2
+        if len(active_players) <= 1:
+            return active_players, []
 
-            players_to_eliminate = random.sample(active_players, eliminate_count)
-
-            for player_status in players_to_eliminate:
-                player_status.status = 'eliminated'
-                player_status.eliminated_in_round = round_number
-
-            db.session.commit()
+        eliminated_player_ids = state.engine.eliminate([p.user_id for p in active_players], round_number)
 
-            eliminated_player_ids = [p.user_id for p in players_to_eliminate]
-            socketio.emit('players_eliminated', {
-                'eliminated_players': eliminated_player_ids,
-                'round_number': round_number,
-                'remaining_count': len(active_players) - eliminate_count
-            })
-            print(f"Players eliminated event sent: {eliminated_player_ids}", file=sys.stderr)
+        for user_id in eliminated_player_ids:
+            player_status = state.players[user_id]
+            player_status.status = 'eliminated'
+            player_status.eliminated_in_round = round_number
 
-            remaining_players = [p for p in active_players if p not in players_to_eliminate]
+        remaining_players = [p for p in active_players if p.status == 'active']
 
-            print(f"Eliminated {eliminate_count} players in round {round_number}, {len(remaining_players)} remaining", file=sys.stderr)
+        emit_to_lobby('players_eliminated', {
+            'eliminated_players': eliminated_player_ids,
+            'round_number': round_number,
+            'remaining_count': len(remaining_players)
+        }, state.lobby_id)
+        log.info("Eliminated %s players, %s remaining", len(eliminated_player_ids), len(remaining_players),
+                 extra=state.log_fields(round_number))
 
-            return remaining_players
+        return remaining_players, eliminated_player_ids
 
     except Exception as e:
-        print(f"Error eliminating players: {str(e)}", file=sys.stderr)
-        db.session.rollback()
+        log.exception("Error eliminating players", extra=log_fields(game_session_id=game_session_id, round_number=round_number))
+        raise
+
+if MULTI_WORKER:
+    # Первый тик сразу: игры упавшего воркера подхватываются при старте
+    scheduler.schedule(0, game_lease_tick, name='game leases')
 
 if __name__ == '__main__':
-    socketio.run(app, host='0.0.0.0', port=5000, debug=True, use_reloader=False)
\ No newline at end of file
+    socketio.run(app, host='0.0.0.0', port=5000, debug=True, use_reloader=False)
@@ -0,0 +1,64 @@
+"""JSON ответов Flask и пакетов Socket.IO: orjson, если установлен, иначе json из stdlib.
+
+Даты и время пишутся в ISO 8601, как datetime.isoformat(): to_dict моделей
+отдают datetime как есть, строка собирается уже при сериализации.
+"""
+import dataclasses
+import decimal
+import json
+import uuid
+from datetime import date, time
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _default(obj):
+    """Типы вне JSON: даты в ISO 8601, остальное как у провайдера Flask по умолчанию"""
+    if isinstance(obj, (date, time)):
+        return obj.isoformat()
+    if isinstance(obj, (decimal.Decimal, uuid.UUID)):
+        return str(obj)
+    if dataclasses.is_dataclass(obj) and not isinstance(obj, type):
+        return dataclasses.asdict(obj)
+    if hasattr(obj, '__html__'):
+        return str(obj.__html__())
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+def dumps(obj, **kwargs):
+    """Совместим с json.dumps по вызову; с orjson учитываются только indent и sort_keys,
+    вывод всегда компактный и в UTF-8 без экранирования"""
+    if orjson is None:
+        kwargs.setdefault('default', _default)
+        return json.dumps(obj, **kwargs)
+    option = orjson.OPT_NON_STR_KEYS
+    if kwargs.get('indent'):
+        option |= orjson.OPT_INDENT_2
+    if kwargs.get('sort_keys'):
+        option |= orjson.OPT_SORT_KEYS
+    return orjson.dumps(obj, default=_default, option=option).decode()
+
+
+def loads(s, **kwargs):
+    if orjson is None:
+        return json.loads(s, **kwargs)
+    return orjson.loads(s)
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """Провайдер app.json поверх dumps/loads этого модуля"""
+
+    # Клиенту порядок ключей не важен, сортировка — лишняя работа на каждом ответе
+    sort_keys = False
+
+    def dumps(self, obj, **kwargs):
+        kwargs.setdefault('sort_keys', self.sort_keys)
+        return dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        return loads(s, **kwargs)
@@ -0,0 +1,268 @@
+"""Нагрузочный прогон: синтетические игроки Telegram против запущенного сервера.
+
+    python loadgen.py --url http://127.0.0.1:5000 --players 200 --lobbies 4
+
+Каждый игрок входит через /api/telegram/auth с подписанным initData (токен
+бота из config, тот же, что у сервера), открывает сокет с токеном сессии,
+заходит в лобби, платит вход и становится готовым. Затем лобби стартуют
+админским эндпоинтом, игроки проходят игру до game_result, отвечая в фазе
+выбора stay/leave после случайной паузы.
+
+В отчёте p50/p95/p99 по HTTP-вызовам, задержка emit -> получение клиентом
+для событий с server_time (таймеры игры), опоздание таймеров на сервере и у
+клиента и доля ошибок. Часы сервера и клиента общие: прогон рассчитан на
+одну машину. Код выхода 1, если доля ошибок выше --max-error-rate.
+
+Зависимости клиента (requests, python-socketio[client]) — в requirements-dev.txt:
+
+    pip install -r requirements-dev.txt
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import math
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+import requests
+import socketio
+
+from config import FRONTEND_URL, TELEGRAM_BOT_TOKEN
+
+
+def init_data(chat_id, first_name, bot_token):
+    """Подписанный initData Telegram Web App для /api/telegram/auth"""
+    fields = {
+        'auth_date': str(int(time.time())),
+        'query_id': 'loadgen',
+        'user': json.dumps({'id': chat_id, 'first_name': first_name}),
+    }
+    check_string = '\n'.join(f'{key}={value}' for key, value in sorted(fields.items()))
+    secret = hmac.new(b'WebAppData', bot_token.encode(), hashlib.sha256).digest()
+    fields['hash'] = hmac.new(secret, check_string.encode(), hashlib.sha256).hexdigest()
+    return urlencode(fields)
+
+
+def percentile(values, q):
+    """Процентиль по ближайшему рангу из отсортированного списка"""
+    return values[max(0, math.ceil(q * len(values)) - 1)]
+
+
+class Stats:
+    """Замеры в миллисекундах и ошибки, общие для потоков всех игроков"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.calls = {}
+        self.errors = {}
+
+    def record(self, group, name, value):
+        with self.lock:
+            self.samples.setdefault((group, name), []).append(value)
+
+    def call(self, name, ok, reason=None):
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+            if not ok:
+                key = (name, str(reason))
+                self.errors[key] = self.errors.get(key, 0) + 1
+
+    def error_count(self):
+        return sum(self.errors.values())
+
+    def report(self, out=sys.stdout):
+        titles = {
+            'http': 'HTTP, ms',
+            'socket': 'Socket.IO, ms',
+            'emit': 'emit -> receipt, ms',
+            'timer': 'timer lateness past deadline, ms',
+        }
+        for group, title in titles.items():
+            rows = sorted((name, sorted(values)) for (kind, name), values in self.samples.items() if kind == group)
+            if not rows:
+                continue
+            print(f'\n{title}', file=out)
+            print(f'  {"name":<48} {"count":>7} {"p50":>8} {"p95":>8} {"p99":>8} {"max":>8}', file=out)
+            for name, values in rows:
+                print(f'  {name:<48} {len(values):>7} {percentile(values, 0.5):>8.1f} {percentile(values, 0.95):>8.1f} '
+                      f'{percentile(values, 0.99):>8.1f} {values[-1]:>8.1f}', file=out)
+        total = sum(self.calls.values())
+        errors = self.error_count()
+        print(f'\nerrors: {errors} of {total} operations ({errors / max(total, 1):.2%})', file=out)
+        for (name, reason), count in sorted(self.errors.items()):
+            print(f'  {name}: {reason} x{count}', file=out)
+
+
+class Player:
+    """Один синтетический игрок: HTTP-сессия с токеном и клиент Socket.IO"""
+
+    def __init__(self, run, chat_id, lobby_id):
+        self.run = run
+        self.chat_id = str(chat_id)
+        self.user_id = None
+        self.lobby_id = lobby_id
+        self.http = requests.Session()
+        # Origin задаётся опцией websocket-client: заголовком он ушёл бы вторым после адреса сервера
+        self.sio = socketio.Client(reconnection=False, websocket_extra_options={'origin': run.origin})
+        self.sio.on('*', self.on_event)
+        self.finished = threading.Event()
+
+    def request(self, method, path, name=None, **kwargs):
+        """HTTP-вызов с замером; возвращает JSON ответа или None при ошибке"""
+        name = name or f'{method} {path}'
+        started = time.perf_counter()
+        try:
+            response = self.http.request(method, self.run.url + path, timeout=self.run.http_timeout, **kwargs)
+        except requests.RequestException as e:
+            self.run.stats.call(name, False, type(e).__name__)
+            return None
+        self.run.stats.record('http', name, (time.perf_counter() - started) * 1000)
+        ok = response.status_code < 400
+        self.run.stats.call(name, ok, response.status_code)
+        if not ok:
+            return None
+        try:
+            return response.json()
+        except ValueError:
+            return {}
+
+    def login(self):
+        auth = self.request('POST', '/api/telegram/auth', json={
+            'initData': init_data(int(self.chat_id), f'load{self.chat_id}', self.run.bot_token)
+        })
+        if not auth:
+            return False
+        self.user_id = auth['user']['user_id']
+        self.http.headers['Authorization'] = f'Bearer {auth["token"]}'
+        started = time.perf_counter()
+        try:
+            self.sio.connect(self.run.url, auth={'token': auth['token']}, transports=['websocket'],
+                             wait_timeout=self.run.http_timeout)
+        except socketio.exceptions.ConnectionError as e:
+            self.run.stats.call('socket connect', False, e)
+            return False
+        self.run.stats.record('socket', 'connect', (time.perf_counter() - started) * 1000)
+        self.run.stats.call('socket connect', True)
+        if self.request('POST', '/api/lobby/join', json={'chat_id': self.chat_id, 'lobby_id': self.lobby_id}) is None:
+            return False
+        self.sio.emit('join_lobby', {'chat_id': self.chat_id, 'lobby_id': self.lobby_id})
+        return True
+
+    def get_ready(self):
+        """Вход в игру как во фронтенде: списать монету, затем отметиться готовым"""
+        self.finished.clear()
+        if self.request('POST', '/api/coins/deduct', json={'chat_id': self.chat_id}) is None:
+            return False
+        return self.request('POST', '/api/lobby/ready', json={'chat_id': self.chat_id}) is not None
+
+    def on_event(self, event, *args):
+        received = time.time() * 1000
+        data = args[0] if args and isinstance(args[0], dict) else {}
+        if 'server_time' in data:
+            self.run.stats.record('emit', event, received - data['server_time'])
+            if event.endswith('_finished') and 'deadline' in data:
+                self.run.stats.record('timer', f'{event} server', data['server_time'] - data['deadline'])
+                self.run.stats.record('timer', f'{event} client', received - data['deadline'])
+        if event == 'choice_phase_started' and self.user_id in data.get('active_players', ()):
+            self.sio.start_background_task(self.choose, data['game_session_id'], data['round_number'])
+        elif event == 'game_result':
+            self.finished.set()
+
+    def choose(self, game_session_id, round_number):
+        time.sleep(random.uniform(0, self.run.think_time))
+        self.request('POST', '/api/game/choice', json={
+            'chat_id': self.chat_id,
+            'game_session_id': game_session_id,
+            'round_number': round_number,
+            'choice': 'stay' if random.random() < self.run.stay_probability else 'leave',
+        })
+
+    def close(self):
+        if self.sio.connected:
+            self.sio.disconnect()
+        self.http.close()
+
+
+class LoadRun:
+    def __init__(self, args):
+        self.url = args.url.rstrip('/')
+        self.bot_token = args.bot_token
+        self.origin = args.origin
+        self.http_timeout = args.http_timeout
+        self.think_time = args.think_time
+        self.stay_probability = args.stay_probability
+        self.concurrency = args.concurrency
+        self.games = args.games
+        self.game_timeout = args.game_timeout
+        self.stats = Stats()
+        self.lobby_ids = [f'load-{args.id_base}-{index}' for index in range(args.lobbies)]
+        self.players = [Player(self, args.id_base + index, self.lobby_ids[index % args.lobbies])
+                        for index in range(args.players)]
+        # Админские эндпоинты вызываются без токена, как из панели
+        self.admin = requests.Session()
+
+    def run(self):
+        with ThreadPoolExecutor(self.concurrency) as pool:
+            online = [player for player, ok in zip(self.players, pool.map(Player.login, self.players)) if ok]
+            print(f'{len(online)} of {len(self.players)} players online', file=sys.stderr)
+            for game in range(self.games):
+                ready = [player for player, ok in zip(online, pool.map(Player.get_ready, online)) if ok]
+                self.play(game, ready)
+        for player in self.players:
+            player.close()
+
+    def play(self, game, players):
+        for lobby_id in self.lobby_ids:
+            if not any(player.lobby_id == lobby_id for player in players):
+                continue
+            name = 'POST /api/admin/lobby/<lobby_id>/start'
+            started = time.perf_counter()
+            try:
+                response = self.admin.post(f'{self.url}/api/admin/lobby/{lobby_id}/start', timeout=self.http_timeout)
+            except requests.RequestException as e:
+                self.stats.call(name, False, type(e).__name__)
+                continue
+            self.stats.record('http', name, (time.perf_counter() - started) * 1000)
+            self.stats.call(name, response.status_code < 400, response.status_code)
+        deadline = time.monotonic() + self.game_timeout
+        for player in players:
+            finished = player.finished.wait(max(0.0, deadline - time.monotonic()))
+            self.stats.call('game_result', finished, 'timeout')
+        print(f'game {game + 1} of {self.games} finished', file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load test with simulated Telegram players')
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--players', type=int, default=100)
+    parser.add_argument('--lobbies', type=int, default=1)
+    parser.add_argument('--games', type=int, default=1, help='games played in a row by every lobby')
+    parser.add_argument('--id-base', type=int, default=700000000,
+                        help='first synthetic chat_id; change it to start with fresh balances')
+    parser.add_argument('--bot-token', default=TELEGRAM_BOT_TOKEN)
+    parser.add_argument('--origin', default=FRONTEND_URL, help='Origin header, must pass the CORS check of Socket.IO')
+    parser.add_argument('--concurrency', type=int, default=50, help='players logging in at the same time')
+    parser.add_argument('--think-time', type=float, default=3.0, help='max pause before a choice, seconds')
+    parser.add_argument('--stay-probability', type=float, default=0.5)
+    parser.add_argument('--http-timeout', type=float, default=30.0)
+    parser.add_argument('--game-timeout', type=float, default=600.0)
+    parser.add_argument('--max-error-rate', type=float, default=0.0)
+    args = parser.parse_args(argv)
+
+    run = LoadRun(args)
+    started = time.monotonic()
+    run.run()
+    print(f'\n{args.players} players, {args.lobbies} lobbies, {args.games} games in {time.monotonic() - started:.1f}s')
+    run.stats.report()
+    total = sum(run.stats.calls.values())
+    return 1 if run.stats.error_count() > args.max_error_rate * total else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,84 @@
+import atexit
+import copy
+import json
+import logging
+import sys
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+
+from eventlet import patcher
+
+# Настоящие очередь и поток ОС: запись в stderr идёт мимо хаба eventlet
+_queue = patcher.original('queue')
+_threading = patcher.original('threading')
+
+# Поля контекста игры, которые выводятся отдельными ключами
+CONTEXT_FIELDS = ('lobby_id', 'game_session_id', 'round_number')
+
+
+def log_fields(**fields):
+    """extra для записи лога: поля контекста без пустых значений"""
+    return {name: value for name, value in fields.items() if value is not None}
+
+
+class StructuredFormatter(logging.Formatter):
+    """Строка `время уровень логгер сообщение key=value` или JSON-объект на строку"""
+
+    def __init__(self, json_lines=False):
+        super().__init__()
+        self.json_lines = json_lines
+
+    def format(self, record):
+        fields = {name: getattr(record, name) for name in CONTEXT_FIELDS
+                  if getattr(record, name, None) is not None}
+        timestamp = datetime.utcfromtimestamp(record.created).isoformat(timespec='milliseconds') + 'Z'
+        if self.json_lines:
+            entry = {'ts': timestamp, 'level': record.levelname, 'logger': record.name,
+                     'msg': record.getMessage(), **fields}
+            if record.exc_text:
+                entry['exc'] = record.exc_text
+            return json.dumps(entry, ensure_ascii=False, default=str)
+        line = f'{timestamp} {record.levelname} {record.name} {record.getMessage()}'
+        if fields:
+            line += ' ' + ' '.join(f'{name}={value}' for name, value in fields.items())
+        if record.exc_text:
+            line += '\n' + record.exc_text
+        return line
+
+
+class DeferredQueueHandler(QueueHandler):
+    """Кладёт запись в очередь: в гринлете только склейка сообщения и трейсбек"""
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        record.stack_info = None
+        return record
+
+
+class ThreadQueueListener(QueueListener):
+    """QueueListener в потоке ОС, даже если threading пропатчен eventlet"""
+
+    def start(self):
+        self._thread = _threading.Thread(target=self._monitor, name='log-writer', daemon=True)
+        self._thread.start()
+
+
+def setup_logging(level='INFO', fmt='text', stream=None):
+    """Настраивает корневой логгер на запись через очередь; повторный вызов ничего не делает"""
+    root = logging.getLogger()
+    if any(isinstance(handler, DeferredQueueHandler) for handler in root.handlers):
+        return None
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(StructuredFormatter(json_lines=fmt == 'json'))
+    queue = _queue.SimpleQueue()
+    listener = ThreadQueueListener(queue, output, respect_handler_level=False)
+    listener.start()
+    atexit.register(listener.stop)
+    root.handlers[:] = [DeferredQueueHandler(queue)]
+    root.setLevel(level.upper())
+    return listener
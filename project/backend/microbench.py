@@ -0,0 +1,271 @@
+"""Микробенчмарки горячих функций: initData, правила игры, сериализация моделей и событий.
+
+    python microbench.py                 # сравнить с microbench_baseline.json
+    python microbench.py --save          # записать текущие результаты как базу
+    python microbench.py --only to_dict --sizes 2 1000
+
+Каждая функция, зависящая от числа игроков, меряется на размерах от 2 до
+100 000. Время вызова — минимум из нескольких повторов timeit; сравнение с
+базой идёт в единицах эталонной нагрузки, замеренной рядом с каждым
+бенчмарком. Код выхода 1, если результат медленнее базы больше чем на
+--threshold и после повторных замеров (--confirm). База зависит от
+машины: после смены железа или версии Python её нужно перезаписать (--save).
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import timeit
+from datetime import datetime
+from types import SimpleNamespace
+from urllib.parse import urlencode
+
+# Окружение до импорта app: своя база и тихие логи, профилировщик SQL не нужен
+DB_FILE = os.path.join(tempfile.mkdtemp(prefix='microbench-'), 'bench.sqlite')
+os.environ['DATABASE_URL'] = f'sqlite:///{DB_FILE}'
+os.environ['MIGRATE_ON_STARTUP'] = 'true'
+os.environ['MULTI_WORKER'] = 'false'
+os.environ.setdefault('SESSION_SECRET', 'microbench-session-secret')
+os.environ['SQL_PROFILE'] = 'false'
+os.environ.setdefault('LOG_LEVEL', 'ERROR')
+
+import app as A
+import fastjson
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'microbench_baseline.json')
+SIZES = (2, 100, 1000, 10000, 100000)
+
+
+def init_data(chat_id, first_name):
+    """Подписанный initData Telegram Web App тем же токеном, что у app"""
+    fields = {
+        'auth_date': str(int(time.time())),
+        'query_id': 'microbench',
+        'user': json.dumps({'id': chat_id, 'first_name': first_name}),
+    }
+    check_string = '\n'.join(f'{key}={value}' for key, value in sorted(fields.items()))
+    secret = hmac.new(b'WebAppData', A.TELEGRAM_BOT_TOKEN.encode(), hashlib.sha256).digest()
+    fields['hash'] = hmac.new(secret, check_string.encode(), hashlib.sha256).hexdigest()
+    return urlencode(fields)
+
+
+def user_ids(size):
+    return [str(100000000 + i) for i in range(size)]
+
+
+def player_statuses(size):
+    now = datetime.utcnow()
+    return [A.PlayerGameStatus(id=i + 1, game_session_id=1, user_id=user_id, status='active',
+                               total_coins_earned=0, created_at=now)
+            for i, user_id in enumerate(user_ids(size))]
+
+
+def game_state(size):
+    game_session = SimpleNamespace(id=1, lobby_id='bench', status='playing', current_round=1,
+                                   total_rounds=A.calculate_total_rounds(size), started_at=datetime.utcnow(),
+                                   finished_at=None, winner_id=None, initial_bank=size, rng_seed=42)
+    return A.GameState(game_session, player_statuses(size))
+
+
+def round_choices(ids):
+    # Часть игроков не успевает выбрать: ветка «без выбора» тоже в замере
+    rng = random.Random(len(ids))
+    return {user_id: rng.choice(('stay', 'stay', 'leave')) for user_id in ids if rng.random() < 0.9}
+
+
+def bench_verify_telegram(size):
+    data = init_data(100000000, 'Bench')
+    assert A.verify_telegram_webapp_data(data) is not None
+    return lambda: A.verify_telegram_webapp_data(data)
+
+
+def bench_total_rounds(size):
+    return lambda: A.calculate_total_rounds(size)
+
+
+def bench_eliminate(size):
+    engine = A.EliminationEngine(42)
+    ids = user_ids(size)
+    return lambda: engine.eliminate(ids, 1)
+
+
+def bench_split_by_choice(size):
+    state = game_state(size)
+    players = state.active_players()
+    choices = round_choices(list(state.players))
+    return lambda: A.split_by_choice(players, choices)
+
+
+def bench_choices_op(size):
+    state = game_state(size)
+    for user_id, choice in round_choices(list(state.players)).items():
+        state.add_choice(1, user_id, choice)
+    return lambda: state.choices_op(1)
+
+
+def bench_user_to_dict(size):
+    users = [A.User(chat_id=user_id, user_id=user_id, nickname=f'Player {user_id}', first_name='Player',
+                    last_name=None, username=f'p{user_id}', balance=10, is_admin=False)
+             for user_id in user_ids(size)]
+    return lambda: [user.to_dict() for user in users]
+
+
+def bench_lobby_to_dict(size):
+    now = datetime.utcnow()
+    entries = [A.Lobby(lobby_id='bench', chat_id=user_id, user_id=user_id, nickname=f'Player {user_id}',
+                       joined_at=now, is_active=True, is_admin=False, is_observer=False, is_ready=True)
+               for user_id in user_ids(size)]
+    return lambda: [entry.to_dict() for entry in entries]
+
+
+def bench_status_to_dict(size):
+    statuses = player_statuses(size)
+    return lambda: [status.to_dict() for status in statuses]
+
+
+def bench_statuses(size):
+    state = game_state(size)
+    return state.statuses
+
+
+def bench_status_update_payload(size):
+    state = game_state(size)
+    # Так пакет сокета кодирует данные события: статусы собираются и пишутся на каждый emit
+    return lambda: fastjson.dumps({'statuses': state.statuses()}, separators=(',', ':'))
+
+
+def bench_game_result_payload(size):
+    state = game_state(size)
+    winner = next(iter(state.players))
+    return lambda: fastjson.dumps({
+        'winner_id': winner,
+        'game_session': state.to_dict(),
+        'player_statistics': state.statuses(),
+        'game_finished': True
+    }, separators=(',', ':'))
+
+
+# Имя -> (подготовка(size) -> вызов без аргументов, зависит ли от числа игроков)
+BENCHMARKS = {
+    'verify_telegram_webapp_data': (bench_verify_telegram, False),
+    'calculate_total_rounds': (bench_total_rounds, True),
+    'EliminationEngine.eliminate': (bench_eliminate, True),
+    'split_by_choice': (bench_split_by_choice, True),
+    'GameState.choices_op': (bench_choices_op, True),
+    'User.to_dict': (bench_user_to_dict, True),
+    'Lobby.to_dict': (bench_lobby_to_dict, True),
+    'PlayerGameStatus.to_dict': (bench_status_to_dict, True),
+    'GameState.statuses': (bench_statuses, True),
+    'player_status_update payload': (bench_status_update_payload, True),
+    'game_result payload': (bench_game_result_payload, True),
+}
+
+
+def measure(call, repeat):
+    """Лучшее время одного вызова, секунд: число вызовов подбирается на ~0.2 с"""
+    timer = timeit.Timer(call)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+# Эталонная нагрузка на чистом Python: словарь из тысячи строк
+_CALIBRATION_KEYS = [str(i) for i in range(1000)]
+
+
+def calibrate(repeat):
+    """Время эталонной нагрузки сейчас: поправка на скорость машины, которая
+    на общих и виртуальных хостах плавает в разы за время прогона"""
+    timer = timeit.Timer(lambda: {key: len(key) for key in _CALIBRATION_KEYS})
+    return min(timer.repeat(repeat=repeat, number=100)) / 100
+
+
+def machine():
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'cpu': platform.processor()}
+
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def relative(result, reference):
+    """Во сколько раз результат медленнее базы с поправкой на скорость машины"""
+    return (result['seconds'] / result['calibration']) / (reference['seconds'] / reference['calibration'])
+
+
+def format_time(seconds):
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale:
+            return f'{seconds / scale:.2f} {unit}'
+    return f'{seconds / 1e-9:.0f} ns'
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Microbenchmarks of the game-rule and auth hot functions')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--only', help='run benchmarks whose name contains this text')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--threshold', type=float, default=0.5, help='allowed slowdown against the baseline, 0.5 = 50%%')
+    parser.add_argument('--confirm', type=int, default=3, help='re-measurements before reporting a regression')
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--save', action='store_true', help='store the results as the new baseline')
+    args = parser.parse_args(argv)
+
+    baseline = load_baseline(args.baseline)
+    expected = (baseline or {}).get('results', {})
+    if baseline and baseline.get('machine') != machine():
+        print(f'warning: baseline was recorded on {baseline.get("machine")}, comparison is approximate', file=sys.stderr)
+
+    results = {}
+    regressions = 0
+    print(f'{"benchmark":<40} {"per call":>12} {"baseline":>12} {"ratio":>7}')
+    for name, (setup, sized) in BENCHMARKS.items():
+        if args.only and args.only not in name:
+            continue
+        for size in (args.sizes if sized else (None,)):
+            key = f'{name}[{size}]' if sized else name
+            call = setup(size)
+            reference = expected.get(key)
+            result = None
+            # Выброс на шумной машине не считается: подозрение на регрессию перемеряется
+            for _ in range(1 + args.confirm):
+                seconds = measure(call, args.repeat)
+                calibration = calibrate(args.repeat)
+                if result is None or seconds / calibration < result['seconds'] / result['calibration']:
+                    result = {'seconds': seconds, 'calibration': calibration}
+                if not reference or relative(result, reference) <= 1 + args.threshold:
+                    break
+            results[key] = result
+            if reference:
+                ratio = relative(result, reference)
+                verdict = 'REGRESSION' if ratio > 1 + args.threshold else ''
+                regressions += bool(verdict)
+                print(f'{key:<40} {format_time(result["seconds"]):>12} {format_time(reference["seconds"]):>12} '
+                      f'{ratio:>6.2f}x {verdict}')
+            else:
+                print(f'{key:<40} {format_time(result["seconds"]):>12} {"-":>12} {"-":>7}')
+
+    if args.save:
+        # Сохраняются и ключи, не попавшие в этот прогон (--only, --sizes)
+        stored = dict(expected, **results)
+        with open(args.baseline, 'w') as f:
+            json.dump({'machine': machine(), 'results': stored}, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f'baseline saved to {args.baseline}')
+        return 0
+    if baseline is None:
+        print('no baseline yet: run with --save to store one')
+    print(f'{len(results)} benchmarks, {regressions} regressions')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
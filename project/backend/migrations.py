@@ -0,0 +1,222 @@
+import logging
+import sys
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, func, inspect, select, text
+
+log = logging.getLogger(__name__)
+
+# Ключ pg_advisory_lock: одновременно мигрирует только один процесс
+MIGRATION_LOCK_KEY = 7340521
+
+schema_meta = MetaData()
+
+schema_version = Table(
+    'schema_version', schema_meta,
+    Column('version', Integer, primary_key=True),
+    Column('name', String(120), nullable=False),
+    Column('applied_at', DateTime, nullable=False),
+)
+
+MIGRATIONS = []
+
+
+def migration(version, name):
+    """Регистрирует функцию fn(conn, metadata) как миграцию с номером version"""
+    def decorator(fn):
+        MIGRATIONS.append((version, name, fn))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return fn
+    return decorator
+
+
+def create_index(conn, table, name, columns, unique=False, where=None):
+    """Создаёт индекс (частичный, если задан where), если индекса или ограничения с таким именем ещё нет"""
+    inspector = inspect(conn)
+    existing = {ix['name'] for ix in inspector.get_indexes(table)}
+    existing |= {uq['name'] for uq in inspector.get_unique_constraints(table)}
+    if name in existing:
+        return False
+    kind = 'UNIQUE INDEX' if unique else 'INDEX'
+    condition = f' WHERE {where}' if where else ''
+    conn.execute(text(f'CREATE {kind} {name} ON {table} ({", ".join(columns)}){condition}'))
+    return True
+
+
+def add_column(conn, table, column, ddl):
+    """Добавляет колонку без пересоздания таблицы, если её ещё нет"""
+    if column in {c['name'] for c in inspect(conn).get_columns(table)}:
+        return False
+    conn.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} {ddl}'))
+    return True
+
+
+def drop_unique(conn, metadata, table, columns):
+    """Снимает ограничение уникальности ровно по columns.
+
+    В PostgreSQL это DROP CONSTRAINT, SQLite так не умеет: таблица
+    пересоздаётся по модели с переносом строк.
+    """
+    inspector = inspect(conn)
+    constraints = [uq['name'] for uq in inspector.get_unique_constraints(table)
+                   if uq['column_names'] == list(columns)]
+    if not constraints:
+        return False
+    if conn.dialect.name == 'sqlite':
+        rebuild_sqlite_table(conn, metadata, table)
+    else:
+        for name in constraints:
+            conn.execute(text(f'ALTER TABLE {table} DROP CONSTRAINT {name}'))
+    return True
+
+
+def rebuild_sqlite_table(conn, metadata, table):
+    columns = {c['name'] for c in inspect(conn).get_columns(table)}
+    for ix in inspect(conn).get_indexes(table):
+        conn.execute(text(f'DROP INDEX {ix["name"]}'))
+    # Внешние ключи других таблиц продолжают ссылаться на имя table, а не на _old
+    conn.execute(text('PRAGMA legacy_alter_table = ON'))
+    conn.execute(text(f'ALTER TABLE {table} RENAME TO {table}_old'))
+    model = metadata.tables[table]
+    model.create(conn)
+    kept = ', '.join(c.name for c in model.columns if c.name in columns)
+    conn.execute(text(f'INSERT INTO {table} ({kept}) SELECT {kept} FROM {table}_old'))
+    conn.execute(text(f'DROP TABLE {table}_old'))
+    conn.execute(text('PRAGMA legacy_alter_table = OFF'))
+
+
+def delete_duplicates(conn, table, columns):
+    """Оставляет по одной строке (с минимальным id) на каждый набор columns"""
+    cols = ', '.join(columns)
+    conn.execute(text(
+        f'DELETE FROM {table} WHERE id NOT IN '
+        f'(SELECT keep_id FROM (SELECT MIN(id) AS keep_id FROM {table} GROUP BY {cols}) AS keep)'
+    ))
+
+
+@migration(1, 'initial schema')
+def initial_schema(conn, metadata):
+    # Базовые таблицы моделей; существующие не трогаем
+    metadata.create_all(conn, checkfirst=True)
+
+
+@migration(2, 'hot path indexes and unique constraints')
+def hot_path_indexes(conn, metadata):
+    create_index(conn, 'lobby', 'ix_lobby_chat_id_is_active', ['chat_id', 'is_active'])
+    create_index(conn, 'lobby', 'ix_lobby_lobby_id_is_active', ['lobby_id', 'is_active'])
+    create_index(conn, 'game_session', 'ix_game_session_status', ['status'])
+    create_index(conn, 'game_round', 'ix_game_round_session_round', ['game_session_id', 'round_number'])
+    create_index(conn, 'player_game_status', 'ix_player_game_status_session_status', ['game_session_id', 'status'])
+
+    delete_duplicates(conn, 'player_game_status', ['game_session_id', 'user_id'])
+    create_index(conn, 'player_game_status', 'uq_player_game_status_session_user',
+                 ['game_session_id', 'user_id'], unique=True)
+    delete_duplicates(conn, 'player_choice', ['game_session_id', 'round_number', 'user_id'])
+    create_index(conn, 'player_choice', 'uq_player_choice_session_round_user',
+                 ['game_session_id', 'round_number', 'user_id'], unique=True)
+
+
+@migration(3, 'coin ledger')
+def coin_ledger(conn, metadata):
+    metadata.tables['coin_ledger'].create(conn, checkfirst=True)
+    # Открывающие записи, чтобы сумма журнала сходилась с текущими балансами
+    conn.execute(text(
+        "INSERT INTO coin_ledger (user_id, delta, reason, created_at) "
+        "SELECT user_id, balance, 'opening', :now FROM \"user\" "
+        "WHERE balance IS NOT NULL AND balance != 0 "
+        "AND user_id NOT IN (SELECT user_id FROM coin_ledger)"
+    ), {'now': datetime.utcnow()})
+
+
+@migration(4, 'game session rng seed')
+def game_session_rng_seed(conn, metadata):
+    add_column(conn, 'game_session', 'rng_seed', 'BIGINT')
+
+
+@migration(5, 'game leases')
+def game_leases(conn, metadata):
+    metadata.tables['game_lease'].create(conn, checkfirst=True)
+
+
+@migration(6, 'game round candidates')
+def game_round_candidates(conn, metadata):
+    add_column(conn, 'game_round', 'candidates', 'TEXT')
+
+
+@migration(7, 'lobby countdowns')
+def lobby_countdowns(conn, metadata):
+    metadata.tables['lobby_countdown'].create(conn, checkfirst=True)
+
+
+@migration(8, 'archived game sessions')
+def archived_game_sessions(conn, metadata):
+    # Прошлые игры лобби не удаляются, а уходят в архив: уникальна только текущая сессия
+    add_column(conn, 'game_session', 'archived', 'BOOLEAN NOT NULL DEFAULT FALSE')
+    drop_unique(conn, metadata, 'game_session', ['lobby_id'])
+    create_index(conn, 'game_session', 'uq_game_session_lobby_current', ['lobby_id'],
+                 unique=True, where='NOT archived')
+
+
+@migration(9, 'unique game rounds')
+def unique_game_rounds(conn, metadata):
+    # Раунд сессии записывается один раз; уникальный индекс заменяет обычный
+    delete_duplicates(conn, 'game_round', ['game_session_id', 'round_number'])
+    create_index(conn, 'game_round', 'uq_game_round_session_round',
+                 ['game_session_id', 'round_number'], unique=True)
+    conn.execute(text('DROP INDEX IF EXISTS ix_game_round_session_round'))
+
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(conn):
+    if not inspect(conn).has_table('schema_version'):
+        return 0
+    return conn.execute(select(func.max(schema_version.c.version))).scalar() or 0
+
+
+def run_migrations(engine, metadata):
+    """Применяет недостающие миграции по порядку, каждую в своей транзакции.
+
+    Возвращает список применённых версий.
+    """
+    applied = []
+    with engine.connect() as conn:
+        locked = conn.dialect.name == 'postgresql'
+        if locked:
+            conn.execute(text('SELECT pg_advisory_lock(:key)'), {'key': MIGRATION_LOCK_KEY})
+            conn.commit()
+        try:
+            with conn.begin():
+                schema_meta.create_all(conn, checkfirst=True)
+            with conn.begin():
+                done = set(conn.execute(select(schema_version.c.version)).scalars())
+            for version, name, fn in MIGRATIONS:
+                if version in done:
+                    continue
+                with conn.begin():
+                    fn(conn, metadata)
+                    conn.execute(schema_version.insert().values(
+                        version=version, name=name, applied_at=datetime.utcnow()
+                    ))
+                applied.append(version)
+                log.info("Applied migration %s: %s", version, name)
+        finally:
+            if locked:
+                conn.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': MIGRATION_LOCK_KEY})
+                conn.commit()
+    return applied
+
+
+if __name__ == '__main__':
+    # Ручной прогон при деплое: python migrations.py
+    from app import app, db
+    try:
+        with app.app_context():
+            applied = run_migrations(db.engine, db.metadata)
+            with db.engine.connect() as conn:
+                version = current_version(conn)
+        print(f"Schema version {version}, applied: {applied or 'none'}")
+    except Exception:
+        log.exception("Error running migrations")
+        sys.exit(1)
@@ -0,0 +1,301 @@
+"""Проверка режима MULTI_WORKER: два воркера в одном процессе на общей SQLite-базе.
+
+    python multiworker_check.py
+
+Воркеры — два экземпляра модуля app с разными WORKER_ID. Очередь сообщений
+Socket.IO заменена очередью в процессе: emit и смена комнат доходят до
+менеджеров обоих воркеров сразу, поэтому прогон повторяем. Проверяется, что
+состав лобби рассылается снимками без версий дельт, выход из лобби через
+HTTP на одном воркере выводит из комнаты сокет другого, а отсчёт лобби,
+перезапущенный на другом воркере, останавливает прежний. Игру, брошенную
+воркером посреди раунда, другой подхватывает без повтора раунда, и её
+жеребьёвка воспроизводится по зерну. Код выхода 1 при любом нарушении.
+"""
+import importlib
+import importlib.util
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+# Окружение до импорта app: своя база, тихие логи
+DB_FILE = os.path.join(tempfile.mkdtemp(prefix='multiworker-'), 'workers.sqlite')
+os.environ['DATABASE_URL'] = f'sqlite:///{DB_FILE}'
+os.environ['MIGRATE_ON_STARTUP'] = 'true'
+os.environ['MULTI_WORKER'] = 'true'
+os.environ.setdefault('SESSION_SECRET', 'multiworker-session-secret')
+os.environ['SQL_PROFILE'] = 'false'
+os.environ.setdefault('LOG_LEVEL', 'ERROR')
+
+import eventlet
+eventlet.monkey_patch()
+
+import socketio
+
+import config
+
+LOBBY_ID = 'multiworker'
+PLAYERS = ('800000001', '800000002', '800000003')
+# Игра, которую подхватывает второй воркер: три раунда до победителя
+TAKEOVER_LOBBY_ID = 'takeover'
+TAKEOVER_PLAYERS = tuple(str(800000100 + i) for i in range(8))
+
+
+class InProcessQueue:
+    """Очередь сообщений Socket.IO внутри процесса вместо Redis/AMQP"""
+
+    def __init__(self):
+        self.managers = []
+
+    def attach(self, flask_socketio):
+        manager = QueueManager(self)
+        flask_socketio.server.manager = manager
+        manager.set_server(flask_socketio.server)
+        self.managers.append(manager)
+
+
+class QueueManager(socketio.Manager):
+    """Менеджер воркера: как PubSubManager, но сообщения другим воркерам доставляются сразу"""
+
+    def __init__(self, queue):
+        super().__init__()
+        self.queue = queue
+
+    def emit(self, event, data, namespace, room=None, skip_sid=None, callback=None, **kwargs):
+        for manager in self.queue.managers:
+            socketio.Manager.emit(manager, event, data, namespace, room=room, skip_sid=skip_sid,
+                                  callback=callback if manager is self else None, **kwargs)
+
+    def enter_room(self, sid, namespace, room, eio_sid=None):
+        for manager in self.owners(sid, namespace):
+            socketio.Manager.enter_room(manager, sid, namespace, room, eio_sid=eio_sid)
+
+    def leave_room(self, sid, namespace, room):
+        for manager in self.owners(sid, namespace):
+            socketio.Manager.leave_room(manager, sid, namespace, room)
+
+    def owners(self, sid, namespace):
+        # Свой сокет меняется на месте, чужой — на воркере, где он подключён
+        if self.is_connected(sid, namespace):
+            return [self]
+        return [manager for manager in self.queue.managers if manager.is_connected(sid, namespace)]
+
+
+def load_worker(worker_id):
+    """Отдельный экземпляр app со своим WORKER_ID"""
+    os.environ['WORKER_ID'] = worker_id
+    importlib.reload(config)
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py')
+    spec = importlib.util.spec_from_file_location(f'app_{worker_id}', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    # Отсчёты длиннее прогона: ресинк и финиш вызываются явно
+    module.LOBBY_TIME = module.ROUND_TIME = module.CHOICE_TIME = 3600
+    return module
+
+
+class Worker:
+    def __init__(self, module):
+        self.app = module
+        self.client = module.app.test_client()
+
+    def token(self, chat_id):
+        """Токен сессии игрока; секрет у воркеров общий, подходит любому из них"""
+        return self.app.session_tokens.issue(
+            {'chat_id': chat_id, 'user_id': chat_id, 'nickname': f'p{chat_id}', 'is_admin': False})
+
+    def post(self, url, as_user=None, **kwargs):
+        """POST от имени игрока as_user (с его токеном) или без пользователя"""
+        if as_user is not None:
+            kwargs['headers'] = {'Authorization': f'Bearer {self.token(as_user)}'}
+        return self.client.post(url, **kwargs)
+
+    def socket(self, chat_id):
+        """Сокет игрока на этом воркере, уже в лобби; входящие события сброшены"""
+        sock = self.app.socketio.test_client(
+            self.app.app, flask_test_client=self.client, auth={'token': self.token(chat_id)})
+        sock.emit('join_lobby', {'chat_id': chat_id, 'lobby_id': LOBBY_ID})
+        sock.get_received()
+        return sock
+
+    def rooms(self, sock):
+        server = self.app.socketio.server
+        return set(server.rooms(server.manager.sid_from_eio_sid(sock.eio_sid, '/'), namespace='/'))
+
+
+def events(sock, name):
+    return [event['args'][0] for event in sock.get_received() if event['name'] == name]
+
+
+class Check:
+    def __init__(self):
+        self.failures = []
+        self.count = 0
+
+    def expect(self, ok, message):
+        self.count += 1
+        if not ok:
+            self.failures.append(message)
+
+
+def seed(worker):
+    with worker.app.app.app_context():
+        worker.app.db.session.execute(worker.app.db.insert(worker.app.User), [
+            {'chat_id': chat_id, 'user_id': chat_id, 'nickname': f'p{chat_id}', 'balance': 10}
+            for chat_id in PLAYERS + TAKEOVER_PLAYERS
+        ])
+        worker.app.db.session.execute(worker.app.db.insert(worker.app.Lobby), [
+            {'lobby_id': TAKEOVER_LOBBY_ID, 'chat_id': chat_id, 'user_id': chat_id, 'nickname': f'p{chat_id}',
+             'is_ready': True, 'is_active': True}
+            for chat_id in TAKEOVER_PLAYERS
+        ])
+        worker.app.db.session.commit()
+
+
+def check_lobby_snapshots(check, a, b, sock_a):
+    # Вход на воркере B: сокет на A получает полный снимок, дельт с версиями нет
+    b.post('/api/lobby/join', json={'chat_id': PLAYERS[1], 'lobby_id': LOBBY_ID}, as_user=PLAYERS[1])
+    received = sock_a.get_received()
+    names = [event['name'] for event in received]
+    check.expect('lobby_delta' not in names, f'lobby_delta sent in multi-worker mode: {names}')
+    snapshots = [event['args'][0] for event in received if event['name'] == 'lobby_update']
+    members = {player['chat_id'] for player in snapshots[-1]['players']} if snapshots else set()
+    check.expect(members == {PLAYERS[0], PLAYERS[1]},
+                 f'join on another worker: lobby_update members {sorted(members)}')
+
+
+def check_leave_moves_remote_socket(check, a, b, sock_a):
+    room = a.app.lobby_room(LOBBY_ID)
+    b.post('/api/lobby/unready', json={'chat_id': PLAYERS[0]}, as_user=PLAYERS[0])
+    response = b.post('/api/lobby/leave', json={'chat_id': PLAYERS[0]}, as_user=PLAYERS[0])
+    check.expect(response.status_code == 200, f'leave on another worker -> {response.status_code}')
+    changed = events(sock_a, 'lobby_room_changed')
+    check.expect(changed == [{'lobby_id': None}], f'lobby_room_changed for the remote socket: {changed}')
+    # Ответ клиента, как в socketService: сверка комнаты на воркере сокета
+    sock_a.emit('sync_lobby_room')
+    check.expect(room not in a.rooms(sock_a), f'socket left on another worker still in {room}')
+    sock_a.get_received()
+    b.post('/api/lobby/join', json={'chat_id': PLAYERS[2], 'lobby_id': LOBBY_ID}, as_user=PLAYERS[2])
+    leaked = [event['name'] for event in sock_a.get_received() if event['name'] in ('lobby_update', 'lobby_delta')]
+    check.expect(not leaked, 'socket that left the lobby still receives its updates')
+
+
+def check_lobby_countdown(check, a, b, sock_b):
+    response = a.post(f'/api/admin/lobby/{LOBBY_ID}/start_timer')
+    check.expect(response.status_code == 200, f'start_timer on worker A -> {response.status_code}')
+    started = events(sock_b, 'timer_update')
+    check.expect(len(started) == 1, f'timer_update reached the socket on worker B {len(started)} times')
+    # Отсчёт идёт на A, сокет спрашивает у B
+    sock_b.emit('request_timer', {'lobby_id': LOBBY_ID})
+    answer = events(sock_b, 'timer_update')
+    check.expect(bool(started) and len(answer) == 1 and answer[0].get('deadline') == started[0]['deadline'],
+                 f'request_timer on worker B: {answer} for countdown {started}')
+
+    # Перезапуск на B: отсчёт A на ближайшем ресинке останавливается без рассылки
+    b.post(f'/api/admin/lobby/{LOBBY_ID}/start_timer')
+    restarted = events(sock_b, 'timer_update')
+    countdown_a = a.app.lobby_countdowns.get(LOBBY_ID)
+    check.expect(countdown_a is not None, 'worker A lost its countdown before the resync')
+    if countdown_a is not None:
+        a.app.lobby_timer_resync(LOBBY_ID, countdown_a)
+        check.expect(LOBBY_ID not in a.app.lobby_countdowns and not countdown_a.running,
+                     'superseded countdown keeps running on worker A')
+        stale = events(sock_b, 'timer_update')
+        check.expect(not stale, f'superseded countdown still sends timer_update: {stale}')
+    sock_b.emit('request_timer', {'lobby_id': LOBBY_ID})
+    answer = events(sock_b, 'timer_update')
+    check.expect(bool(restarted) and len(answer) == 1 and answer[0].get('deadline') == restarted[-1]['deadline'],
+                 f'request_timer after the restart: {answer} for countdown {restarted}')
+    for worker in (a, b):
+        for countdown in worker.app.lobby_countdowns.values():
+            countdown.cancel()
+        worker.app.lobby_countdowns.clear()
+
+
+def play_phase(worker, game_session_id):
+    """Завершает текущую фазу игры на воркере, как истёкший таймер; в фазе выбора все остаются"""
+    runner = worker.app.game_runners[game_session_id]
+    phase, round_number, active = runner.phase, runner.round_number, runner.active_players
+    if phase == 'choice':
+        for player in active:
+            worker.post('/api/game/choice', json={
+                'chat_id': player.user_id, 'game_session_id': game_session_id,
+                'round_number': round_number, 'choice': 'stay'
+            }, as_user=player.user_id)
+    with worker.app.app.app_context():
+        if phase == 'round':
+            worker.app.finish_round(game_session_id, round_number)
+        else:
+            worker.app.finish_choice_phase(game_session_id, round_number, active)
+
+
+def check_game_takeover(check, a, b):
+    # Игра идёт на A; после жеребьёвки первого раунда A перестаёт продлевать аренду
+    response = a.post(f'/api/admin/lobby/{TAKEOVER_LOBBY_ID}/start')
+    check.expect(response.status_code == 200, f'game start on worker A -> {response.status_code}')
+    if response.status_code != 200:
+        return
+    game_session_id = response.get_json()['game_session']['id']
+    play_phase(a, game_session_id)
+    a.app.game_persister.flush()
+    with a.app.game_runners_lock:
+        runner_a = a.app.game_runners.pop(game_session_id)
+    runner_a.countdown.cancel()
+
+    # Аренда истекла: B подхватывает игру в той же фазе, что бросил A
+    with b.app.app.app_context():
+        b.app.db.session.execute(b.app.GameLease.__table__.update().values(
+            expires_at=datetime.utcnow() - timedelta(seconds=1)))
+        b.app.db.session.commit()
+        b.app.adopt_orphan_games()
+    runner_b = b.app.game_runners.get(game_session_id)
+    check.expect(runner_b is not None, 'worker B did not adopt the orphaned game')
+    if runner_b is None:
+        return
+    check.expect((runner_b.phase, runner_b.round_number) == ('choice', 1),
+                 f'adopted game resumed in {runner_b.phase} {runner_b.round_number}, not in choice 1')
+
+    state = b.app.get_game_state(game_session_id)
+    for _ in range(10):
+        if state.status != 'playing':
+            break
+        play_phase(b, game_session_id)
+    b.app.game_persister.flush()
+    check.expect(state.status == 'finished', f'adopted game ended as {state.status}')
+
+    with b.app.app.app_context():
+        rounds = [number for (number,) in b.app.db.session.query(b.app.GameRound.round_number).filter_by(
+            game_session_id=game_session_id).order_by(b.app.GameRound.round_number)]
+        eliminated_in_first = b.app.PlayerGameStatus.query.filter_by(
+            game_session_id=game_session_id, eliminated_in_round=1).count()
+    check.expect(rounds == list(range(1, len(rounds) + 1)) and len(rounds) == 3,
+                 f'game rounds after the takeover: {rounds}')
+    check.expect(eliminated_in_first == len(TAKEOVER_PLAYERS) // 2,
+                 f'{eliminated_in_first} players eliminated in round 1')
+    replay = b.client.get(f'/api/admin/game/{game_session_id}/replay').get_json()
+    check.expect(replay.get('match') is True, f'replay after the takeover: {replay}')
+
+
+def main():
+    queue = InProcessQueue()
+    a, b = Worker(load_worker('worker-a')), Worker(load_worker('worker-b'))
+    queue.attach(a.app.socketio)
+    queue.attach(b.app.socketio)
+    seed(a)
+
+    check = Check()
+    sock_a = a.socket(PLAYERS[0])
+    check_lobby_snapshots(check, a, b, sock_a)
+    check_leave_moves_remote_socket(check, a, b, sock_a)
+    sock_b = b.socket(PLAYERS[1])
+    check_lobby_countdown(check, a, b, sock_b)
+    check_game_takeover(check, a, b)
+
+    for failure in check.failures:
+        print(f'FAIL {failure}')
+    print(f'{check.count} checks, {len(check.failures)} failures')
+    return 1 if check.failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,359 @@
+"""Бюджет SQL по маршрутам /api/*, обработчикам сокетов и жизненному циклу игры.
+
+Прогон на временной SQLite-базе:
+
+    python query_budget.py [--small 5] [--large 200] [--table]
+
+Сценарий проходит дважды — с маленьким и большим лобби. Для каждого шага
+считаются SQL-запросы и коммиты (через sql_profiler, включая отложенные
+записи игр); шаг, вызванный несколько раз, считается по худшему вызову.
+Зерно жеребьёвки фиксировано (--seed), чтобы прогоны были повторяемы. Код выхода 1, если шаг превысил бюджет из BUDGETS или с большим
+лобби делает больше запросов, чем с маленьким (N+1).
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import sys
+import tempfile
+import time
+from urllib.parse import urlencode
+
+# Окружение до импорта app: своя база, тихие логи, без N+1-предупреждений в выводе
+DB_FILE = os.path.join(tempfile.mkdtemp(prefix='query-budget-'), 'budget.sqlite')
+os.environ['DATABASE_URL'] = f'sqlite:///{DB_FILE}'
+os.environ['MIGRATE_ON_STARTUP'] = 'true'
+os.environ['MULTI_WORKER'] = 'false'
+os.environ.setdefault('SESSION_SECRET', 'query-budget-session-secret')
+os.environ['SQL_PROFILE'] = 'true'
+os.environ['SQL_REPEAT_THRESHOLD'] = '1000000'
+os.environ.setdefault('LOG_LEVEL', 'ERROR')
+
+import eventlet
+eventlet.monkey_patch()
+
+import app as A
+
+# Шаг -> (максимум запросов, максимум коммитов) на один вызов. Значения — замер
+# на момент введения бюджета; рост означает регрессию, снижение — повод ужать бюджет
+BUDGETS = {
+    'POST /api/telegram/auth': (3, 1),
+    'POST /api/lobby/join': (3, 1),
+    'GET /api/user': (0, 0),
+    'GET /api/coins/balance': (0, 0),
+    'POST /api/coins/add': (2, 1),
+    'POST /api/coins/deduct': (2, 1),
+    'GET /api/lobby/ready': (1, 0),
+    'POST /api/lobby/ready': (3, 1),
+    'POST /api/lobby/unready': (3, 1),
+    'POST /api/lobby/reset-ready': (2, 1),
+    'GET /api/lobby/players': (2, 0),
+    'GET /api/admin/lobby/players': (2, 0),
+    'GET /api/admin/lobbies': (1, 0),
+    'GET /api/admin/users': (1, 0),
+    'POST /api/admin/lobby/<lobby_id>/join': (4, 1),
+    'socket connect': (0, 0),
+    'socket join_lobby': (3, 0),
+    'socket request_lobby': (1, 0),
+    'socket sync_lobby_room': (2, 0),
+    'socket request_timer': (1, 0),
+    'socket leave_lobby': (3, 1),
+    'socket start_game': (4, 1),
+    'socket disconnect': (0, 0),
+    'socket join_admin': (1, 0),
+    # Прошлая сессия закрывается и уходит в архив: +2 запроса
+    'POST /api/admin/lobby/<lobby_id>/start': (12, 3),
+    'GET /api/game/status': (0, 0),
+    'GET /api/game/player-status': (0, 0),
+    'finish_round': (2, 1),
+    'POST /api/game/choice': (1, 0),
+    'finish_choice_phase': (3, 1),
+    'finish_game_with_winner': (6, 1),
+    'GET /api/admin/game/<int:game_session_id>/replay': (3, 0),
+    'finish_game_with_split_bank': (6, 1),
+    'finish_game_without_winner': (2, 1),
+    'POST /api/game/round/start': (2, 1),
+    'POST /api/game/round/end': (5, 2),
+    # Лобби завершённой игры (раннера уже нет) читается из сессии
+    'POST /api/game/finish': (1, 0),
+    'GET /api/data': (0, 0),
+    'GET /api/admin/cache/stats': (0, 0),
+    'GET /api/admin/scheduler/stats': (0, 0),
+    'POST /api/admin/lobby/<lobby_id>/start_timer': (1, 0),
+    'POST /api/admin/lobby/test/start_timer': (0, 0),
+    'POST /api/admin/give-coins-to-all': (2, 1),
+    'GET /api/admin/coins/reconcile': (2, 0),
+    'POST /api/admin/lobby/create': (1, 0),
+    'DELETE /api/admin/lobby/<lobby_id>/delete': (7, 1),
+    'POST /api/lobby/leave': (4, 1),
+    # Сессии не удаляются, а архивируются: закрытие незавершённых и флаг архива
+    'POST /api/lobby/clear': (3, 1),
+}
+
+ADMIN_CHAT_ID = '99999999'
+
+
+def init_data(chat_id, first_name):
+    """Подписанный initData Telegram Web App для /api/telegram/auth"""
+    fields = {
+        'auth_date': str(int(time.time())),
+        'query_id': 'budget',
+        'user': json.dumps({'id': chat_id, 'first_name': first_name}),
+    }
+    check_string = '\n'.join(f'{key}={value}' for key, value in sorted(fields.items()))
+    secret = hmac.new(b'WebAppData', A.TELEGRAM_BOT_TOKEN.encode(), hashlib.sha256).digest()
+    fields['hash'] = hmac.new(secret, check_string.encode(), hashlib.sha256).hexdigest()
+    return urlencode(fields)
+
+
+class BudgetRun:
+    """Прогон сценария для одного размера лобби; results[шаг] = (запросы, коммиты)"""
+
+    def __init__(self, size):
+        self.size = size
+        self.lobby_id = f'budget-{size}'
+        self.chat_ids = [str(size * 100000 + i) for i in range(size)]
+        self.client = A.app.test_client()
+        self.results = {}
+        self._reports = []
+
+    def measure(self, step, call):
+        """Выполняет call() и записывает запросы и коммиты всех профилей шага"""
+        self._reports.clear()
+        with A.app.app_context(), A.sql_profiler.profile('budget', step):
+            result = call()
+            # Отложенные записи игр — часть шага
+            A.game_persister.flush()
+        measured = (sum(p.queries for p in self._reports), sum(p.commits for p in self._reports))
+        previous = self.results.get(step, (0, 0))
+        self.results[step] = (max(previous[0], measured[0]), max(previous[1], measured[1]))
+        return result
+
+    def token(self, chat_id):
+        """Токен сессии игрока, как после /api/telegram/auth; подписывается вне замера"""
+        is_admin = chat_id == ADMIN_CHAT_ID
+        return A.session_tokens.issue({
+            'chat_id': chat_id, 'user_id': chat_id,
+            'nickname': 'admin' if is_admin else f'p{chat_id}', 'is_admin': is_admin
+        })
+
+    def auth(self, chat_id):
+        return {'Authorization': f'Bearer {self.token(chat_id)}'}
+
+    def http(self, step, method, url, expect=(200,), as_user=None, **kwargs):
+        """Запрос шага; as_user — chat_id, от имени которого идёт запрос с токеном"""
+        if as_user is not None:
+            kwargs['headers'] = self.auth(as_user)
+        response = self.measure(step, lambda: self.client.open(url, method=method, **kwargs))
+        if response.status_code not in expect:
+            raise AssertionError(f'{step}: {method} {url} -> {response.status_code} {response.get_data(as_text=True)[:200]}')
+        return response
+
+    def run(self):
+        A.sql_profiler.listeners.append(self._reports.append)
+        try:
+            self.seed()
+            self.lobby_steps()
+            self.socket_steps()
+            self.game_steps()
+            self.admin_steps()
+        finally:
+            A.sql_profiler.listeners.remove(self._reports.append)
+
+    def seed(self):
+        # Игроки и лобби вставляются пачкой: измеряется только вход последнего игрока
+        with A.app.app_context():
+            A.db.session.execute(A.db.insert(A.User), [
+                {'chat_id': chat_id, 'user_id': chat_id, 'nickname': f'p{chat_id}', 'balance': 100}
+                for chat_id in self.chat_ids
+            ])
+            if not A.User.query.filter_by(chat_id=ADMIN_CHAT_ID).first():
+                A.db.session.add(A.User(chat_id=ADMIN_CHAT_ID, user_id=ADMIN_CHAT_ID, nickname='admin',
+                                        balance=0, is_admin=True))
+            A.db.session.execute(A.db.insert(A.Lobby), [
+                {'lobby_id': self.lobby_id, 'chat_id': chat_id, 'user_id': chat_id, 'nickname': f'p{chat_id}',
+                 'is_active': True, 'is_ready': True}
+                for chat_id in self.chat_ids[:-1]
+            ])
+            A.db.session.commit()
+            A.bump_data_version('lobby', self.lobby_id)
+
+    def lobby_steps(self):
+        last = self.chat_ids[-1]
+        self.http('POST /api/telegram/auth', 'POST', '/api/telegram/auth',
+                  json={'initData': init_data(last, 'Budget')})
+        self.http('POST /api/lobby/join', 'POST', '/api/lobby/join', json={'chat_id': last, 'lobby_id': self.lobby_id}, as_user=last)
+        self.http('GET /api/user', 'GET', f'/api/user?chat_id={last}', as_user=last)
+        self.http('GET /api/coins/balance', 'GET', f'/api/coins/balance?chat_id={last}', as_user=last)
+        self.http('POST /api/coins/add', 'POST', '/api/coins/add', json={'chat_id': last, 'amount': 5}, as_user=last)
+        self.http('POST /api/coins/deduct', 'POST', '/api/coins/deduct', json={'chat_id': last, 'amount': 5}, as_user=last)
+        self.http('GET /api/lobby/ready', 'GET', f'/api/lobby/ready?chat_id={last}', as_user=last)
+        self.http('POST /api/lobby/ready', 'POST', '/api/lobby/ready', json={'chat_id': last}, as_user=last)
+        self.http('POST /api/lobby/unready', 'POST', '/api/lobby/unready', json={'chat_id': last}, as_user=last)
+        self.http('POST /api/lobby/reset-ready', 'POST', '/api/lobby/reset-ready', json={'chat_id': last}, as_user=last)
+        self.client.post('/api/lobby/ready', json={'chat_id': last}, headers=self.auth(last))
+        self.http('GET /api/lobby/players', 'GET', f'/api/lobby/players?lobby_id={self.lobby_id}')
+        self.http('GET /api/admin/lobby/players', 'GET', f'/api/admin/lobby/players?lobby_id={self.lobby_id}')
+        self.http('GET /api/admin/lobbies', 'GET', '/api/admin/lobbies')
+        self.http('GET /api/admin/users', 'GET', '/api/admin/users')
+        self.http('POST /api/admin/lobby/<lobby_id>/join', 'POST', f'/api/admin/lobby/{self.lobby_id}/join',
+                  json={'chat_id': ADMIN_CHAT_ID}, as_user=ADMIN_CHAT_ID)
+
+    def socket_steps(self):
+        # Обработчики выполняются в том же гринлете, чтобы попасть в профиль шага
+        A.socketio.server.async_handlers = False
+        socket = self.measure('socket connect', lambda: A.socketio.test_client(
+            A.app, flask_test_client=self.client, auth={'token': self.token(self.chat_ids[0])}))
+        data = {'chat_id': self.chat_ids[0], 'lobby_id': self.lobby_id}
+        self.measure('socket join_lobby', lambda: socket.emit('join_lobby', data))
+        self.measure('socket request_lobby', lambda: socket.emit('request_lobby', {'lobby_id': self.lobby_id}))
+        # Без lobby_id: лобби сокета ищется по его пользователю
+        self.measure('socket sync_lobby_room', lambda: socket.emit('sync_lobby_room'))
+        self.measure('socket request_timer', lambda: socket.emit('request_timer', {}))
+        self.measure('socket leave_lobby', lambda: socket.emit('leave_lobby', data))
+        self.measure('socket start_game', lambda: socket.emit('start_game', {'lobby_id': self.lobby_id}))
+        self.measure('socket disconnect', socket.disconnect)
+
+        admin = A.socketio.test_client(A.app, flask_test_client=self.client, auth={'token': self.token(ADMIN_CHAT_ID)})
+        self.measure('socket join_admin', lambda: admin.emit('join_admin', {'chat_id': ADMIN_CHAT_ID}))
+        if not any(event['name'] == 'admin_lobby_update' for event in admin.get_received()):
+            raise AssertionError('join_admin sent no admin_lobby_update')
+        admin.disconnect()
+
+    def start_game(self, measured=False):
+        """Старт игры лобби; проверяет, что статусы получили все игроки лобби"""
+        url = f'/api/admin/lobby/{self.lobby_id}/start'
+        if measured:
+            response = self.http('POST /api/admin/lobby/<lobby_id>/start', 'POST', url)
+        else:
+            response = self.client.post(url)
+        game_session_id = response.get_json()['game_session']['id']
+        with A.app.app_context():
+            players = A.Lobby.query.filter_by(lobby_id=self.lobby_id, is_active=True).join(
+                A.User, A.Lobby.chat_id == A.User.chat_id).filter(A.User.is_admin == False).count()
+            statuses = A.PlayerGameStatus.query.filter_by(game_session_id=game_session_id, status='active').count()
+        if statuses != players or len(A.get_game_state(game_session_id).players) != players:
+            raise AssertionError(f'game {game_session_id} started with {statuses} active statuses for {players} players')
+        return game_session_id
+
+    def game_steps(self):
+        # Таймеры длиннее прогона: фазы завершаются явными вызовами
+        A.ROUND_TIME = A.CHOICE_TIME = 3600
+        game_session_id = self.start_game(measured=True)
+        last = self.chat_ids[-1]
+        self.http('GET /api/game/status', 'GET', f'/api/game/status?lobby_id={self.lobby_id}')
+        self.http('GET /api/game/player-status', 'GET',
+                  f'/api/game/player-status?chat_id={last}&lobby_id={self.lobby_id}', as_user=last)
+
+        self.measure('finish_round', lambda: A.finish_round(game_session_id, 1))
+        state = A.get_game_state(game_session_id)
+        active = state.active_players()
+        # Кэш пользователей прогрет: меряется выбор, а не первый запрос игрока
+        with A.app.app_context():
+            for player in active:
+                A.find_user(user_id=player.user_id)
+        for player in active:
+            self.http('POST /api/game/choice', 'POST', '/api/game/choice', json={
+                'chat_id': player.user_id, 'game_session_id': game_session_id,
+                'round_number': 1, 'choice': 'stay'
+            }, as_user=player.user_id)
+        self.measure('finish_choice_phase', lambda: A.finish_choice_phase(game_session_id, 1, active))
+        if state.status == 'playing':
+            winner = state.active_players()[0]
+            self.measure('finish_game_with_winner', lambda: A.finish_game_with_winner(game_session_id, winner.user_id))
+        self.http('GET /api/admin/game/<int:game_session_id>/replay', 'GET', f'/api/admin/game/{game_session_id}/replay')
+
+        # Второй запуск — делёж банка, третий — игра без победителя
+        game_session_id = self.start_game()
+        state = A.get_game_state(game_session_id)
+        self.measure('finish_game_with_split_bank',
+                     lambda: A.finish_game_with_split_bank(game_session_id, state.active_players()))
+        game_session_id = self.start_game()
+        self.measure('finish_game_without_winner', lambda: A.finish_game_without_winner(game_session_id))
+
+        self.http('POST /api/game/round/start', 'POST', '/api/game/round/start',
+                  json={'game_session_id': game_session_id, 'round_number': 1})
+        self.http('POST /api/game/round/end', 'POST', '/api/game/round/end',
+                  json={'game_session_id': game_session_id, 'round_number': 1, 'eliminated_players': []})
+        self.http('POST /api/game/finish', 'POST', '/api/game/finish',
+                  json={'game_session_id': game_session_id, 'winner_id': last})
+
+    def admin_steps(self):
+        A.LOBBY_TIME = 3600
+        self.http('GET /api/data', 'GET', '/api/data')
+        self.http('GET /api/admin/cache/stats', 'GET', '/api/admin/cache/stats')
+        self.http('GET /api/admin/scheduler/stats', 'GET', '/api/admin/scheduler/stats')
+        self.http('POST /api/admin/lobby/<lobby_id>/start_timer', 'POST', f'/api/admin/lobby/{self.lobby_id}/start_timer')
+        self.http('POST /api/admin/lobby/test/start_timer', 'POST', '/api/admin/lobby/test/start_timer')
+        with A.lobby_timer_lock:
+            for countdown in A.lobby_countdowns.values():
+                countdown.cancel()
+            A.lobby_countdowns.clear()
+        self.http('POST /api/admin/give-coins-to-all', 'POST', '/api/admin/give-coins-to-all')
+        self.http('GET /api/admin/coins/reconcile', 'GET', '/api/admin/coins/reconcile')
+        self.http('POST /api/admin/lobby/create', 'POST', '/api/admin/lobby/create',
+                  json={'lobby_id': f'{self.lobby_id}-new', 'chat_id': ADMIN_CHAT_ID}, expect=(200, 201),
+                  as_user=ADMIN_CHAT_ID)
+        # Выходит игрок лобби: из готовых выйти нельзя, готовность снимается вне замера
+        last = self.chat_ids[-1]
+        self.client.post('/api/lobby/unready', json={'chat_id': last}, headers=self.auth(last))
+        self.http('POST /api/lobby/leave', 'POST', '/api/lobby/leave', json={'chat_id': last}, as_user=last)
+        self.http('DELETE /api/admin/lobby/<lobby_id>/delete', 'DELETE', f'/api/admin/lobby/{self.lobby_id}/delete')
+        self.http('POST /api/lobby/clear', 'POST', '/api/lobby/clear')
+
+
+def check(small, large):
+    """Список нарушений: превышение бюджета и рост числа запросов с размером лобби"""
+    failures = []
+    for step, (queries, commits) in large.results.items():
+        small_queries, small_commits = small.results.get(step, (queries, commits))
+        budget = BUDGETS.get(step)
+        if budget is None:
+            failures.append(f'{step}: no budget (measured {queries} queries, {commits} commits)')
+            continue
+        max_queries, max_commits = budget
+        for size, q, c in ((small.size, small_queries, small_commits), (large.size, queries, commits)):
+            if q > max_queries or c > max_commits:
+                failures.append(f'{step}: {q} queries / {c} commits with {size} players, budget {max_queries} / {max_commits}')
+        if queries > small_queries or commits > small_commits:
+            failures.append(f'{step}: grows with lobby size ({small_queries} -> {queries} queries, '
+                            f'{small_commits} -> {commits} commits)')
+    for step in BUDGETS.keys() - large.results.keys():
+        failures.append(f'{step}: budgeted but not exercised')
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--small', type=int, default=5, help='players in the small lobby')
+    parser.add_argument('--large', type=int, default=200, help='players in the large lobby')
+    parser.add_argument('--table', action='store_true', help='print measured queries and commits per step')
+    parser.add_argument('--seed', type=int, default=1, help='elimination seed of every game')
+    args = parser.parse_args()
+
+    # От зерна зависит, кто выбывает и чей выбор меряется
+    A.new_game_seed = lambda: args.seed
+
+    small, large = BudgetRun(args.small), BudgetRun(args.large)
+    small.run()
+    large.run()
+
+    if args.table:
+        width = max(len(step) for step in large.results)
+        print(f'{"step":<{width}}  {args.small:>7}  {args.large:>7}  budget')
+        for step, (queries, commits) in large.results.items():
+            small_queries, small_commits = small.results.get(step, (0, 0))
+            budget = BUDGETS.get(step)
+            budget_text = f'{budget[0]}/{budget[1]}' if budget else '-'
+            print(f'{step:<{width}}  {small_queries:>3}/{small_commits:<3}  {queries:>3}/{commits:<3}  {budget_text}')
+
+    failures = check(small, large)
+    for failure in failures:
+        print(f'FAIL {failure}')
+    print(f'{len(large.results)} steps checked, {len(failures)} failures')
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,241 @@
+import heapq
+import itertools
+import logging
+import math
+import threading
+import time
+
+import eventlet
+from eventlet.event import Event
+
+log = logging.getLogger(__name__)
+
+
+class ScheduledTimer:
+    """Отложенный вызов, зарегистрированный в TimerScheduler"""
+
+    __slots__ = ('scheduler', 'deadline', 'callback', 'args', 'name', 'seq', 'cancelled', 'fired')
+
+    def __init__(self, scheduler, deadline, callback, args, name):
+        self.scheduler = scheduler
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.name = name
+        self.seq = None
+        self.cancelled = False
+        self.fired = False
+
+    @property
+    def active(self):
+        return not self.cancelled and not self.fired
+
+    def cancel(self):
+        self.scheduler.cancel(self)
+
+    def reschedule(self, delay):
+        self.scheduler.reschedule(self, delay)
+
+
+class TimerScheduler:
+    """Один гринлет на все таймеры: куча монотонных дедлайнов.
+
+    Гринлет запускается при первом schedule() и спит до ближайшего
+    дедлайна; пока таймеров нет, он ждёт события и не просыпается.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._heap = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._wakeup = Event()
+        self._thread = None
+        self._pending = 0
+        self._stats = {
+            'scheduled': 0,
+            'fired': 0,
+            'cancelled': 0,
+            'rescheduled': 0,
+            'lag_total': 0.0,
+            'lag_max': 0.0,
+            'lag_last': 0.0,
+        }
+
+    def schedule(self, delay, callback, *args, name=None):
+        return self.schedule_at(self.clock() + delay, callback, *args, name=name)
+
+    def schedule_at(self, deadline, callback, *args, name=None):
+        timer = ScheduledTimer(self, deadline, callback, args, name)
+        with self._lock:
+            self._push(timer)
+            self._pending += 1
+            self._stats['scheduled'] += 1
+        self._ensure_running(timer)
+        return timer
+
+    def cancel(self, timer):
+        with self._lock:
+            if not timer.active:
+                return False
+            timer.cancelled = True
+            self._pending -= 1
+            self._stats['cancelled'] += 1
+            self._compact()
+        return True
+
+    def reschedule(self, timer, delay):
+        return self.reschedule_at(timer, self.clock() + delay)
+
+    def reschedule_at(self, timer, deadline):
+        with self._lock:
+            if not timer.active:
+                return False
+            # Старая запись в куче остаётся и пропускается по seq
+            timer.deadline = deadline
+            self._push(timer)
+            self._stats['rescheduled'] += 1
+            self._compact()
+        self._ensure_running(timer)
+        return True
+
+    def stats(self):
+        with self._lock:
+            fired = self._stats['fired']
+            return {
+                'pending': self._pending,
+                'heap_size': len(self._heap),
+                'scheduled': self._stats['scheduled'],
+                'fired': fired,
+                'cancelled': self._stats['cancelled'],
+                'rescheduled': self._stats['rescheduled'],
+                'lag_avg_ms': round(self._stats['lag_total'] / fired * 1000, 3) if fired else 0.0,
+                'lag_max_ms': round(self._stats['lag_max'] * 1000, 3),
+                'lag_last_ms': round(self._stats['lag_last'] * 1000, 3),
+            }
+
+    def _push(self, timer):
+        timer.seq = next(self._seq)
+        heapq.heappush(self._heap, (timer.deadline, timer.seq, timer))
+
+    def _compact(self):
+        # Убираем отменённые и устаревшие записи, когда их больше половины кучи
+        if len(self._heap) > 64 and len(self._heap) > 2 * self._pending:
+            self._heap = [entry for entry in self._heap if entry[2].active and entry[1] == entry[2].seq]
+            heapq.heapify(self._heap)
+
+    def _ensure_running(self, timer):
+        if self._thread is None:
+            self._thread = eventlet.spawn(self._run)
+        elif self._heap and self._heap[0][2] is timer and not self._wakeup.ready():
+            # Новый таймер раньше текущего сна — будим цикл
+            self._wakeup.send()
+
+    def _pop_due(self, now):
+        due = []
+        with self._lock:
+            while self._heap:
+                deadline, seq, timer = self._heap[0]
+                if not timer.active or seq != timer.seq:
+                    heapq.heappop(self._heap)
+                    continue
+                if deadline > now:
+                    return due, deadline - now
+                heapq.heappop(self._heap)
+                timer.fired = True
+                self._pending -= 1
+                lag = now - deadline
+                self._stats['fired'] += 1
+                self._stats['lag_total'] += lag
+                self._stats['lag_last'] = lag
+                if lag > self._stats['lag_max']:
+                    self._stats['lag_max'] = lag
+                due.append(timer)
+        return due, None
+
+    def _run(self):
+        while True:
+            due, delay = self._pop_due(self.clock())
+            for timer in due:
+                eventlet.spawn_n(self._fire, timer)
+            if due:
+                eventlet.sleep(0)
+                continue
+            self._wakeup.wait(delay)
+            if self._wakeup.ready():
+                self._wakeup = Event()
+
+    def _fire(self, timer):
+        try:
+            timer.callback(*timer.args)
+        except Exception as e:
+            log.exception("Error in scheduled timer %s", timer.name or timer.callback)
+
+
+class Countdown:
+    """Обратный отсчёт до дедлайна: один таймер на финиш и редкий ресинк.
+
+    Клиенты считают остаток сами по deadline/server_time из payload(),
+    поэтому посекундные тики не нужны.
+    """
+
+    def __init__(self, duration, on_finish, on_resync=None, resync_interval=0, timer_scheduler=None, name=None):
+        self.scheduler = timer_scheduler or scheduler
+        self.duration = duration
+        self.on_finish = on_finish
+        self.on_resync = on_resync
+        self.resync_interval = resync_interval
+        self.name = name
+        self.cancelled = False
+        self.finished = False
+        started_at = self.scheduler.clock()
+        self.deadline = started_at + duration
+        self.wall_deadline = time.time() + duration
+        self.finish_timer = self.scheduler.schedule_at(self.deadline, self._finish, name=name)
+        self.resync_timer = None
+        if on_resync and resync_interval and resync_interval < duration:
+            self.resync_timer = self.scheduler.schedule_at(started_at + resync_interval, self._resync, name=name)
+
+    @property
+    def running(self):
+        return not self.cancelled and not self.finished
+
+    def time_left(self):
+        if not self.running:
+            return 0
+        return max(0, math.ceil(self.deadline - self.scheduler.clock() - 1e-3))
+
+    def payload(self):
+        return {
+            'time': self.time_left(),
+            'deadline': int(self.wall_deadline * 1000),
+            'server_time': int(time.time() * 1000),
+        }
+
+    def cancel(self):
+        if not self.running:
+            return False
+        self.cancelled = True
+        self.finish_timer.cancel()
+        if self.resync_timer:
+            self.resync_timer.cancel()
+        return True
+
+    def _resync(self):
+        if not self.running:
+            return
+        next_resync = self.resync_timer.deadline + self.resync_interval
+        if next_resync < self.deadline:
+            self.resync_timer = self.scheduler.schedule_at(next_resync, self._resync, name=self.name)
+        self.on_resync(self)
+
+    def _finish(self):
+        if not self.running:
+            return
+        self.finished = True
+        if self.resync_timer:
+            self.resync_timer.cancel()
+        self.on_finish(self)
+
+
+scheduler = TimerScheduler()
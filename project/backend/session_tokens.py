@@ -0,0 +1,52 @@
+import base64
+import hashlib
+import hmac
+import json
+import time
+
+
+def _b64encode(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode()
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+class SessionTokens:
+    """Короткоживущие токены сессии: JSON-клеймы, подписанные HMAC-SHA256.
+
+    HMAC с ключом подготавливается один раз в конструкторе, подпись
+    считается копией; проверка токена не ходит в базу.
+    """
+
+    def __init__(self, secret, ttl):
+        self.ttl = ttl
+        key = hashlib.sha256(b'session-token:' + secret.encode()).digest()
+        self._mac = hmac.new(key, digestmod=hashlib.sha256)
+
+    def issue(self, claims):
+        """Подписывает claims, добавляя срок действия exp (unix-время)"""
+        payload = dict(claims, exp=int(time.time()) + self.ttl)
+        body = _b64encode(json.dumps(payload, separators=(',', ':')).encode())
+        return f'{body}.{self._sign(body)}'
+
+    def verify(self, token):
+        """Возвращает клеймы действующего токена или None"""
+        if not token or not isinstance(token, str):
+            return None
+        body, _, signature = token.partition('.')
+        if not signature or not hmac.compare_digest(signature, self._sign(body)):
+            return None
+        try:
+            claims = json.loads(_b64decode(body))
+        except ValueError:
+            return None
+        if not isinstance(claims, dict) or claims.get('exp', 0) < time.time():
+            return None
+        return claims
+
+    def _sign(self, body):
+        mac = self._mac.copy()
+        mac.update(body.encode())
+        return _b64encode(mac.digest())
@@ -0,0 +1,163 @@
+import contextvars
+import functools
+import logging
+import os
+import re
+import sys
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+log = logging.getLogger(__name__)
+
+# Текущая единица работы (HTTP-запрос, событие сокета, таймер); у каждого гринлета своя
+_current = contextvars.ContextVar('sql_profile', default=None)
+
+_PLACEHOLDER_LIST = re.compile(r'\((?:\s*(?:\?|%\(\w+\)s|%s|:\w+)\s*,)+\s*(?:\?|%\(\w+\)s|%s|:\w+)\s*\)')
+_SPACES = re.compile(r'\s+')
+_THIS_FILE = os.path.abspath(__file__)
+
+
+@functools.lru_cache(maxsize=2048)
+def statement_shape(statement):
+    """Форма запроса: пробелы схлопнуты, списки параметров IN (?, ?, ...) сведены к (?)"""
+    return _PLACEHOLDER_LIST.sub('(?)', _SPACES.sub(' ', statement).strip())
+
+
+class QueryProfile:
+    """Счётчики SQL одной единицы работы"""
+
+    __slots__ = ('kind', 'name', 'queries', 'commits', 'db_time', 'shapes', 'repeated')
+
+    def __init__(self, kind, name):
+        self.kind = kind
+        self.name = name
+        self.queries = 0
+        self.commits = 0
+        self.db_time = 0.0
+        self.shapes = {}
+        # форма -> место вызова, где повтор впервые превысил порог
+        self.repeated = {}
+
+
+class SQLProfiler:
+    """Профилировщик SQL на событиях движка SQLAlchemy.
+
+    Считает запросы и время БД для текущей единицы работы, отмечает формы
+    запросов, повторённые больше repeat_threshold раз (N+1), и логирует
+    медленные запросы с местом вызова в коде приложения.
+    """
+
+    def __init__(self, slow_threshold=0.1, repeat_threshold=10, app_root=None, registry=None, enabled=True):
+        self.slow_threshold = slow_threshold
+        self.repeat_threshold = repeat_threshold
+        self.app_root = app_root or os.path.dirname(_THIS_FILE)
+        self.enabled = enabled
+        # Вызываются с каждым завершённым профилем (query_budget.py собирает их по шагам)
+        self.listeners = []
+        if registry is not None:
+            self.queries_metric = registry.histogram(
+                'sql_queries_per_unit', 'SQL statements per request, socket event or timer callback',
+                ('kind', 'name'), buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100, 200, 500))
+            self.time_metric = registry.counter(
+                'sql_time_seconds_total', 'Time spent in SQL by request, socket event or timer callback',
+                ('kind', 'name'))
+            self.repeated_metric = registry.counter(
+                'sql_repeated_statements_total', 'Statement shapes repeated above the N+1 threshold',
+                ('kind', 'name'))
+        else:
+            self.queries_metric = self.time_metric = self.repeated_metric = None
+
+    def attach(self, engine):
+        if not self.enabled:
+            return
+        event.listen(engine, 'before_cursor_execute', self._before_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_execute)
+        event.listen(engine, 'commit', self._on_commit)
+        event.listen(engine, 'handle_error', self._on_error)
+
+    def start(self, kind, name):
+        """Начинает профиль; вернуть токен в finish()"""
+        if not self.enabled:
+            return None
+        profile = QueryProfile(kind, name)
+        return profile, _current.set(profile)
+
+    def finish(self, token):
+        """Завершает профиль: метрики и предупреждения о повторах. Возвращает профиль"""
+        if token is None:
+            return None
+        profile, reset = token
+        try:
+            _current.reset(reset)
+        except ValueError:
+            # Токен из другого контекста: профиль уже не текущий
+            _current.set(None)
+        self._report(profile)
+        return profile
+
+    @contextmanager
+    def profile(self, kind, name):
+        token = self.start(kind, name)
+        try:
+            yield token[0] if token else None
+        finally:
+            self.finish(token)
+
+    def current(self):
+        return _current.get()
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('sql_profile_started', []).append(time.perf_counter())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started = conn.info['sql_profile_started'].pop()
+        elapsed = time.perf_counter() - started
+        if elapsed >= self.slow_threshold:
+            log.warning("Slow SQL %.1f ms at %s: %s", elapsed * 1000, self._call_site(), statement_shape(statement)[:500])
+        profile = _current.get()
+        if profile is None:
+            return
+        profile.queries += 1
+        profile.db_time += elapsed
+        shape = statement_shape(statement)
+        count = profile.shapes.get(shape, 0) + 1
+        profile.shapes[shape] = count
+        if count == self.repeat_threshold + 1:
+            profile.repeated[shape] = self._call_site()
+
+    def _on_error(self, context):
+        # Упавший запрос не дойдёт до after_cursor_execute: снимаем его время старта,
+        # иначе следующий замер на этом соединении возьмёт чужое
+        conn = context.connection
+        started = conn.info.get('sql_profile_started') if conn is not None else None
+        if started:
+            started.pop()
+
+    def _on_commit(self, conn):
+        profile = _current.get()
+        if profile is not None:
+            profile.commits += 1
+
+    def _report(self, profile):
+        for listener in self.listeners:
+            listener(profile)
+        if self.queries_metric is not None:
+            self.queries_metric.observe(profile.queries, profile.kind, profile.name)
+            self.time_metric.inc(profile.kind, profile.name, amount=profile.db_time)
+        for shape, site in profile.repeated.items():
+            if self.repeated_metric is not None:
+                self.repeated_metric.inc(profile.kind, profile.name)
+            log.warning("Possible N+1: statement repeated %s times in %s %s, first excess at %s: %s",
+                        profile.shapes[shape], profile.kind, profile.name, site, shape[:500])
+
+    def _call_site(self):
+        # Ближайший кадр кода приложения вне этого модуля
+        frame = sys._getframe(2)
+        while frame is not None:
+            filename = os.path.abspath(frame.f_code.co_filename)
+            if filename.startswith(self.app_root) and filename != _THIS_FILE:
+                return f'{os.path.basename(filename)}:{frame.f_lineno} in {frame.f_code.co_name}'
+            frame = frame.f_back
+        return 'unknown'
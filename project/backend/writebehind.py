@@ -0,0 +1,126 @@
+import logging
+
+import eventlet
+from eventlet.queue import Queue, Empty
+
+log = logging.getLogger(__name__)
+
+
+class WriteBehindQueue:
+    """Отложенная запись: пачки операций применяются в фоновом гринлете.
+
+    Накопившееся в очереди группируется по ключу пачки (игре): каждый ключ
+    пишется своим вызовом apply_batch (один коммит), так что сбой одной игры
+    не теряет записи других. Порядок пачек внутри ключа сохраняется.
+
+    Если все попытки записи ключа не удались, его пачки остаются в очереди
+    отложенными и перезаписываются позже (вместе с новыми пачками того же
+    ключа); их callback вызываются только после успешной записи.
+    """
+
+    def __init__(self, apply_batch, max_batches=64, retries=3, retry_interval=5, max_retry_interval=60):
+        self.apply_batch = apply_batch
+        self.max_batches = max_batches
+        self.retries = retries
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self._queue = Queue()
+        self._worker = None
+        # Ключ -> пачки, запись которых не удалась, и число неудачных заходов
+        self._held = {}
+        self._held_failures = {}
+        self.stats = {
+            'submitted': 0,
+            'flushed': 0,
+            'commits': 0,
+            'failed': 0,
+        }
+
+    def submit(self, ops, callback=None, key=None):
+        """Ставит пачку операций в очередь; callback вызывается после записи"""
+        self._put((list(ops), callback, key))
+        self.stats['submitted'] += 1
+
+    def flush(self):
+        """Ждёт, пока поставленные пачки будут записаны или отложены после сбоя"""
+        if self._worker is not None:
+            self._queue.join()
+
+    def discard(self, key=None):
+        """Отбрасывает отложенные пачки ключа (игра удалена), без ключа — все;
+        возвращает число отброшенных операций"""
+        keys = list(self._held) if key is None else [key]
+        dropped = 0
+        for k in keys:
+            self._held_failures.pop(k, None)
+            count = sum(len(ops) for ops, _, _ in self._held.pop(k, []))
+            if count:
+                log.warning("Discarded %s deferred operations of %s", count, k)
+            dropped += count
+        return dropped
+
+    @property
+    def pending(self):
+        return self._queue.unfinished_tasks
+
+    @property
+    def held(self):
+        return sum(len(ops) for items in self._held.values() for ops, _, _ in items)
+
+    def _put(self, item):
+        self._queue.put(item)
+        if self._worker is None:
+            self._worker = eventlet.spawn(self._run)
+
+    def _run(self):
+        while True:
+            items = [self._queue.get()]
+            while len(items) < self.max_batches:
+                try:
+                    items.append(self._queue.get_nowait())
+                except Empty:
+                    break
+            groups = {}
+            for item in items:
+                groups.setdefault(item[2], []).append(item)
+            try:
+                for key, group in groups.items():
+                    self._write_group(key, self._held.pop(key, []) + group)
+            finally:
+                for _ in items:
+                    self._queue.task_done()
+
+    def _write_group(self, key, items):
+        ops = [op for batch, _, _ in items for op in batch]
+        if not self._write(ops):
+            failures = self._held_failures.get(key, 0) + 1
+            self._held_failures[key] = failures
+            self._held[key] = [item for item in items if item[0] or item[1]]
+            delay = min(self.retry_interval * 2 ** (failures - 1), self.max_retry_interval)
+            log.error("Deferred write of %s failed, %s operations kept, next attempt in %ss",
+                      key, len(ops), delay)
+            # Пустая пачка ключа снова поднимет отложенные
+            eventlet.spawn_after(delay, self._put, ([], None, key))
+            return
+        self._held_failures.pop(key, None)
+        for _, callback, _ in items:
+            if callback:
+                try:
+                    callback()
+                except Exception:
+                    log.exception("Error in write-behind callback")
+
+    def _write(self, ops):
+        """Пишет ops одним вызовом apply_batch с повторами; False, если все попытки упали"""
+        for attempt in range(1, self.retries + 1):
+            try:
+                if ops:
+                    self.apply_batch(ops)
+                    self.stats['commits'] += 1
+                self.stats['flushed'] += len(ops)
+                return True
+            except Exception:
+                log.exception("Error writing %s deferred operations (attempt %s)", len(ops), attempt)
+                eventlet.sleep(0.1 * attempt)
+        self.stats['failed'] += len(ops)
+        return False
@@ -3,6 +3,19 @@ import { createPinia } from 'pinia'
 import './style.css'
 import App from './App.vue'
 
+// Токен сессии уходит с каждым запросом к API: сервер берёт пользователя из него без БД
+const nativeFetch = window.fetch.bind(window)
+window.fetch = (input: RequestInfo | URL, init: RequestInit = {}) => {
+  const url = typeof input === 'string' ? input : input instanceof URL ? input.pathname : input.url
+  const token = localStorage.getItem('sessionToken')
+  if (token && url.startsWith('/api/')) {
+    const headers = new Headers(init.headers)
+    headers.set('Authorization', `Bearer ${token}`)
+    init = { ...init, headers }
+  }
+  return nativeFetch(input, init)
+}
+
 const app = createApp(App)
 const pinia = createPinia()
 
@@ -18,8 +18,60 @@ export const currentRoundNumber = ref(1)
 export const totalRounds = ref(1)
 export const playerStatuses = ref<any[]>([])
 
+export const lobbyMembers = ref<any[]>([])
+// Личный статус в текущей игре из my_status_update
+export const myStatus = ref<any>(null)
+let lobbyVersion = { lobby_id: null as string | null, version: 0 }
+
 let socket: Socket | null = null
 let isConnected = false
+let joinedLobby: { chat_id: string, lobby_id: string } | null = null
+
+// Таймеры считаются локально по дедлайну сервера
+type CountdownKind = 'lobby' | 'round' | 'choice'
+let serverOffset = 0
+const deadlines: Record<CountdownKind, number | null> = { lobby: null, round: null, choice: null }
+let countdownTicker: ReturnType<typeof setInterval> | null = null
+
+function secondsLeft(deadline: number) {
+  return Math.max(0, Math.ceil((deadline - (Date.now() + serverOffset)) / 1000))
+}
+
+function tickCountdowns() {
+  if (deadlines.lobby !== null) {
+    globalTimer.value = secondsLeft(deadlines.lobby)
+  }
+  if (deadlines.round !== null) {
+    roundTimer.value = secondsLeft(deadlines.round)
+    gameTimer.value = roundTimer.value
+  }
+  if (deadlines.choice !== null) {
+    choiceTimer.value = secondsLeft(deadlines.choice)
+  }
+  const running = (Object.values(deadlines) as Array<number | null>).some(d => d !== null && secondsLeft(d) > 0)
+  if (!running && countdownTicker) {
+    clearInterval(countdownTicker)
+    countdownTicker = null
+  }
+}
+
+function syncCountdown(kind: CountdownKind, data: any) {
+  if (typeof data.server_time === 'number') {
+    serverOffset = data.server_time - Date.now()
+  }
+  deadlines[kind] = typeof data.deadline === 'number'
+    ? data.deadline
+    : Date.now() + serverOffset + (data.time || 0) * 1000
+  tickCountdowns()
+  if (!countdownTicker) {
+    countdownTicker = setInterval(tickCountdowns, 250)
+  }
+}
+
+function stopCountdown(kind: CountdownKind) {
+  deadlines[kind] = null
+  tickCountdowns()
+}
 
 const onGameFinishedCallbacks: Array<(winnerId: string) => void> = []
 const onTimerUpdateCallbacks: Array<(time: number) => void> = []
@@ -34,13 +86,20 @@ const onChoiceTimerUpdateCallbacks: Array<(data: any) => void> = []
 const onPlayersEliminatedCallbacks: Array<(data: any) => void> = []
 const onRoundUpdatedCallbacks: Array<(data: any) => void> = []
 const onPlayerStatusUpdateCallbacks: Array<(data: any) => void> = []
+const onBalanceUpdateCallbacks: Array<(data: any) => void> = []
 
 export const socketService = {
   connect() {
     if (socket && isConnected) return
-    socket = io({ transports: ['websocket'] })
+    socket = io({
+      transports: ['websocket'],
+      auth: (cb) => cb({ token: localStorage.getItem('sessionToken') })
+    })
     socket.on('connect', () => {
       isConnected = true
+      if (joinedLobby) {
+        socket?.emit('join_lobby', joinedLobby)
+      }
       onConnectCallbacks.forEach(cb => cb())
     })
     socket.on('disconnect', () => {
@@ -49,22 +108,29 @@ export const socketService = {
     socket.on('connect_error', (error) => {
     })
     socket.on('timer_update', (data) => {
-      globalTimer.value = data.time
-      onTimerUpdateCallbacks.forEach(callback => callback(data.time))
+      syncCountdown('lobby', data)
+      onTimerUpdateCallbacks.forEach(callback => callback(globalTimer.value))
     })
     socket.on('game_timer_start', (data) => {
-      roundTimer.value = data.time
-      gameTimer.value = data.time
+      syncCountdown('round', data)
       gameTimerRunning.value = true
       choicePhaseActive.value = false
       onGameTimerStartCallbacks.forEach(callback => callback(data))
     })
     socket.on('game_timer_update', (data) => {
-      roundTimer.value = data.time
-      gameTimer.value = data.time
-      gameTimerRunning.value = data.time > 0
+      syncCountdown('round', data)
+      gameTimerRunning.value = roundTimer.value > 0
       onGameTimerUpdateCallbacks.forEach(callback => callback(data))
     })
+    const onGameTimerStopped = (data: any) => {
+      stopCountdown('round')
+      roundTimer.value = 0
+      gameTimer.value = 0
+      gameTimerRunning.value = false
+      onGameTimerUpdateCallbacks.forEach(callback => callback({ ...data, time: 0 }))
+    }
+    socket.on('game_timer_finished', onGameTimerStopped)
+    socket.on('game_timer_cancel', onGameTimerStopped)
     socket.on('choice_phase_started', (data) => {
       choicePhaseActive.value = true
       choicePhaseData.value = data
@@ -72,14 +138,21 @@ export const socketService = {
       onChoicePhaseStartedCallbacks.forEach(callback => callback(data))
     })
     socket.on('choice_timer_start', (data) => {
-      choiceTimer.value = data.time
+      syncCountdown('choice', data)
       choicePhaseActive.value = true
       onChoiceTimerStartCallbacks.forEach(callback => callback(data))
     })
     socket.on('choice_timer_update', (data) => {
-      choiceTimer.value = data.time
+      syncCountdown('choice', data)
       onChoiceTimerUpdateCallbacks.forEach(callback => callback(data))
     })
+    const onChoiceTimerStopped = (data: any) => {
+      stopCountdown('choice')
+      choiceTimer.value = 0
+      onChoiceTimerUpdateCallbacks.forEach(callback => callback({ ...data, time: 0 }))
+    }
+    socket.on('choice_timer_finished', onChoiceTimerStopped)
+    socket.on('choice_timer_cancel', onChoiceTimerStopped)
     socket.on('players_eliminated', (data) => {
       eliminatedPlayers.value = data.eliminated_players || []
       onPlayersEliminatedCallbacks.forEach(callback => callback(data))
@@ -114,7 +187,34 @@ export const socketService = {
       gameTimerRunning.value = false
       onGameFinishedCallbacks.forEach(callback => callback(data.winner_id))
     })
+    socket.on('lobby_room_changed', (data) => {
+      if (!data.lobby_id) {
+        lobbyMembers.value = []
+        lobbyVersion = { lobby_id: null, version: 0 }
+      }
+      // Комнаты сокета меняет только его воркер: просим сверить комнату лобби
+      socket?.emit('sync_lobby_room')
+    })
     socket.on('lobby_update', (data) => {
+      lobbyVersion = { lobby_id: data.lobby_id ?? null, version: data.version ?? 0 }
+      lobbyMembers.value = data.players || []
+    })
+    socket.on('lobby_delta', (data) => {
+      if (data.lobby_id !== lobbyVersion.lobby_id || data.version > lobbyVersion.version + 1) {
+        // Пропущена версия — просим полный снимок
+        socket?.emit('request_lobby', { lobby_id: data.lobby_id })
+        return
+      }
+      if (data.version <= lobbyVersion.version) return
+      const removed = new Set<string>(data.removed || [])
+      const members = lobbyMembers.value.filter((m: any) => !removed.has(m.chat_id))
+      for (const member of [...(data.changed || []), ...(data.added || [])]) {
+        const index = members.findIndex((m: any) => m.chat_id === member.chat_id)
+        if (index >= 0) members[index] = member
+        else members.push(member)
+      }
+      lobbyMembers.value = members
+      lobbyVersion.version = data.version
     })
     socket.on('admin_lobby_update', (data) => {
     })
@@ -122,6 +222,12 @@ export const socketService = {
       playerStatuses.value = data.statuses || []
       onPlayerStatusUpdateCallbacks.forEach(callback => callback(data))
     })
+    socket.on('balance_update', (data) => {
+      onBalanceUpdateCallbacks.forEach(callback => callback(data))
+    })
+    socket.on('my_status_update', (data) => {
+      myStatus.value = data
+    })
     socket.on('error', (error) => {
     })
   },
@@ -137,6 +243,24 @@ export const socketService = {
       socket.emit(event, data)
     }
   },
+  // Новый токен после входа или обновления; при переподключении он берётся из localStorage
+  setSessionToken(token: string) {
+    this.emit('session_token', { token })
+  },
+  joinLobby(chatId: string, lobbyId: string) {
+    if (lobbyVersion.lobby_id !== lobbyId) {
+      // Состав другого лобби не показываем: снимок нового придёт в ответ на join_lobby
+      lobbyMembers.value = []
+      lobbyVersion = { lobby_id: null, version: 0 }
+    }
+    joinedLobby = { chat_id: chatId, lobby_id: lobbyId }
+    this.emit('join_lobby', joinedLobby)
+  },
+  leaveLobby() {
+    joinedLobby = null
+    lobbyMembers.value = []
+    lobbyVersion = { lobby_id: null, version: 0 }
+  },
   onGameFinished(callback: (winnerId: string) => void) {
     onGameFinishedCallbacks.push(callback)
   },
@@ -176,6 +300,9 @@ export const socketService = {
   onPlayerStatusUpdate(callback: (data: any) => void) {
     onPlayerStatusUpdateCallbacks.push(callback)
   },
+  onBalanceUpdate(callback: (data: any) => void) {
+    onBalanceUpdateCallbacks.push(callback)
+  },
   get isConnected() {
     return isConnected
   }
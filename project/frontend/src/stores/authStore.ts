@@ -1,5 +1,6 @@
 import { defineStore } from 'pinia'
 import { ref, computed } from 'vue'
+import { socketService } from '../services/socketService'
 
 interface TelegramUser {
   chat_id: string
@@ -12,13 +13,52 @@ interface TelegramUser {
   is_admin: boolean
 }
 
+// Токен обновляется за минуту до истечения
+const TOKEN_REFRESH_MARGIN_MS = 60 * 1000
+
 export const useAuthStore = defineStore('auth', () => {
   const user = ref<TelegramUser | null>(null)
+  const token = ref<string | null>(localStorage.getItem('sessionToken'))
   const isAuthenticated = computed(() => !!user.value)
+  let refreshTimer: ReturnType<typeof setTimeout> | null = null
+
+  const scheduleRefresh = (expiresIn: number) => {
+    if (refreshTimer) clearTimeout(refreshTimer)
+    const delay = Math.max(0, expiresIn * 1000 - TOKEN_REFRESH_MARGIN_MS)
+    refreshTimer = setTimeout(() => { refreshToken() }, delay)
+  }
 
-  const login = (userData: TelegramUser) => {
+  const setToken = (sessionToken: string, expiresIn?: number) => {
+    token.value = sessionToken
+    localStorage.setItem('sessionToken', sessionToken)
+    socketService.setSessionToken(sessionToken)
+    if (expiresIn) scheduleRefresh(expiresIn)
+  }
+
+  const login = (userData: TelegramUser, sessionToken?: string, expiresIn?: number) => {
     user.value = userData
     localStorage.setItem('user', JSON.stringify(userData))
+    if (sessionToken) {
+      setToken(sessionToken, expiresIn)
+    }
+  }
+
+  // Новый токен по действующему; false — токена нет или он истёк, нужен вход заново
+  const refreshToken = async () => {
+    if (!token.value) return false
+    try {
+      const response = await fetch('/api/auth/refresh', { method: 'POST' })
+      if (response.ok) {
+        const data = await response.json()
+        setToken(data.token, data.expires_in)
+        return true
+      }
+    } catch (error) {
+      console.error('Error refreshing session token:', error)
+      return false
+    }
+    logout()
+    return false
   }
 
   const register = async (userData: TelegramUser) => {
@@ -27,8 +67,12 @@ export const useAuthStore = defineStore('auth', () => {
   }
 
   const logout = () => {
+    if (refreshTimer) clearTimeout(refreshTimer)
+    refreshTimer = null
     user.value = null
+    token.value = null
     localStorage.removeItem('user')
+    localStorage.removeItem('sessionToken')
   }
 
   const updateBalance = (newBalance: number) => {
@@ -58,6 +102,9 @@ export const useAuthStore = defineStore('auth', () => {
         login(userData)
         return userData
       }
+      if (response.status === 401) {
+        logout()
+      }
     } catch (error) {
       console.error('Error fetching user data:', error)
     }
@@ -69,10 +116,12 @@ export const useAuthStore = defineStore('auth', () => {
 
   return {
     user,
+    token,
     isAuthenticated,
     login,
     register,
     logout,
+    refreshToken,
     updateBalance,
     fetchUserData
   }
@@ -96,26 +96,35 @@ const addCoins = async (amount: number): Promise<boolean> => {
   }
 }
 
+// Баланс при входе; дальше он приходит событием balance_update (setBalance)
 const loadBalance = async (): Promise<void> => {
   const authStore = useAuthStore()
   if (!authStore.isAuthenticated || !authStore.user) {
     return
   }
   try {
-    const response = await fetch(`/api/coins/balance?user_id=${authStore.user.user_id}`)
+    const response = await fetch(`/api/coins/balance?chat_id=${authStore.user.chat_id}`)
     if (response.ok) {
       const data = await response.json()
       if (currentPlayer.value) {
-        currentPlayer.value.balance = data.balance
         currentPlayer.value.id = authStore.user.user_id
         currentPlayer.value.name = authStore.user.nickname
         currentPlayer.value.avatar = authStore.user.nickname.charAt(0).toUpperCase()
       }
+      setBalance(data.balance)
     }
   } catch (error) {
   }
 }
 
+const setBalance = (balance: number) => {
+  const authStore = useAuthStore()
+  authStore.updateBalance(balance)
+  if (currentPlayer.value) {
+    currentPlayer.value.balance = balance
+  }
+}
+
 const playerName = computed(() => {
   const authStore = useAuthStore()
   return authStore.isAuthenticated && authStore.user ? authStore.user.nickname : (currentPlayer.value?.name || '')
@@ -136,6 +145,7 @@ export {
   deductCoin,
   addCoins,
   loadBalance,
+  setBalance,
   playerName,
   playerBalance,
   playerColor,